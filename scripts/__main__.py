@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Runs the stages of a run in one process: python -m scripts --config ..."""
+
+import argparse
+import logging
+import shutil
+
+from scripts.filepaths import FilePaths
+from scripts.pipeline import STAGES, Pipeline
+from scripts.shards import run_shards
+from scripts.telemetry import get_telemetry
+from scripts.utils import load_config
+
+if __name__ == "__main__":
+    # Set up logging
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    names = ", ".join(stage.name for stage in STAGES)
+
+    # Get command line arguments
+    parser = argparse.ArgumentParser(
+        prog="python -m scripts", description="Run the stages of a run."
+    )
+    parser.add_argument("--config", type=str, required=True, help="Config file as YAML")
+    parser.add_argument(
+        "stages",
+        nargs="*",
+        metavar="STAGE",
+        help=f"Stages to run, all by default: {names}",
+    )
+    parser.add_argument(
+        "--only",
+        action="store_true",
+        help="Do not run the stages the given stages depend on",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Run the stages even if nothing changed"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes"
+    )
+    args = parser.parse_args()
+
+    # Load configuration
+    config = load_config(args.config)
+    logging.info(f"Successfully read config file: {args.config}")
+
+    if config.get("aois") or config.get("split_aoi_by"):
+        # One pipeline per AOI, see shards.py
+        try:
+            Pipeline(config).order(args.stages)
+        except ValueError as e:
+            parser.error(str(e))
+        results = run_shards(
+            config,
+            args.stages,
+            force=args.force,
+            upstream=not args.only,
+            workers=args.workers,
+        )
+    else:
+        pipeline = Pipeline(config, workers=args.workers)
+        try:
+            pipeline.order(args.stages)
+        except ValueError as e:
+            parser.error(str(e))
+        results = {
+            None: pipeline.run(args.stages, force=args.force, upstream=not args.only)
+        }
+
+    # Copy config file to output directory, as generate_routes does
+    filepaths = FilePaths(config["output_dir"], config["run_name"])
+    filepaths.OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    shutil.copy(args.config, filepaths.OUTPUT_DIR)
+    get_telemetry().dump(filepaths.OUTPUT_DIR / "telemetry_pipeline.json")
+    for shard, result in results.items():
+        logging.info(
+            ("Successfully finished the run: " if shard is None else f"Shard {shard}: ")
+            + ", ".join(f"{name} {status}" for name, status in result.items())
+        )
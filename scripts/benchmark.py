@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmarks of the pipeline stages on synthetic ORS routes"""
+
+import argparse
+import json
+import logging
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import pandas as pd
+
+from scripts.filepaths import FilePaths, ResultPaths
+from scripts.generate_routes import download_routes
+from scripts.line import LineCollection
+from scripts.ors_stub import StubORSServer, synthetic_route
+from scripts.route import Route, load_routes
+from scripts.route_metrics import calculate_route_metrics
+
+TIMES_OF_DAY = ["morning", "noon", "afternoon", "evening"]
+MODES = ["shortest", "recommended"]
+
+
+class SyntheticRun:
+    """Output tree of a run filled with synthetic ORS responses"""
+
+    def __init__(
+        self, base_dir, n_routes: int, n_vertices: int = 200, n_segments: int = 10
+    ) -> None:
+        """
+        :param base_dir: Directory in which the run is created
+        :param n_routes: Number of route files
+        :param n_vertices: Number of vertices per route
+        :param n_segments: Number of csv value runs per route
+        """
+        self.base_dir = Path(base_dir)
+        self.n_routes = n_routes
+        self.n_vertices = n_vertices
+        self.n_segments = n_segments
+
+        self.filepaths = FilePaths(self.base_dir / "data", "bench")
+        self.filepaths_res = ResultPaths(self.base_dir / "results", "bench")
+        for paths in [self.filepaths, self.filepaths_res]:
+            paths.OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+            paths.create_dirs()
+
+        self.route_files = self._write_routes()
+
+    def _write_routes(self) -> list:
+        paths = []
+        for k in range(self.n_routes):
+            route_id = k // (len(TIMES_OF_DAY) * len(MODES))
+            time_of_day = TIMES_OF_DAY[(k // len(MODES)) % len(TIMES_OF_DAY)]
+            mode = MODES[k % len(MODES)]
+            path = (
+                self.filepaths.ROUTES_DIR
+                / f"route_{route_id}_{time_of_day}_{mode}.geojson"
+            )
+            start = [8.60 + (k % 97) * 1e-3, 49.38 + (k % 89) * 1e-3]
+            end = [8.75 - (k % 83) * 1e-3, 49.44 - (k % 79) * 1e-3]
+            response = synthetic_route(
+                start, end, self.n_vertices, self.n_segments, seed=k
+            )
+            with open(path, "w") as f:
+                json.dump(response, f)
+            paths.append(path)
+        return paths
+
+    def od_pairs(self) -> pd.DataFrame:
+        """OD pairs resulting in n_routes requests for one time of day"""
+        n_pairs = max(1, self.n_routes // len(MODES))
+        return pd.DataFrame(
+            {
+                "lon": [8.60 + (k % 97) * 1e-3 for k in range(n_pairs)],
+                "lat": [49.38 + (k % 89) * 1e-3 for k in range(n_pairs)],
+                "lon2": [8.75 - (k % 83) * 1e-3 for k in range(n_pairs)],
+                "lat2": [49.44 - (k % 79) * 1e-3 for k in range(n_pairs)],
+                "id": range(n_pairs),
+            }
+        )
+
+
+# Each stage prepares its inputs and returns the function that is timed
+def _parse(run):
+    return lambda: [Route(p).extras for p in run.route_files]
+
+
+def _convert_coordinates(run):
+    return lambda: load_routes(run.route_files)
+
+
+def _length(run):
+    routes = load_routes(run.route_files)
+    return lambda: [r.length() for r in routes]
+
+
+def _length_collection(run):
+    collection = LineCollection.from_lines(load_routes(run.route_files))
+    return collection.lengths
+
+
+def _route_metrics(run):
+    return lambda: calculate_route_metrics(run.filepaths, run.filepaths_res, full=True)
+
+
+def _download_routes(run):
+    od_pairs = run.od_pairs()
+    counter = iter(range(1_000_000))
+
+    def download():
+        # New output tree per call, so the response cache is always cold
+        filepaths = FilePaths(run.base_dir / "download", f"run_{next(counter)}")
+        filepaths.OUTPUT_DIR.mkdir(parents=True)
+        filepaths.create_dirs()
+        config = {"ors_url": run.stub.url, "download_workers": 8}
+        download_routes(
+            od_pairs,
+            config,
+            filepaths,
+            ["noon"],
+            len(od_pairs),
+            max_total_requests=run.n_routes,
+        )
+
+    return download
+
+
+STAGES = {
+    "parse": _parse,
+    "convert_coordinates": _convert_coordinates,
+    "length": _length,
+    "length_collection": _length_collection,
+    "route_metrics": _route_metrics,
+    "download_routes": _download_routes,
+}
+
+
+def measure(function, memory: bool = True) -> dict:
+    """
+    Times a function and, in a second call, measures its peak memory with
+    tracemalloc (kept separate, as tracing slows down the timed call).
+    :return: Dictionary with wall time, CPU time and peak memory
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    function()
+    result = {
+        "seconds": time.perf_counter() - wall,
+        "cpu_seconds": time.process_time() - cpu,
+        "peak_mb": None,
+    }
+    if memory:
+        tracemalloc.start()
+        function()
+        result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(
+    sizes=(100, 1000, 10000),
+    stages=None,
+    n_vertices: int = 200,
+    n_segments: int = 10,
+    memory: bool = True,
+) -> list:
+    """
+    Runs the stages on synthetic runs of each size.
+    :param sizes: Numbers of routes
+    :param stages: Names of stages (keys of STAGES), all if None
+    :return: List of result dictionaries
+    """
+    stages = stages or list(STAGES)
+    results = []
+    with (
+        tempfile.TemporaryDirectory() as tmp_dir,
+        StubORSServer(n_vertices=n_vertices, n_segments=n_segments) as stub,
+    ):
+        for n_routes in sizes:
+            run = SyntheticRun(
+                Path(tmp_dir) / str(n_routes), n_routes, n_vertices, n_segments
+            )
+            run.stub = stub
+            for name in stages:
+                result = measure(STAGES[name](run), memory=memory)
+                result.update(
+                    {
+                        "stage": name,
+                        "n_routes": n_routes,
+                        "routes_per_second": n_routes / result["seconds"],
+                    }
+                )
+                logging.info(
+                    f"{name:>20} {n_routes:>6} routes: {result['seconds']:8.3f} s, "
+                    f"{result['routes_per_second']:10.1f} routes/s"
+                )
+                results.append(result)
+    return results
+
+
+def compare(results: list, baseline: list, tolerance: float = 0.2) -> list:
+    """
+    Compares the throughput to a baseline.
+    :param tolerance: Allowed relative slowdown
+    :return: List of results that are slower than the baseline
+    """
+    reference = {(b["stage"], b["n_routes"]): b for b in baseline}
+    regressions = []
+    for result in results:
+        base = reference.get((result["stage"], result["n_routes"]))
+        if base is None:
+            continue
+        ratio = result["routes_per_second"] / base["routes_per_second"]
+        result["baseline_ratio"] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(result)
+    return regressions
+
+
+if __name__ == "__main__":
+    # Set up logging
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    logging.info("Starting benchmarks...")
+
+    # Get command line arguments
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages.")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="Routes"
+    )
+    parser.add_argument(
+        "--stages", nargs="+", choices=list(STAGES), help="Stages to run (all)"
+    )
+    parser.add_argument("--vertices", type=int, default=200, help="Vertices/route")
+    parser.add_argument("--segments", type=int, default=10, help="csv runs/route")
+    parser.add_argument("--no-memory", action="store_true", help="Skip peak memory")
+    parser.add_argument("--output", type=str, help="Write results as JSON")
+    parser.add_argument("--baseline", type=str, help="Baseline results as JSON")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed relative slowdown"
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        args.sizes, args.stages, args.vertices, args.segments, not args.no_memory
+    )
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as src:
+            regressions = compare(results, json.load(src), args.tolerance)
+        for r in regressions:
+            logging.warning(
+                f"Regression in {r['stage']} ({r['n_routes']} routes): "
+                f"{r['baseline_ratio']:.2f}x baseline throughput"
+            )
+
+    if args.output:
+        with open(args.output, "w") as dst:
+            json.dump(results, dst, indent=2)
+        logging.info(f"Successfully wrote results to {args.output}")
+
+    raise SystemExit(1 if regressions else 0)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Content-addressed cache of ORS responses and manifests of completed work"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+
+def request_key(endpoint: str, payload: dict) -> str:
+    """
+    Returns the SHA-256 hash of the full request (endpoint, coordinates,
+    preference and options) in canonical JSON form.
+    """
+    blob = json.dumps(
+        {"endpoint": endpoint, "payload": payload},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def _json_hash(value) -> str:
+    blob = json.dumps(value, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def response_hashes(response: dict) -> tuple:
+    """
+    Returns the SHA-256 hashes of the geometry and of the extras of a
+    directions response. Responses with equal hashes describe the same route,
+    whatever request they were sent for. Works for the GeoJSON and the JSON
+    format (encoded polyline).
+    """
+    if "routes" in response:
+        route = response["routes"][0]
+        geometry, extras = route["geometry"], route.get("extras")
+    else:
+        feature = response["features"][0]
+        geometry, extras = feature["geometry"], feature["properties"].get("extras")
+    return _json_hash(geometry), _json_hash(extras)
+
+
+class ResponseCache:
+    """On-disk cache of ORS responses keyed by request hash, evicting the least recently used"""
+
+    def __init__(self, cache_dir, max_bytes: int = None) -> None:
+        """
+        :param cache_dir: Directory of the cache files
+        :param max_bytes: Maximum total size of the cache, None for unlimited
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._sizes = {p: p.stat().st_size for p in self.cache_dir.glob("*/*.json")}
+
+    @property
+    def size(self) -> int:
+        """Total size of the cached responses in bytes"""
+        return sum(self._sizes.values())
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def get(self, key: str):
+        """
+        Returns the cached response or None. A hit refreshes the access time
+        of the entry, so it is evicted last.
+        """
+        path = self._path(key)
+        try:
+            with open(path) as src:
+                response = json.load(src)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+        return response
+
+    def put(self, key: str, response: dict) -> None:
+        """Stores a response and evicts old entries if the cache is too large."""
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(path.name + f".{threading.get_ident()}.part")
+        with open(tmp_path, "w") as f:
+            json.dump(response, f)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._sizes[path] = path.stat().st_size
+            self._evict()
+
+    def _evict(self) -> None:
+        if self.max_bytes is None or self.size <= self.max_bytes:
+            return
+        entries = []
+        for path in self._sizes:
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                entries.append((0.0, path))
+        for _, path in sorted(entries):
+            if self.size <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            del self._sizes[path]
+
+
+class DownloadManifest:
+    """
+    Append-only record (JSON lines) of the request hash each route file was
+    downloaded with. Used to skip satisfied requests when resuming a run.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def entries(self) -> dict:
+        """
+        Returns the latest entry per route file name: the request hash 'key'
+        and, if recorded, the 'geometry' and 'extras' hashes of the response
+        and 'ref', the file the response was taken from.
+        """
+        entries = {}
+        if not self.path.exists():
+            return entries
+        with open(self.path) as src:
+            for line in src:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line of an interrupted run
+                    continue
+                entries[entry["file"]] = entry
+        return entries
+
+    def load(self) -> dict:
+        """Returns the latest request hash per route file name"""
+        return {name: entry["key"] for name, entry in self.entries().items()}
+
+    def record(self, file_name: str, key: str, **fields) -> None:
+        line = json.dumps({"file": file_name, "key": key, **fields}) + "\n"
+        with self._lock:
+            with open(self.path, "a") as dst:
+                dst.write(line)
+
+
+class FailureJournal:
+    """
+    Append-only record (JSON lines) of failed requests with their full payload
+    and the error, so that only these requests have to be sent again.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def _append(self, entries: list) -> None:
+        lines = "".join(json.dumps(e, default=str) + "\n" for e in entries)
+        with self._lock:
+            with open(self.path, "a") as dst:
+                dst.write(lines)
+
+    def record(self, request: dict, error: Exception) -> None:
+        """
+        :param request: Request as dict, with the route file name as 'file'
+        :param error: Exception of the last attempt
+        """
+        self._append(
+            [
+                {
+                    **request,
+                    "error": type(error).__name__,
+                    "message": str(error),
+                    "time": time.time(),
+                }
+            ]
+        )
+
+    def resolve(self, file_names) -> None:
+        """Marks the failures of these route files as resolved"""
+        self._append([{"file": name, "resolved": True} for name in file_names])
+
+    def load(self) -> dict:
+        """Returns the latest failure per route file name, without resolved ones"""
+        entries = {}
+        if not self.path.exists():
+            return entries
+        with open(self.path) as src:
+            for line in src:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line of an interrupted run
+                    continue
+                if entry.get("resolved"):
+                    entries.pop(entry["file"], None)
+                else:
+                    entries[entry["file"]] = entry
+        return entries
+
+
+def file_state(path: Path, previous: dict = None) -> dict:
+    """
+    Returns size, mtime and SHA-256 hash of a file. The hash of the previous
+    state is reused if size and mtime are unchanged, so unchanged files are
+    not read.
+    """
+    stat = path.stat()
+    state = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if (
+        previous is not None
+        and previous["size"] == state["size"]
+        and previous["mtime_ns"] == state["mtime_ns"]
+    ):
+        return dict(previous)
+    state["sha256"] = hashlib.sha256(path.read_bytes()).hexdigest()
+    return state
+
+
+class MetricsManifest:
+    """
+    State (size, mtime, content hash) of the route files whose metrics are
+    stored in the results, keyed by file name. Used to only process new or
+    changed routes.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+
+    def load(self) -> dict:
+        """Returns the file states of the last run, empty if there is none"""
+        if not self.path.exists():
+            return {}
+        with open(self.path) as src:
+            return json.load(src)
+
+    def save(self, entries: dict) -> None:
+        tmp_path = self.path.with_name(self.path.name + ".part")
+        with open(tmp_path, "w") as dst:
+            json.dump(entries, dst, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def changes(self, file_paths) -> tuple:
+        """
+        Compares route files to the manifest.
+        :param file_paths: Current route files
+        :return: (new file states, added or modified paths, deleted file names)
+        """
+        previous = self.load()
+        current = {}
+        changed = []
+        for path in file_paths:
+            old = previous.get(path.name)
+            current[path.name] = file_state(path, old)
+            if old is None or old["sha256"] != current[path.name]["sha256"]:
+                changed.append(path)
+        deleted = sorted(previous.keys() - current.keys())
+        return current, changed, deleted
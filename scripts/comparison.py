@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Spatial index of all routes of a run and comparison of shortest vs recommended routes"""
+
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from scripts.filepaths import FilePaths, ResultPaths
+from scripts.line import LineCollection
+from scripts.route import (
+    UTM32N,
+    WGS84,
+    get_transformer,
+    route_ids,
+    transform_coordinates,
+)
+from scripts.route_store import RouteStore
+from scripts.utils import load_config
+
+
+class RouteIndex:
+    """
+    Shapely geometries of all routes of a run in a projected CRS, with an
+    STRtree for spatial queries. All geometries are created in one call from
+    the flat vertex array of a LineCollection.
+    """
+
+    def __init__(self, lines: LineCollection, crs: str = UTM32N) -> None:
+        """
+        :param lines: Route geometries in `crs`, named route_{id}_{time}_{type}
+        :param crs: CRS of the vertices (metric)
+        """
+        self.lines = lines
+        self.crs = crs
+        self.names = np.asarray(lines.names, dtype=object)
+        vertex_line = np.repeat(np.arange(len(lines)), lines.counts())
+        self.geometries = shapely.linestrings(
+            lines.vertices[:, :2], indices=vertex_line
+        )
+        self.tree = shapely.STRtree(self.geometries)
+
+    @classmethod
+    def from_routes(cls, routes: list):
+        """Creates the index from Route objects in UTM32N, e.g. from load_routes"""
+        lines = LineCollection.from_lines(routes)
+        names = [route.file_name() for route in routes]
+        return cls(LineCollection(lines.vertices, lines.offsets, names), UTM32N)
+
+    @classmethod
+    def from_store(cls, store: RouteStore, dst_crs: str = UTM32N):
+        """Creates the index from a route store, reprojecting all vertices at once"""
+        vertices = transform_coordinates(store.vertices, WGS84, dst_crs)
+        return cls(LineCollection(vertices, store.offsets, store.sources), dst_crs)
+
+    def keys(self) -> pd.DataFrame:
+        """Returns route_id, time_of_day and type_route of every route"""
+        parts = pd.Series(self.names).str.split("_", expand=True)
+        return pd.DataFrame(
+            {
+                "route_id": route_ids(parts[1]),
+                "time_of_day": parts[2],
+                "type_route": parts[3],
+            }
+        )
+
+    def query(self, area, predicate: str = "intersects", crs: str = None) -> list:
+        """
+        Returns the names of the routes passing through an area.
+        :param area: Shapely geometry, e.g. a polygon or a buffered point
+        :param predicate: Spatial predicate of shapely.STRtree.query
+        :param crs: CRS of the area, the CRS of the index if None
+        """
+        if crs is not None and crs != self.crs:
+            transformer = get_transformer(crs, self.crs)
+            area = shapely.transform(
+                area, lambda xy: np.column_stack(transformer.transform(*xy.T))
+            )
+        index = self.tree.query(area, predicate=predicate)
+        return self.names[np.sort(index)].tolist()
+
+    def pairs(self, first: str = "shortest", second: str = "recommended"):
+        """
+        Returns the indices of matching routes of two route types, i.e. with
+        the same route_id and time of day.
+        :return: DataFrame with route_id, time_of_day and the indices i, j
+        """
+        keys = self.keys()
+        keys["index"] = np.arange(len(keys))
+        a = keys[keys["type_route"] == first]
+        b = keys[keys["type_route"] == second]
+        merged = a.merge(b, on=["route_id", "time_of_day"], suffixes=("_i", "_j"))
+        return merged.rename(columns={"index_i": "i", "index_j": "j"})[
+            ["route_id", "time_of_day", "i", "j"]
+        ]
+
+    def compare_pairs(
+        self,
+        tolerance: float = 10.0,
+        first: str = "shortest",
+        second: str = "recommended",
+        frechet: bool = False,
+        workers: int = 1,
+    ) -> pd.DataFrame:
+        """
+        Compares every pair of routes of two types (see pairs) with vectorized
+        shapely functions.
+        :param tolerance: Buffer width in metres: parts of the first route
+        within this distance of the second count as shared
+        :param frechet: Also compute the discrete Fréchet distance (NaN
+        otherwise). It is quadratic in the number of vertices of a pair and
+        dominates the run time, see README
+        :param workers: Number of threads; shapely releases the GIL, so the
+        pairs are compared in parallel chunks
+        :return: DataFrame with one row per pair: lengths, shared length,
+        shared fraction, Hausdorff and Fréchet distance and the overlap
+        (intersection over union) of the buffered routes
+        """
+        pairs = self.pairs(first, second)
+        a = self.geometries[pairs["i"].to_numpy()]
+        b = self.geometries[pairs["j"].to_numpy()]
+
+        chunks = np.array_split(np.arange(len(pairs)), max(1, workers * 4))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            results = list(
+                pool.map(
+                    lambda rows: _compare(a[rows], b[rows], tolerance, frechet),
+                    chunks,
+                )
+            )
+
+        result = pairs[["route_id", "time_of_day"]].copy()
+        for column in results[0]:
+            values = np.concatenate([r[column] for r in results])
+            result[column.format(first=first, second=second)] = values
+        return result
+
+
+def _compare(a, b, tolerance: float, frechet: bool) -> dict:
+    """Metrics of the pairs of line arrays a and b, see RouteIndex.compare_pairs"""
+    buffer_a = shapely.buffer(a, tolerance)
+    buffer_b = shapely.buffer(b, tolerance)
+    length_a = shapely.length(a)
+    shared = shapely.length(shapely.intersection(a, buffer_b))
+    # Union area from the intersection, saves computing the union
+    area_a, area_b = shapely.area(buffer_a), shapely.area(buffer_b)
+    intersection = shapely.area(shapely.intersection(buffer_a, buffer_b))
+    return {
+        "length_{first}": length_a,
+        "length_{second}": shapely.length(b),
+        "shared_length": shared,
+        "shared_fraction": shared / length_a,
+        "hausdorff": shapely.hausdorff_distance(a, b),
+        "frechet": shapely.frechet_distance(a, b)
+        if frechet
+        else np.full(len(a), np.nan),
+        "buffer_overlap": intersection / (area_a + area_b - intersection),
+    }
+
+
+def write_comparison(
+    filepaths: FilePaths,
+    filepaths_res: ResultPaths,
+    tolerance: float = 10.0,
+    workers: int = 1,
+    frechet: bool = False,
+) -> pd.DataFrame:
+    """
+    Compares the shortest and recommended routes of the route store and
+    writes the result to csv_results/comparison.parquet, see compare_pairs.
+    """
+    index = RouteIndex.from_store(RouteStore(filepaths.ROUTE_STORE_FILE))
+    comparison = index.compare_pairs(
+        tolerance=tolerance, frechet=frechet, workers=workers
+    )
+    comparison.to_parquet(filepaths_res.CSV_RESULTS_DIR / "comparison.parquet")
+    return comparison
+
+
+if __name__ == "__main__":
+    # Set up logging
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    logging.info("Starting route comparison...")
+
+    # Get command line arguments
+    parser = argparse.ArgumentParser(description="Compare route pairs.")
+    parser.add_argument("--config", type=str, required=True, help="Config file as YAML")
+    parser.add_argument(
+        "--tolerance", type=float, default=10.0, help="Shared buffer width (m)"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Number of threads")
+    parser.add_argument(
+        "--frechet",
+        action="store_true",
+        help="Also compute the Fréchet distance (slow, quadratic per pair)",
+    )
+    args = parser.parse_args()
+
+    # Load configuration
+    config = load_config(args.config)
+    logging.info(f"Successfully read config file: {args.config}")
+
+    filepaths = FilePaths(config["output_dir"], config["run_name"])
+    filepaths_res = ResultPaths(config["output_dir_metrics"], config["run_name"])
+    filepaths_res.create_dirs()
+
+    comparison = write_comparison(
+        filepaths,
+        filepaths_res,
+        tolerance=args.tolerance,
+        workers=args.workers,
+        frechet=args.frechet,
+    )
+
+    logging.info(f"Successfully compared {len(comparison)} route pairs")
@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Concurrent, rate-limited download of routes from openrouteservice."""
+
+import json
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import openrouteservice as ors
+import requests
+
+from scripts.cache import (
+    DownloadManifest,
+    FailureJournal,
+    ResponseCache,
+    request_key,
+    response_hashes,
+)
+from scripts.polyline import geometry_file, write_compact
+from scripts.telemetry import get_telemetry, in_context
+
+DIRECTIONS_ENDPOINT = "v2/directions/foot-walking/geojson"
+# JSON format with the geometry as encoded polyline, see polyline.write_compact
+COMPACT_ENDPOINT = "v2/directions/foot-walking/json"
+
+HEADERS = {
+    "Accept": "application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8",
+    "Content-Type": "application/json; charset=utf-8",
+}
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting the request rate to the ORS instance"""
+
+    def __init__(self, rate: float = None, burst: int = 1) -> None:
+        """
+        :param rate: Tokens (requests) added per second. None or 0 disables the limit.
+        :param burst: Maximum number of tokens that can be accumulated
+        """
+        self.rate = rate
+        self.capacity = max(1, int(burst))
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Blocks until a token is available and consumes it."""
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last) * self.rate
+                )
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Pauses all workers of a downloader once the server fails repeatedly, so
+    that a struggling ORS instance is not flooded with retries.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0) -> None:
+        """
+        :param threshold: Consecutive failures that open the breaker. None or
+        0 disables it.
+        :param cooldown: Seconds the breaker stays open. Afterwards requests
+        are sent again, and the next failure reopens it at once.
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Blocks while the breaker is open."""
+        while True:
+            with self._lock:
+                remaining = self._open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self) -> bool:
+        """
+        Counts a failure.
+        :return: True if the breaker was closed and is opened by this failure
+        """
+        if not self.threshold:
+            return False
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.threshold:
+                return False
+            now = time.monotonic()
+            opened = self._open_until <= now
+            self._open_until = now + self.cooldown
+            return opened
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Returns True for errors worth retrying: timeouts, connection errors, rate
+    limiting (429) and server errors (5xx). Other API errors, e.g. unroutable
+    points, fail the same way on every attempt.
+    """
+    if isinstance(error, ors.exceptions.ApiError):
+        return error.status == 429 or error.status >= 500
+    if isinstance(error, ors.exceptions.HTTPError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(
+        error,
+        (
+            ors.exceptions.Timeout,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ),
+    )
+
+
+class _ORSClient(ors.Client):
+    """
+    ORS client raising 503 errors instead of retrying them internally for up
+    to retry_timeout, past the rate limiter, the circuit breaker and the
+    retry counter of the downloader.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._session.hooks["response"].append(self._count_bytes)
+        # Raise before the client sees the response and decides to retry
+        self._session.hooks["response"].append(self._raise_retriable)
+
+    @staticmethod
+    def _count_bytes(response, *args, **kwargs):
+        # Body as received, also of errors; cache hits and links are not sent
+        get_telemetry().count("bytes_downloaded", len(response.content))
+
+    @staticmethod
+    def _raise_retriable(response, *args, **kwargs):
+        if response.status_code in ors.client._RETRIABLE_STATUSES:
+            # ApiError with the status and body, HTTPError if not JSON
+            ors.Client._get_body(response)
+
+
+class RouteRequest:
+    """
+    Single directions request and the file its response is written to. A
+    request derived from another one is not sent: its file is a link to the
+    file of the other request.
+    """
+
+    def __init__(
+        self,
+        route_id,
+        time_of_day: str,
+        mode: str,
+        payload: dict,
+        out_path: Path,
+        endpoint: str = DIRECTIONS_ENDPOINT,
+        derived_from=None,
+    ) -> None:
+        self.route_id = route_id
+        self.time_of_day = time_of_day
+        self.mode = mode
+        self.payload = payload
+        self.out_path = Path(out_path)
+        self.endpoint = endpoint
+        self.derived_from = derived_from
+
+    @property
+    def key(self) -> str:
+        """Hash of the full request, see cache.request_key"""
+        return request_key(self.endpoint, self.payload)
+
+    def __repr__(self) -> str:
+        return f"RouteRequest({self.route_id}, {self.time_of_day}, {self.mode})"
+
+    def to_dict(self) -> dict:
+        """Returns the request as JSON-serializable dict, see from_dict"""
+        return {
+            "file": self.out_path.name,
+            "route_id": self.route_id,
+            "time_of_day": self.time_of_day,
+            "mode": self.mode,
+            "payload": self.payload,
+            "out_path": str(self.out_path),
+            "endpoint": self.endpoint,
+            "derived_from": None
+            if self.derived_from is None
+            else self.derived_from.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, entry: dict):
+        """Creates a request from a dict of to_dict, e.g. a failure journal entry"""
+        derived_from = entry.get("derived_from")
+        return cls(
+            entry["route_id"],
+            entry["time_of_day"],
+            entry["mode"],
+            entry["payload"],
+            Path(entry["out_path"]),
+            endpoint=entry["endpoint"],
+            derived_from=None if derived_from is None else cls.from_dict(derived_from),
+        )
+
+
+def write_response(out_path: Path, response: dict) -> int:
+    """
+    Writes a response atomically, so that an interrupted run never leaves
+    a truncated GeoJSON file behind. Responses of the JSON endpoint are
+    written as compact route files.
+    :return: Number of bytes written
+    """
+    if "routes" in response:
+        return write_compact(out_path, response)
+    data = json.dumps(response).encode()
+    tmp_path = out_path.with_name(out_path.name + ".part")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, out_path)
+    return len(data)
+
+
+def response_files(out_path: Path) -> list:
+    """Returns the files of a response: the geometry file of a compact route first"""
+    if out_path.suffix == ".json":
+        return [geometry_file(out_path), out_path]
+    return [out_path]
+
+
+def link_response(src_path: Path, out_path: Path) -> bool:
+    """
+    Makes out_path a hard link to the response file src_path, so identical
+    responses are stored once, or a copy if the file system does not support
+    hard links. Replaced atomically like write_response.
+    :return: False if src_path does not exist
+    """
+    for src, dst in zip(response_files(src_path), response_files(out_path)):
+        tmp_path = dst.with_name(dst.name + ".part")
+        tmp_path.unlink(missing_ok=True)
+        try:
+            os.link(src, tmp_path)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    return True
+
+
+class RouteDownloader:
+    """Downloads route requests with a bounded thread pool under a shared rate limit"""
+
+    def __init__(
+        self,
+        base_url: str,
+        workers: int = 4,
+        rate_limiter: TokenBucket = None,
+        headers: dict = None,
+        cache: ResponseCache = None,
+        manifest: DownloadManifest = None,
+        journal: FailureJournal = None,
+        max_retries: int = 3,
+        backoff: float = 1.0,
+        circuit_breaker: CircuitBreaker = None,
+        dedup_probes: int = 3,
+    ) -> None:
+        """
+        :param base_url: Base URL of the ORS instance
+        :param workers: Number of concurrent requests
+        :param rate_limiter: Token bucket shared by all workers
+        :param headers: HTTP headers sent with every request
+        :param cache: Optional response cache consulted before each request
+        :param manifest: Optional manifest recording the hash of each written file
+        :param journal: Optional journal recording every failed request
+        :param max_retries: Retries of a request after a transient error
+        :param backoff: Delay before the first retry in seconds, doubled for
+        every further retry
+        :param circuit_breaker: Breaker shared by all workers, disabled if None
+        :param dedup_probes: Number of source requests per preference whose
+        derived requests are sent to confirm that the responses do not depend
+        on the time of day, see run
+        """
+        self.base_url = base_url
+        self.workers = max(1, int(workers))
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.headers = headers or HEADERS
+        self.cache = cache
+        self.manifest = manifest
+        self.journal = journal
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(threshold=None)
+        self.dedup_probes = dedup_probes
+        self._local = threading.local()
+        # First file written per response, the response hashes per file and
+        # all geometry hashes seen
+        self._files = {}
+        self._hashes = {}
+        self._geometries = set()
+        self._lock = threading.Lock()
+        # Per preference: True if derived requests were confirmed to get the
+        # same response as their source, False if not, missing if unknown
+        self._dedup = {}
+        self._manifest_entries = None
+
+    @classmethod
+    def from_config(
+        cls,
+        config: dict,
+        rate_limiter: TokenBucket = None,
+        cache: ResponseCache = None,
+        manifest: DownloadManifest = None,
+        journal: FailureJournal = None,
+        circuit_breaker: CircuitBreaker = None,
+    ):
+        """
+        Creates a downloader from the settings in config.yml. A rate limiter
+        and circuit breaker can be passed to share them between downloaders
+        that send to the same ORS instance, e.g. the shards of a run.
+        """
+        if rate_limiter is None:
+            rate_limiter = TokenBucket(
+                config.get("requests_per_second"), config.get("request_burst", 1)
+            )
+        return cls(
+            config["ors_url"],
+            workers=config.get("download_workers", 4),
+            rate_limiter=rate_limiter,
+            cache=cache,
+            manifest=manifest,
+            journal=journal,
+            max_retries=config.get("max_retries", 3),
+            backoff=config.get("retry_backoff_s", 1.0),
+            circuit_breaker=circuit_breaker
+            or CircuitBreaker(
+                config.get("circuit_breaker_failures", 5),
+                config.get("circuit_breaker_cooldown_s", 30.0),
+            ),
+            dedup_probes=config.get("dedup_probes", 3),
+        )
+
+    def pending(self, requests: list, done: dict = None) -> list:
+        """
+        Returns the requests that are not yet satisfied, i.e. whose output file
+        is missing or was downloaded with a different request.
+        :param done: Manifest entries, loaded from the manifest if None
+        """
+        if done is None:
+            if self.manifest is None:
+                return list(requests)
+            done = self.manifest.load()
+        return [
+            r
+            for r in requests
+            if not (r.out_path.exists() and done.get(r.out_path.name) == r.key)
+        ]
+
+    def _client(self) -> ors.Client:
+        """Returns the ORS client of the calling thread (sessions are not thread-safe)"""
+        client = getattr(self._local, "client", None)
+        if client is None:
+            # Rate limiting (429) and unavailability (503) are retried in fetch,
+            # under the rate limiter and the circuit breaker
+            client = _ORSClient(base_url=self.base_url, retry_over_query_limit=False)
+            self._local.client = client
+        return client
+
+    def fetch(self, request: RouteRequest) -> dict:
+        """
+        Sends a single request once the circuit breaker and the rate limiter
+        allow it. Transient errors are retried with exponential backoff. The
+        time spent waiting and the request latency are recorded separately.
+        """
+        telemetry = get_telemetry()
+        for attempt in range(self.max_retries + 1):
+            with telemetry.stage("download.circuit_breaker_wait"):
+                self.circuit_breaker.wait()
+            with telemetry.stage("download.rate_limit_wait"):
+                self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self._client().request(
+                    url=request.endpoint,
+                    post_json=request.payload,
+                    requests_kwargs={"headers": self.headers},
+                )
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                if self.circuit_breaker.record_failure():
+                    logging.warning(
+                        f"Server is failing ({e}), pausing all requests for "
+                        f"{self.circuit_breaker.cooldown} s"
+                    )
+                    telemetry.count("circuit_breaker_opened")
+                if attempt == self.max_retries:
+                    raise
+                telemetry.count("retries")
+                # Full jitter, so that the workers do not retry in lockstep
+                time.sleep(self.backoff * 2**attempt * random.random())
+                continue
+            self.circuit_breaker.record_success()
+            telemetry.record_latency(time.perf_counter() - start)
+            return response
+
+    def _write(self, request: RouteRequest, response: dict) -> dict:
+        """
+        Writes a response, as a link to an earlier file with the same geometry
+        and extras if there is one.
+        :return: Manifest fields of the file
+        """
+        telemetry = get_telemetry()
+        geometry, extras = response_hashes(response)
+        with self._lock:
+            first = self._files.setdefault((geometry, extras), request.out_path)
+            same_geometry = geometry in self._geometries
+            self._geometries.add(geometry)
+            self._hashes[request.out_path.name] = (geometry, extras)
+        fields = {"geometry": geometry, "extras": extras}
+        if same_geometry:
+            telemetry.count("duplicate_geometries")
+        if first != request.out_path and link_response(first, request.out_path):
+            telemetry.count("duplicate_responses")
+            fields["ref"] = first.name
+        else:
+            write_response(request.out_path, response)
+        return fields
+
+    def _download(self, request: RouteRequest) -> RouteRequest:
+        telemetry = get_telemetry()
+        key = request.key
+        response = self.cache.get(key) if self.cache is not None else None
+        if response is None:
+            response = self.fetch(request)
+            if self.cache is not None:
+                self.cache.put(key, response)
+            fields = self._write(request, response)
+        else:
+            telemetry.count("cache_hits")
+            fields = self._write(request, response)
+        if self.manifest is not None:
+            self.manifest.record(request.out_path.name, key, **fields)
+        return request
+
+    def _derive(self, request: RouteRequest, failed=()) -> RouteRequest:
+        """
+        Links the file of a derived request to the file it is derived from.
+        :param failed: Files whose download failed in this run
+        """
+        source = request.derived_from.out_path
+        if source in failed or not link_response(source, request.out_path):
+            raise FileNotFoundError(f"{source.name} was not downloaded")
+        get_telemetry().count("derived_requests")
+        if self.manifest is not None:
+            fields = {"ref": source.name}
+            if source.name in self._hashes:
+                fields["geometry"], fields["extras"] = self._hashes[source.name]
+            self.manifest.record(request.out_path.name, request.key, **fields)
+        return request
+
+    def sends(self, request: RouteRequest) -> bool:
+        """
+        Returns False if the request will be derived instead of sent: it is
+        derived and probes confirmed the derivation of its preference. Derived
+        requests of other preferences may be sent as probes or after the
+        probes rejected the derivation.
+        """
+        return request.derived_from is None or not self._dedup.get(request.mode)
+
+    def _response_hashes(self, file_name: str):
+        """
+        Returns the (geometry, extras) hashes of a route file written in this
+        run or recorded in the manifest, None if unknown.
+        """
+        with self._lock:
+            if file_name in self._hashes:
+                return self._hashes[file_name]
+        if self.manifest is None:
+            return None
+        if self._manifest_entries is None:
+            self._manifest_entries = self.manifest.entries()
+        entry = self._manifest_entries.get(file_name, {})
+        if "geometry" not in entry or "extras" not in entry:
+            return None
+        return entry["geometry"], entry["extras"]
+
+    def _probes(self, derived: list) -> list:
+        """
+        Returns the derived requests of the first dedup_probes sources of
+        every preference that is not yet confirmed or rejected.
+        """
+        probes = []
+        sources = {}
+        for request in derived:
+            if request.mode in self._dedup:
+                continue
+            seen = sources.setdefault(request.mode, set())
+            if id(request.derived_from) not in seen:
+                if len(seen) == self.dedup_probes:
+                    continue
+                seen.add(id(request.derived_from))
+            probes.append(request)
+        return probes
+
+    def _confirm(self, probes: list) -> None:
+        """
+        Confirms or rejects the derivation of each preference of the probes:
+        confirmed if every probe got the same geometry and extras as its
+        source, rejected as soon as one differs.
+        """
+        matches = {}
+        for request in probes:
+            source = self._response_hashes(request.derived_from.out_path.name)
+            probe = self._response_hashes(request.out_path.name)
+            if source is not None and probe is not None:
+                matches.setdefault(request.mode, []).append(source == probe)
+        for mode, results in matches.items():
+            self._dedup[mode] = all(results)
+            get_telemetry().count(
+                "dedup_confirmed" if self._dedup[mode] else "dedup_rejected"
+            )
+            logging.info(
+                f"Dedup of {mode}: {sum(results)} of {len(results)} probes "
+                f"identical, {'deriving' if self._dedup[mode] else 'sending'} "
+                "the other requests"
+            )
+
+    def run(self, requests: list, progress=None) -> list:
+        """
+        Downloads all requests and writes every response as soon as it arrives.
+        Derived requests are only derived from their source request (their file
+        is linked to its file) once the responses of their preference were
+        confirmed to be equivalent: the derived requests of the first
+        dedup_probes sources of a preference are sent, and the preference is
+        derived only if all of them got the same geometry and extras as their
+        source. Otherwise the derived requests are sent like all others. The
+        decision is kept for later calls.
+        :param requests: List of RouteRequest
+        :param progress: Optional tqdm-like object, updated once per request
+        :return: List of (RouteRequest, Exception) tuples for failed requests
+        """
+        failed = []
+
+        def done(request, call):
+            try:
+                call(request)
+            except Exception as e:
+                print(
+                    f"Error for row {request.route_id} at time {request.time_of_day}: {e}"
+                )
+                failed.append((request, e))
+                get_telemetry().count("failures")
+                if self.journal is not None:
+                    self.journal.record(request.to_dict(), e)
+            if progress is not None:
+                progress.update(1)
+
+        def send(requests):
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = {
+                    pool.submit(in_context(self._download), r): r for r in requests
+                }
+                for future in as_completed(futures):
+                    done(futures[future], lambda _: future.result())
+
+        derived = [r for r in requests if r.derived_from is not None]
+        probes = self._probes(derived)
+        send([r for r in requests if r.derived_from is None] + probes)
+        self._confirm(probes)
+
+        probe_ids = {id(r) for r in probes}
+        rest = [r for r in derived if id(r) not in probe_ids]
+        send([r for r in rest if not self._dedup.get(r.mode)])
+        failed_paths = {r.out_path for r, _ in failed}
+        for request in rest:
+            if self._dedup.get(request.mode):
+                done(request, lambda r: self._derive(r, failed_paths))
+        return failed
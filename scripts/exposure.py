@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Segment-level exposure of many routes, computed on flat arrays"""
+
+import argparse
+import logging
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+from scripts.filepaths import FilePaths, ResultPaths
+from scripts.line import LineCollection
+from scripts.route import UTM32N, WGS84, transform_coordinates
+from scripts.route_store import RouteStore
+from scripts.utils import load_config
+
+
+class ExposureEngine:
+    """
+    Exposure along the segments of many routes. The value runs
+    [start_idx, end_idx, value] of an ORS extra (e.g. 'csv') of all routes are
+    stored as one flat (R, 3) array with offsets per route, next to the route
+    geometries as a LineCollection. Run k of route i assigns its value to the
+    segments start_idx to end_idx - 1 of that route.
+    """
+
+    def __init__(
+        self, lines: LineCollection, runs, run_offsets, time_of_day=None
+    ) -> None:
+        """
+        :param lines: Projected route geometries (metres)
+        :param runs: (R, 3) array of [start_idx, end_idx, value] of all routes
+        :param run_offsets: (K + 1,) array, runs of route k are
+        runs[run_offsets[k]:run_offsets[k + 1]]
+        :param time_of_day: Optional list with the time of day of each route
+        """
+        self.lines = lines
+        self.runs = np.asarray(runs, dtype=np.float64).reshape(-1, 3)
+        self.run_offsets = np.asarray(run_offsets, dtype=np.int64)
+        if len(self.run_offsets) != len(lines) + 1:
+            raise ValueError("There must be one run offset per line and one more.")
+        self.time_of_day = time_of_day
+
+    @staticmethod
+    def _flatten(runs_per_route: list) -> tuple:
+        """Returns the runs of all routes as one array and their offsets"""
+        counts = [len(runs) for runs in runs_per_route]
+        runs = np.array(list(chain.from_iterable(runs_per_route)), dtype=np.float64)
+        return runs.reshape(-1, 3), np.concatenate([[0], np.cumsum(counts)])
+
+    @classmethod
+    def from_routes(cls, routes: list, criterion: str = "csv"):
+        """
+        Creates the engine from Route objects in a projected CRS, e.g. from
+        route.load_routes.
+        """
+        runs, run_offsets = cls._flatten(
+            [route.extras[criterion]["values"] for route in routes]
+        )
+        return cls(
+            LineCollection.from_lines(routes),
+            runs,
+            run_offsets,
+            [route.time_of_day for route in routes],
+        )
+
+    @classmethod
+    def from_store(
+        cls,
+        store: RouteStore,
+        criterion: str = "csv",
+        dst_crs: str = UTM32N,
+        start: int = 0,
+        stop: int = None,
+    ):
+        """
+        Creates the engine from the rows start to stop (all by default) of a
+        route store. The vertices of all routes are reprojected to dst_crs in
+        one call.
+        """
+        stop = len(store) if stop is None else stop
+        offsets = store.offsets[start : stop + 1]
+        vertices = transform_coordinates(
+            store.vertices[offsets[0] : offsets[-1]], WGS84, dst_crs
+        )
+        runs, run_offsets = cls._flatten(
+            [store.extras(i)[criterion]["values"] for i in range(start, stop)]
+        )
+        return cls(
+            LineCollection(vertices, offsets - offsets[0], store.sources[start:stop]),
+            runs,
+            run_offsets,
+            store.table.column("time_of_day").to_pylist()[start:stop],
+        )
+
+    def segment_values(self) -> np.ndarray:
+        """
+        Returns the value of every segment (line after line), NaN for segments
+        that are not covered by a run.
+        """
+        n_segments = self.lines.counts() - 1
+        first_segment = np.concatenate([[0], np.cumsum(n_segments)])[:-1]
+        run_line = np.repeat(np.arange(len(self.lines)), np.diff(self.run_offsets))
+
+        starts = self.runs[:, 0].astype(np.int64)
+        ends = np.minimum(self.runs[:, 1].astype(np.int64), n_segments[run_line])
+        lengths = np.clip(ends - starts, 0, None)
+
+        # Flat segment index of every segment covered by a run
+        run_start = first_segment[run_line] + starts - (np.cumsum(lengths) - lengths)
+        index = np.arange(lengths.sum()) + np.repeat(run_start, lengths)
+
+        values = np.full(n_segments.sum(), np.nan)
+        values[index] = np.repeat(self.runs[:, 2], lengths)
+        return values
+
+    def _weighted(self):
+        """Horizontal segment lengths and value * length, 0 where no value"""
+        lengths = self.lines.segment_lengths(horizontal=True)
+        values = self.segment_values()
+        covered = ~np.isnan(values)
+        lengths = np.where(covered, lengths, 0.0)
+        return lengths, np.where(covered, values * lengths, 0.0)
+
+    def route_exposure(self) -> np.ndarray:
+        """
+        Returns the distance-weighted mean value of each route, NaN for
+        routes without values.
+        """
+        lengths, weighted = self._weighted()
+        line_index = self.lines.line_index()
+        n = len(self.lines)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.bincount(line_index, weighted, n) / np.bincount(
+                line_index, lengths, n
+            )
+
+    def exposure_per_time_of_day(self) -> pd.Series:
+        """
+        Returns the distance-weighted mean value of all routes of each time
+        of day.
+        """
+        if self.time_of_day is None:
+            raise ValueError("The time of day of the routes is unknown.")
+        codes, times = pd.factorize(pd.Series(self.time_of_day))
+        segment_codes = codes[self.lines.line_index()]
+        lengths, weighted = self._weighted()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            exposure = np.bincount(segment_codes, weighted, len(times)) / np.bincount(
+                segment_codes, lengths, len(times)
+            )
+        return pd.Series(exposure, index=pd.Index(times, name="time_of_day"))
+
+    def cumulative_exposure(self) -> np.ndarray:
+        """
+        Returns the accumulated exposure (value * metres) along its route at
+        each vertex, aligned with lines.vertices and lines.cumulative_distance.
+        Divided by the cumulative distance it gives the mean exposure so far.
+        """
+        _, weighted = self._weighted()
+        return self.lines.cumulative_sum(weighted)
+
+
+def write_exposure(filepaths: FilePaths, filepaths_res: ResultPaths) -> ExposureEngine:
+    """
+    Writes the length and exposure of every route of the route store to
+    csv_results/exposure.parquet.
+    :return: The engine of all routes
+    """
+    engine = ExposureEngine.from_store(RouteStore(filepaths.ROUTE_STORE_FILE))
+    df = pd.DataFrame(
+        {
+            "source": engine.lines.names,
+            "length": engine.lines.lengths(),
+            "exposure": engine.route_exposure(),
+        }
+    )
+    df.to_parquet(filepaths_res.CSV_RESULTS_DIR / "exposure.parquet")
+    return engine
+
+
+if __name__ == "__main__":
+    # Set up logging
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    logging.info("Starting exposure calculation...")
+
+    # Get command line arguments
+    parser = argparse.ArgumentParser(description="Calculate segment exposure.")
+    parser.add_argument("--config", type=str, required=True, help="Config file as YAML")
+    args = parser.parse_args()
+
+    # Load configuration
+    config = load_config(args.config)
+    logging.info(f"Successfully read config file: {args.config}")
+
+    filepaths = FilePaths(config["output_dir"], config["run_name"])
+    filepaths_res = ResultPaths(config["output_dir_metrics"], config["run_name"])
+    filepaths_res.create_dirs()
+
+    engine = write_exposure(filepaths, filepaths_res)
+
+    for time_of_day, exposure in engine.exposure_per_time_of_day().items():
+        logging.info(f"Exposure at {time_of_day}: {exposure:.2f}")
+    logging.info("Successfully calculated the exposure of the routes")
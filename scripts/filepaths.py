@@ -20,6 +20,12 @@ class FilePaths:
         # Subdirectories and files
         self.ROUTES_DIR = self.RAW_DIR / "01_routes"
         self.PREPROCESSED_ROUTES_FILE = self.INTERIM_DIR / "preprocessed_routes.gpkg"
+        self.CACHE_DIR = self.INTERIM_DIR / "01_cache"
+        self.DOWNLOAD_MANIFEST_FILE = self.INTERIM_DIR / "download_manifest.jsonl"
+        self.FAILURE_JOURNAL_FILE = self.INTERIM_DIR / "failed_requests.jsonl"
+        self.OD_PAIRS_FILE = self.INTERIM_DIR / "od_pairs.csv"
+        self.ROUTE_STORE_FILE = self.INTERIM_DIR / "routes.arrow"
+        self.PIPELINE_STATE_FILE = self.INTERIM_DIR / "pipeline_state.json"
 
     def create_dirs(self) -> None:
         """Creats sub directories :return:"""
@@ -36,8 +42,9 @@ class ResultPaths:
         self.OUTPUT_DIR = Path(output_dir) / name
         self.CSV_RESULTS_DIR = self.OUTPUT_DIR / "csv_results"
         self.PLOTS_DIR = self.OUTPUT_DIR / "plots"
+        self.HEATMAP_DIR = self.OUTPUT_DIR / "heatmap"
 
     def create_dirs(self) -> None:
         """Creates result directories"""
-        for path in [self.CSV_RESULTS_DIR, self.PLOTS_DIR]:
+        for path in [self.CSV_RESULTS_DIR, self.PLOTS_DIR, self.HEATMAP_DIR]:
             path.mkdir(parents=False, exist_ok=True)
@@ -5,93 +5,304 @@
 from scripts.utils import load_config
 from scripts.filepaths import FilePaths
 from scripts.spatial import RandomPoints
+from scripts.downloader import (
+    COMPACT_ENDPOINT,
+    DIRECTIONS_ENDPOINT,
+    RouteDownloader,
+    RouteRequest,
+)
+from scripts.cache import DownloadManifest, FailureJournal, ResponseCache
+from scripts.route_store import ingest_routes
+from scripts.telemetry import get_telemetry, profiled
 
 import argparse
-import json
 import logging
 import shutil
 from tqdm import tqdm
-import time
-import openrouteservice as ors
 import geopandas as gpd
+import pandas as pd
+
+
+def build_requests(
+    df, filepaths, list_times, dedup_preferences=(), compact: bool = False
+) -> list:
+    """
+    Builds the directions requests for all rows, times of day and preferences.
+    :param dedup_preferences: Preferences whose route may not depend on the
+    time of day. The requests of the other times are marked as derived from
+    the first time of day; the downloader only derives them once probes
+    confirmed identical responses, see RouteDownloader.run.
+    :param compact: Request the JSON format with an encoded polyline and store
+    compact route files (.json and .npy) instead of GeoJSON
+    :return: List of RouteRequest
+    """
+    list_modes = ["shortest", "recommended"]
+    endpoint = COMPACT_ENDPOINT if compact else DIRECTIONS_ENDPOINT
+    suffix = ".json" if compact else ".geojson"
+
+    requests = []
+    first = {}
+    for i in list_times:
+        for row in df.itertuples(index=False):
+            for j in list_modes:
+                parameters = {
+                    "coordinates": [[row.lon, row.lat], [row.lon2, row.lat2]],
+                    "instructions": "false",
+                    "preference": j,
+                    "extra_info": ["csv"],
+                    "elevation": "true",
+                    "continue_straight": "true",
+                    "options": {
+                        "avoid_features": ["ferries"],
+                        "profile_params": {
+                            "weightings": {"csv_factor": 1, "csv_column": i}
+                        },
+                    },
+                }
+                out_path = filepaths.ROUTES_DIR / f"route_{row.id}_{i}_{j}{suffix}"
+                derived_from = (
+                    first.get((row.id, j)) if j in dedup_preferences else None
+                )
+                request = RouteRequest(
+                    row.id,
+                    i,
+                    j,
+                    parameters,
+                    out_path,
+                    endpoint=endpoint,
+                    derived_from=derived_from,
+                )
+                first.setdefault((row.id, j), request)
+                requests.append(request)
+    return requests
+
+
+def _has_no_source(request) -> bool:
+    return request.derived_from is None
+
+
+def limit_requests(requests: list, max_requests: int, sends=_has_no_source) -> tuple:
+    """
+    Keeps the first max_requests requests that may be sent, and the requests
+    that are derived without being sent from a kept request.
+    :param sends: Function returning False for requests that are derived
+    without being sent, see RouteDownloader.sends. By default only requests
+    without derived_from are sent.
+    :return: (kept requests, number of requests that may be sent)
+    """
+    kept = []
+    dropped = set()
+    n_sent = 0
+    for request in requests:
+        if sends(request):
+            if n_sent == max_requests:
+                dropped.add(id(request))
+                continue
+            n_sent += 1
+        elif id(request.derived_from) in dropped:
+            continue
+        kept.append(request)
+    return kept, n_sent
 
 
 def download_routes(
-    df, config, filepaths, list_times, max_routes_per_i, max_total_requests=500
+    od_pairs,
+    config,
+    filepaths,
+    list_times,
+    max_routes_per_i,
+    max_total_requests=500,
+    resume=False,
+    rate_limiter=None,
+    circuit_breaker=None,
 ):
-    """Download routes from OpenRouteService API and save them to a file."""
+    """
+    Download routes from OpenRouteService API and save them to a file.
+    Requests are sent concurrently by `download_workers` threads, limited to
+    `requests_per_second` (config.yml). Each response is written as soon as it arrives.
+    Responses are cached in `filepaths.CACHE_DIR` by request hash. Failed
+    requests are recorded in `filepaths.FAILURE_JOURNAL_FILE`, see retry_failed.
+    :param od_pairs: Dataframe or iterable of dataframes (batches) with lon,
+    lat, lon2, lat2 and id. Batches are requested one after another, so only
+    one batch is held in memory.
+    :param max_routes_per_i: Number of OD pairs requested per time of day
+    :param resume: Skip requests whose route file was already downloaded with
+    the same request
+    :param rate_limiter: Optional TokenBucket shared with other runs
+    :param circuit_breaker: Optional CircuitBreaker shared with other runs
+    :return: List of (RouteRequest, Exception) tuples for failed requests
+    """
+    if isinstance(od_pairs, pd.DataFrame):
+        od_pairs = [od_pairs]
 
-    headers = {
-        "Accept": "application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8",
-        "Content-Type": "application/json; charset=utf-8",
-    }
+    cache = ResponseCache(
+        filepaths.CACHE_DIR, max_bytes=config.get("cache_max_mb", 1024) * 2**20
+    )
+    manifest = DownloadManifest(filepaths.DOWNLOAD_MANIFEST_FILE)
+    journal = FailureJournal(filepaths.FAILURE_JOURNAL_FILE)
+    downloader = RouteDownloader.from_config(
+        config,
+        rate_limiter=rate_limiter,
+        cache=cache,
+        manifest=manifest,
+        journal=journal,
+        circuit_breaker=circuit_breaker,
+    )
+    done = manifest.load() if resume else None
+
+    err_iso = []
+    remaining_rows = max_routes_per_i
+    remaining_requests = max_total_requests
+    n_skipped = 0
+    total = max_routes_per_i * len(list_times) * 2
+
+    with (
+        get_telemetry().stage("download_routes"),
+        tqdm(total=total, desc="Routes", leave=False) as progress,
+    ):
+        for batch in od_pairs:
+            if remaining_rows <= 0 or remaining_requests <= 0:
+                break
+            # Take the first n rows once
+            batch = batch.head(remaining_rows)
+            remaining_rows -= len(batch)
+            requests = build_requests(
+                batch,
+                filepaths,
+                list_times,
+                config.get("dedup_preferences", ()),
+                config.get("compact_geometry", False),
+            )
+
+            if resume:
+                n_requests = len(requests)
+                requests = downloader.pending(requests, done)
+                n_skipped += n_requests - len(requests)
+
+            # Probes and derived requests of unconfirmed preferences may be
+            # sent too, so they count towards the maximum
+            n_requests = len(requests)
+            requests, n_sent = limit_requests(
+                requests, remaining_requests, downloader.sends
+            )
+            remaining_requests -= n_sent
+            if len(requests) < n_requests:
+                print(f"Reached maximum total requests: {max_total_requests}")
+                progress.total = progress.n + len(requests)
+                progress.refresh()
+
+            err_iso.extend(downloader.run(requests, progress=progress))
+
+    if resume:
+        logging.info(f"Resuming: {n_skipped} requests already done")
+    logging.info(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+    return err_iso
 
-    parameters = {
-        "instructions": "false",
-        "preference": "recommended",
-        "extra_info": ["csv"],
-        "elevation": "true",
-        "continue_straight": "true",
-        "options": {
-            "avoid_features": ["ferries"],
-            "profile_params": {"weightings": {"csv_factor": 1, "csv_column": "noon"}},
-        },
+
+def retry_failed(config, filepaths) -> list:
+    """
+    Sends the requests of the failure journal again, except those whose route
+    file was downloaded in the meantime. Requests that succeed are marked as
+    resolved; requests that fail again stay in the journal.
+    :return: List of (RouteRequest, Exception) tuples for failed requests
+    """
+    journal = FailureJournal(filepaths.FAILURE_JOURNAL_FILE)
+    requests = {
+        name: RouteRequest.from_dict(entry) for name, entry in journal.load().items()
     }
+    # Derive from the retried request, not from its copy in the entry
+    for request in requests.values():
+        if request.derived_from is not None:
+            source = request.derived_from.out_path.name
+            request.derived_from = requests.get(source, request.derived_from)
 
-    err_iso = []
+    cache = ResponseCache(
+        filepaths.CACHE_DIR, max_bytes=config.get("cache_max_mb", 1024) * 2**20
+    )
+    manifest = DownloadManifest(filepaths.DOWNLOAD_MANIFEST_FILE)
+    downloader = RouteDownloader.from_config(
+        config, cache=cache, manifest=manifest, journal=journal
+    )
+    pending = downloader.pending(list(requests.values()))
+    journal.resolve(requests.keys() - {r.out_path.name for r in pending})
+    logging.info(f"Retrying {len(pending)} of {len(requests)} failed requests")
 
-    client = ors.Client(base_url=config["ors_url"])
+    with (
+        get_telemetry().stage("retry_failed"),
+        tqdm(total=len(pending), desc="Routes", leave=False) as progress,
+    ):
+        failed = downloader.run(pending, progress=progress)
+    failed_names = {r.out_path.name for r, _ in failed}
+    journal.resolve(
+        [r.out_path.name for r in pending if r.out_path.name not in failed_names]
+    )
+    return failed
 
-    total_requests = 0
 
-    list_modes = ["shortest", "recommended"]
+def save_batches(batches, file_path):
+    """
+    Writes each batch of OD pairs to a CSV file while passing it on.
+    """
+    for k, batch in enumerate(batches):
+        batch.to_csv(file_path, mode="w" if k == 0 else "a", header=k == 0, index=False)
+        yield batch
 
-    if max_routes_per_i <= 100:
-        # Take the first n rows once
-        selected_df = df.head(max_routes_per_i)
-
-        for i in tqdm(list_times, desc="Times loop", leave=False):
-            for row in selected_df.itertuples(index=False):
-                for j in list_modes:
-                    if total_requests >= max_total_requests:
-                        print(f"Reached maximum total requests: {max_total_requests}")
-                        break
-
-                    try:
-                        parameters["coordinates"] = [
-                            [row.lon, row.lat],
-                            [row.lon2, row.lat2],
-                        ]
-                        parameters["preference"] = j
-                        parameters["options"]["profile_params"]["weightings"][
-                            "csv_column"
-                        ] = i
-
-                        ors_response = client.request(
-                            url="v2/directions/foot-walking/geojson",
-                            post_json=parameters,
-                            requests_kwargs={"headers": headers},
-                        )
-
-                        out_path = (
-                            filepaths.ROUTES_DIR / f"route_{row.id}_{i}_{j}.geojson"
-                        )
-                        with open(out_path, "w") as f:
-                            json.dump(ors_response, f)
-
-                    except Exception as e:
-                        print(f"Error for row {row.id} at time {i}: {e}")
-                        err_iso.append(row)
-
-                    finally:
-                        total_requests += 1
-                        time.sleep(0.1)
-
-                if total_requests >= max_total_requests:
-                    print(f"Reached maximum total requests: {max_total_requests}")
-                    break
+
+def generate_routes(
+    config, filepaths, resume: bool = False, rate_limiter=None, circuit_breaker=None
+) -> list:
+    """
+    Generates OD pairs in the area of interest of the config and downloads
+    their routes, see download_routes.
+    :param resume: Skip finished requests. Without a seed in the config, the
+    OD pairs of the previous run are reused.
+    :param rate_limiter: Optional TokenBucket shared with other runs
+    :param circuit_breaker: Optional CircuitBreaker shared with other runs
+    :return: List of (RouteRequest, Exception) tuples for failed requests
+    """
+    # Extract list times from config file
+    list_times = config["times_of_day"]
+
+    # Extract max of routes per times of day
+    max_routes_per_i = config["number_of_routes_per_time_of_day"]
+
+    batch_size = config.get("od_batch_size", 1000)
+
+    if resume and config.get("seed") is None and filepaths.OD_PAIRS_FILE.exists():
+        # Reuse the OD pairs of the interrupted run, so request hashes match
+        od_pairs = pd.read_csv(
+            filepaths.OD_PAIRS_FILE, chunksize=batch_size, float_precision="round_trip"
+        )
+        logging.info(f"Loaded OD pairs from {filepaths.OD_PAIRS_FILE}")
     else:
-        print("error")
+        # Extract input Geodataframe (boundaries of HD)
+        gdf = gpd.read_file(config["input_gdf"])
+
+        # Calculates the amount of random points for the AOI.
+        rp = RandomPoints(gdf)
+        rp.random_points(config["random_points"], seed=config.get("seed"))
+        # Streams the OD pairs in batches, stratified by distance
+        od_pairs = save_batches(
+            rp.od_pairs(
+                max_routes_per_i,
+                batch_size=batch_size,
+                distance_bands=config.get("distance_bands_km"),
+                seed=config.get("seed"),
+            ),
+            filepaths.OD_PAIRS_FILE,
+        )
+
+    return download_routes(
+        od_pairs,
+        config,
+        filepaths,
+        list_times,
+        max_routes_per_i,
+        max_total_requests=config.get("max_total_requests", 500),
+        resume=resume,
+        rate_limiter=rate_limiter,
+        circuit_breaker=circuit_breaker,
+    )
 
 
 if __name__ == "__main__":
@@ -104,6 +315,22 @@ if __name__ == "__main__":
     # Get command line arguments
     parser = argparse.ArgumentParser(description="Calculate metrics of routes.")
     parser.add_argument("--config", type=str, required=True, help="Config file as YAML")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip finished requests. Without a seed in the config, the OD "
+        "pairs of the previous run are reused.",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Only send the failed requests of the previous runs again",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Run the download under cProfile and save the stats in the run directory",
+    )
     args = parser.parse_args()
 
     # Load configuration
@@ -118,22 +345,24 @@ if __name__ == "__main__":
     # Copy config file to output directory
     shutil.copy(args.config, filepaths.OUTPUT_DIR)
 
-    # Extract list times from config file
-    list_times = config["times_of_day"]
-
-    # Extract max of routes per times of day
-    max_routes_per_i = config["number_of_routes_per_time_of_day"]
+    profile_file = filepaths.OUTPUT_DIR / "profile_generate_routes.prof"
+    if args.retry_failed:
+        with profiled(profile_file if args.profile else None):
+            failed = retry_failed(config, filepaths)
+        logging.info(f"{len(failed)} requests failed again")
+    else:
+        # Creates and stores the routes.
+        with profiled(profile_file if args.profile else None):
+            generate_routes(config, filepaths, resume=args.resume)
 
-    # Extract input Geodataframe (boundaries of HD)
-    gdf = gpd.read_file(config["input_gdf"])
+    logging.info("Successfully calculated and stores the routes")
 
-    # Calculates the amount of random points for the AOI.
-    rp = RandomPoints(gdf)
-    rp.random_points(config["random_points"])
-    rp.sample_df()
-    # Returns a Geodatframe with max. 100 routes
-    out_df = rp.compute_distance()
-    # Creates and stores the routes.
-    download_routes(out_df, config, filepaths, list_times, max_routes_per_i)
+    # Pack all routes into one columnar file for the downstream stages
+    with get_telemetry().stage("ingest_routes"):
+        n_routes = ingest_routes(filepaths.ROUTES_DIR, filepaths.ROUTE_STORE_FILE)
+    logging.info(
+        f"Successfully stored {n_routes} routes in {filepaths.ROUTE_STORE_FILE}"
+    )
 
-    logging.info("Successfully calculated and stores the routes")
+    # Request latencies and stage timings next to the copied config.yml
+    get_telemetry().dump(filepaths.OUTPUT_DIR / "telemetry_generate_routes.json")
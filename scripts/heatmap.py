@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Solar exposure of all routes aggregated on a regular metric grid"""
+
+import argparse
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from scripts.exposure import ExposureEngine
+from scripts.filepaths import FilePaths, ResultPaths
+from scripts.route import UTM32N, WGS84, get_transformer
+from scripts.route_store import RouteStore
+from scripts.utils import load_config
+
+# Layers of a heat map: route metres in the cell, metres with a value,
+# sum of value * metres and the number of routes traversing the cell
+LAYERS = {
+    "length": np.float64,
+    "covered_length": np.float64,
+    "exposure_sum": np.float64,
+    "count": np.int64,
+}
+
+
+class Grid:
+    """Regular grid of square cells in a projected CRS, row 0 at the bottom"""
+
+    def __init__(
+        self,
+        origin_x: float,
+        origin_y: float,
+        cell_size: float,
+        nx: int,
+        ny: int,
+        crs: str = UTM32N,
+    ) -> None:
+        """
+        :param origin_x: x of the lower left corner
+        :param origin_y: y of the lower left corner
+        :param cell_size: Width of a cell in units of the CRS (metres)
+        :param nx: Number of columns
+        :param ny: Number of rows
+        :param crs: CRS of the grid
+        """
+        self.origin_x = float(origin_x)
+        self.origin_y = float(origin_y)
+        self.cell_size = float(cell_size)
+        self.nx = int(nx)
+        self.ny = int(ny)
+        self.crs = crs
+
+    @classmethod
+    def from_bounds(cls, bounds, cell_size: float, crs: str = UTM32N):
+        """
+        Creates the smallest grid covering bounds, aligned to multiples of the
+        cell size.
+        :param bounds: (min_x, min_y, max_x, max_y) in crs
+        """
+        min_x, min_y, max_x, max_y = bounds
+        origin_x = np.floor(min_x / cell_size) * cell_size
+        origin_y = np.floor(min_y / cell_size) * cell_size
+        nx = int(np.floor((max_x - origin_x) / cell_size)) + 1
+        ny = int(np.floor((max_y - origin_y) / cell_size)) + 1
+        return cls(origin_x, origin_y, cell_size, nx, ny, crs)
+
+    @classmethod
+    def from_store(cls, store: RouteStore, cell_size: float, crs: str = UTM32N):
+        """Creates the grid covering all routes of a route store"""
+        lon, lat = store.vertices[:, 0], store.vertices[:, 1]
+        bounds = get_transformer(WGS84, crs).transform_bounds(
+            lon.min(), lat.min(), lon.max(), lat.max()
+        )
+        return cls.from_bounds(bounds, cell_size, crs)
+
+    @property
+    def shape(self) -> tuple:
+        return self.ny, self.nx
+
+    def cell_index(self, x, y) -> np.ndarray:
+        """Returns the flat cell index (row * nx + column) of points, -1 outside"""
+        column = np.floor((np.asarray(x) - self.origin_x) / self.cell_size)
+        row = np.floor((np.asarray(y) - self.origin_y) / self.cell_size)
+        inside = (column >= 0) & (column < self.nx) & (row >= 0) & (row < self.ny)
+        return np.where(inside, row * self.nx + column, -1).astype(np.int64)
+
+    def cell_centers(self, index) -> tuple:
+        """Returns the x and y of the centers of cells given by flat indices"""
+        row, column = np.divmod(np.asarray(index), self.nx)
+        return (
+            self.origin_x + (column + 0.5) * self.cell_size,
+            self.origin_y + (row + 0.5) * self.cell_size,
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "origin_x": self.origin_x,
+            "origin_y": self.origin_y,
+            "cell_size": self.cell_size,
+            "nx": self.nx,
+            "ny": self.ny,
+            "crs": self.crs,
+        }
+
+
+class HeatMap:
+    """
+    Per-cell route length, exposure and traversal counts of one grid, with one
+    layer of shape (groups, ny, nx) per quantity. A group is a combination of
+    time of day and route type. If a directory is given, the layers are
+    memory-mapped .npy files, so that large grids do not have to fit in memory
+    and can be opened with np.load(..., mmap_mode="r").
+    """
+
+    def __init__(self, grid: Grid, groups: list, directory=None) -> None:
+        """
+        :param grid: Grid of the heat map
+        :param groups: List of (time_of_day, type_route) tuples
+        :param directory: Directory for the layer files, in memory if None
+        """
+        self.grid = grid
+        self.groups = [tuple(group) for group in groups]
+        self.directory = None if directory is None else Path(directory)
+        shape = (len(self.groups), *grid.shape)
+        if self.directory is None:
+            self.layers = {
+                name: np.zeros(shape, dtype) for name, dtype in LAYERS.items()
+            }
+        else:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.layers = {
+                name: np.lib.format.open_memmap(
+                    self.directory / f"{name}.npy", "w+", dtype, shape
+                )
+                for name, dtype in LAYERS.items()
+            }
+            with open(self.directory / "grid.json", "w") as f:
+                json.dump({**grid.to_dict(), "groups": self.groups}, f, indent=2)
+
+    @classmethod
+    def open(cls, directory, mode: str = "r"):
+        """Opens the layers of a heat map written to a directory"""
+        directory = Path(directory)
+        with open(directory / "grid.json") as f:
+            meta = json.load(f)
+        heatmap = cls.__new__(cls)
+        heatmap.groups = [tuple(group) for group in meta.pop("groups")]
+        heatmap.grid = Grid(**meta)
+        heatmap.directory = directory
+        heatmap.layers = {
+            name: np.load(directory / f"{name}.npy", mmap_mode=mode) for name in LAYERS
+        }
+        return heatmap
+
+    def group_index(self, time_of_day, type_route) -> np.ndarray:
+        """Returns the group of each route, -1 for unknown combinations"""
+        lookup = {group: i for i, group in enumerate(self.groups)}
+        return np.array(
+            [lookup.get(key, -1) for key in zip(time_of_day, type_route)],
+            dtype=np.int64,
+        )
+
+    def add(self, engine: ExposureEngine, type_route: list) -> None:
+        """
+        Adds the segments of all routes of an engine (in the CRS of the grid).
+        Segments are split into pieces of at most half a cell, each of which
+        is assigned to the cell of its midpoint.
+        :param type_route: Route type of each route of the engine
+        """
+        lines = engine.lines
+        groups = self.group_index(engine.time_of_day, type_route)
+
+        # Start vertex of every segment within a line
+        start = np.delete(np.arange(len(lines.vertices) - 1), lines.offsets[1:-1] - 1)
+        deltas = lines.vertices[start + 1, :2] - lines.vertices[start, :2]
+        lengths = np.hypot(deltas[:, 0], deltas[:, 1])
+        values = engine.segment_values()
+
+        n_pieces = np.maximum(np.ceil(lengths / (self.grid.cell_size / 2)), 1)
+        n_pieces = n_pieces.astype(np.int64)
+        segment = np.repeat(np.arange(len(start)), n_pieces)
+        first_piece = np.cumsum(n_pieces) - n_pieces
+        t = (np.arange(n_pieces.sum()) - first_piece[segment] + 0.5) / n_pieces[segment]
+        x = lines.vertices[start[segment], 0] + t * deltas[segment, 0]
+        y = lines.vertices[start[segment], 1] + t * deltas[segment, 1]
+        cell = self.grid.cell_index(x, y)
+        line = lines.line_index()[segment]
+        group = groups[line]
+
+        keep = (cell >= 0) & (group >= 0)
+        cell, line, group, segment = cell[keep], line[keep], group[keep], segment[keep]
+        piece_length = (lengths / n_pieces)[segment]
+        piece_value = values[segment]
+        covered = ~np.isnan(piece_value)
+
+        n_cells = self.grid.nx * self.grid.ny
+        key = group * n_cells + cell
+        self._accumulate("length", key, piece_length)
+        self._accumulate("covered_length", key[covered], piece_length[covered])
+        self._accumulate(
+            "exposure_sum", key[covered], (piece_value * piece_length)[covered]
+        )
+        # A route is counted once per cell, however often it enters it
+        route_cell = np.unique(line * n_cells + cell)
+        self._accumulate(
+            "count", groups[route_cell // n_cells] * n_cells + route_cell % n_cells
+        )
+
+    def _accumulate(self, layer: str, key, weights=None) -> None:
+        """Adds the summed weights (or counts) per flat key to a layer"""
+        target = self.layers[layer].reshape(-1)
+        unique, inverse = np.unique(key, return_inverse=True)
+        sums = np.bincount(inverse, weights, len(unique))
+        target[unique] += sums.astype(target.dtype)
+
+    def mean_exposure(self) -> np.ndarray:
+        """Returns the distance-weighted mean value per cell, NaN for empty cells"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.layers["exposure_sum"] / self.layers["covered_length"]
+
+    def flush(self) -> None:
+        for layer in self.layers.values():
+            if isinstance(layer, np.memmap):
+                layer.flush()
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Returns one row per group and traversed cell with the cell center, the
+        number of routes, their length and mean exposure in the cell.
+        """
+        count = self.layers["count"].reshape(len(self.groups), -1)
+        group, cell = np.nonzero(count)
+        x, y = self.grid.cell_centers(cell)
+        n_cells = count.shape[1]
+        flat = group * n_cells + cell
+        covered = self.layers["covered_length"].reshape(-1)[flat]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            exposure = self.layers["exposure_sum"].reshape(-1)[flat] / covered
+        return pd.DataFrame(
+            {
+                "time_of_day": [self.groups[g][0] for g in group],
+                "type_route": [self.groups[g][1] for g in group],
+                "cell": cell,
+                "x": x,
+                "y": y,
+                "count": count[group, cell],
+                "length": self.layers["length"].reshape(-1)[flat],
+                "exposure": exposure,
+            }
+        )
+
+
+def build_heatmap(
+    store: RouteStore,
+    cell_size: float = 100.0,
+    directory=None,
+    batch_size: int = 1000,
+    criterion: str = "csv",
+) -> HeatMap:
+    """
+    Aggregates all routes of a route store on a grid covering them, in
+    batches of routes.
+    :param cell_size: Width of a cell in metres
+    :param directory: Directory for memory-mapped layers, in memory if None
+    :param batch_size: Number of routes reprojected and binned at once
+    :param criterion: ORS extra of the values, e.g. 'csv'
+    """
+    times = store.table.column("time_of_day").to_pylist()
+    types = store.table.column("type_route").to_pylist()
+    groups = [(t, r) for t in dict.fromkeys(times) for r in dict.fromkeys(types)]
+    heatmap = HeatMap(Grid.from_store(store, cell_size), groups, directory)
+
+    for start in range(0, len(store), batch_size):
+        stop = min(start + batch_size, len(store))
+        engine = ExposureEngine.from_store(
+            store, criterion, heatmap.grid.crs, start, stop
+        )
+        heatmap.add(engine, types[start:stop])
+    heatmap.flush()
+    return heatmap
+
+
+def write_heatmap(
+    filepaths: FilePaths, filepaths_res: ResultPaths, cell_size: float = 100.0
+) -> HeatMap:
+    """
+    Builds the heat map of the route store in the heatmap directory and lists
+    the traversed cells in heatmap/cells.parquet.
+    """
+    heatmap = build_heatmap(
+        RouteStore(filepaths.ROUTE_STORE_FILE), cell_size, filepaths_res.HEATMAP_DIR
+    )
+    heatmap.to_frame().to_parquet(filepaths_res.HEATMAP_DIR / "cells.parquet")
+    return heatmap
+
+
+if __name__ == "__main__":
+    # Set up logging
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    logging.info("Starting heat map aggregation...")
+
+    # Get command line arguments
+    parser = argparse.ArgumentParser(description="Aggregate exposure on a grid.")
+    parser.add_argument("--config", type=str, required=True, help="Config file as YAML")
+    parser.add_argument("--cell-size", type=float, help="Cell width (m)")
+    args = parser.parse_args()
+
+    # Load configuration
+    config = load_config(args.config)
+    logging.info(f"Successfully read config file: {args.config}")
+
+    filepaths = FilePaths(config["output_dir"], config["run_name"])
+    filepaths_res = ResultPaths(config["output_dir_metrics"], config["run_name"])
+    filepaths_res.create_dirs()
+
+    cell_size = args.cell_size or config.get("heatmap_cell_size_m", 100)
+    heatmap = write_heatmap(filepaths, filepaths_res, cell_size)
+
+    logging.info(
+        f"Successfully aggregated the routes on a {heatmap.grid.nx} x "
+        f"{heatmap.grid.ny} grid of {cell_size} m cells"
+    )
@@ -1,54 +1,85 @@
-import math
+import numpy as np
+
+
+def _as_vertex_array(coordinates) -> np.ndarray:
+    """Returns coordinates as a (N, 3) float64 array."""
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    if coordinates.ndim != 2 or coordinates.shape[1] != 3:
+        raise ValueError("Coordinates must be 3D points [(x, y, z), ...].")
+    return coordinates
 
 
 class Line:
+    __slots__ = ("_coordinates", "name")
+
     def __init__(self, coordinates, name=None):
         """
         Initialize the Line with a list of 3D points [(x, y, z), ...]
+        The points are stored as a (N, 3) float64 array.
         """
         if len(coordinates) < 2:
             raise ValueError("Line must contain at least two points.")
         self.coordinates = coordinates
         self.name = name
 
-    def get_segment_slopes(self) -> list:
+    @property
+    def coordinates(self) -> np.ndarray:
         """
-        Returns a list of slopes for each segment of the line.
-        If a segment is vertical in x/y (i.e. dx and dy are 0), returns float('inf').
+        Returns the coordinates of the line as a (N, 3) array.
         """
-        slopes = []
-        for i in range(len(self.coordinates) - 1):
-            x1, y1, z1 = self.coordinates[i]
-            x2, y2, z2 = self.coordinates[i + 1]
+        return self._coordinates
 
-            dx = x2 - x1
-            dy = y2 - y1
-            horizontal_distance = math.hypot(dx, dy)
+    @coordinates.setter
+    def coordinates(self, coordinates):
+        self._coordinates = _as_vertex_array(coordinates)
 
-            if horizontal_distance == 0:
-                slopes.append(float("inf"))  # vertical in x/y, undefined slope
-            else:
-                dz = z2 - z1
-                slopes.append(dz / horizontal_distance)
+    def _deltas(self) -> np.ndarray:
+        """Returns the (dx, dy, dz) of each segment."""
+        return np.diff(self.coordinates, axis=0)
+
+    def get_segment_slopes(self) -> np.ndarray:
+        """
+        Returns the slopes (dz / horizontal distance) of each segment of the line.
+        If a segment is vertical in x/y (i.e. dx and dy are 0), returns float('inf').
+        """
+        deltas = self._deltas()
+        horizontal = np.hypot(deltas[:, 0], deltas[:, 1])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slopes = deltas[:, 2] / horizontal
+        slopes[horizontal == 0] = np.inf  # vertical in x/y, undefined slope
         return slopes
 
+    def segment_lengths(self) -> np.ndarray:
+        """
+        Returns the 3D length of each segment.
+        """
+        return np.linalg.norm(self._deltas(), axis=1)
+
     def length(self) -> float:
         """
         Returns the length of the line.
         """
-        total = 0.0
-        for i in range(len(self.coordinates) - 1):
-            x1, y1, z1 = self.coordinates[i]
-            x2, y2, z2 = self.coordinates[i + 1]
-            segment = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2 + (z2 - z1) ** 2)
-            total += segment
-        return total
+        return float(self.segment_lengths().sum())
+
+    def cumulative_distance(self) -> np.ndarray:
+        """
+        Returns the distance along the line at each vertex, starting at 0.
+        """
+        return np.concatenate([[0.0], np.cumsum(self.segment_lengths())])
 
-    def coordinates(self) -> list:
+    def ascent(self) -> float:
         """
-        Returns the coordinates of the line.
+        Returns the total ascent (sum of positive elevation changes).
         """
-        return self.coordinates.copy()
+        dz = self._deltas()[:, 2]
+        return float(dz[dz > 0].sum())
+
+    def descent(self) -> float:
+        """
+        Returns the total descent (sum of negative elevation changes) as a positive value.
+        """
+        dz = self._deltas()[:, 2]
+        return float(-dz[dz < 0].sum())
 
     def move(self, dx, dy, dz):
         """
@@ -57,4 +88,140 @@ class Line:
         :param dy: value by which to move the line in y direction
         :param dz: value by which to move the line in z direction
         """
-        self.coordinates = [(x + dx, y + dy, z + dz) for (x, y, z) in self.coordinates]
+        # A new array: the coordinates may be a view of the caller's array,
+        # of a LineCollection or of a read-only memory-mapped route store
+        self.coordinates = self.coordinates + (dx, dy, dz)
+
+
+class LineCollection:
+    """
+    Ragged collection of lines stored as one flat (M, 3) vertex array and
+    offsets, so that metrics of thousands of lines are computed in one call.
+    The vertices of line k are vertices[offsets[k]:offsets[k + 1]].
+    """
+
+    __slots__ = ("vertices", "offsets", "names")
+
+    def __init__(self, vertices, offsets, names=None):
+        """
+        :param vertices: (M, 3) array of all vertices
+        :param offsets: (K + 1,) array of start indices of the K lines and M
+        :param names: Optional list of K line names
+        """
+        self.vertices = _as_vertex_array(vertices)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if self.offsets[0] != 0 or self.offsets[-1] != len(self.vertices):
+            raise ValueError(
+                "Offsets must start at 0 and end at the number of vertices."
+            )
+        if np.any(np.diff(self.offsets) < 2):
+            raise ValueError("Line must contain at least two points.")
+        self.names = names
+
+    @classmethod
+    def from_lines(cls, lines):
+        """
+        Creates a collection from Line objects (e.g. Routes).
+        """
+        arrays = [line.coordinates for line in lines]
+        offsets = np.concatenate([[0], np.cumsum([len(a) for a in arrays])])
+        names = [line.name for line in lines]
+        return cls(np.concatenate(arrays), offsets, names)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, k) -> Line:
+        name = None if self.names is None else self.names[k]
+        return Line(self.vertices[self.offsets[k] : self.offsets[k + 1]], name)
+
+    def counts(self) -> np.ndarray:
+        """
+        Returns the number of vertices of each line.
+        """
+        return np.diff(self.offsets)
+
+    def line_index(self) -> np.ndarray:
+        """
+        Returns the index of the line each segment belongs to.
+        """
+        return np.repeat(np.arange(len(self)), self.counts() - 1)
+
+    def _segments(self):
+        """
+        Returns the (dx, dy, dz) of all segments within lines and the index of
+        the line each segment belongs to.
+        """
+        deltas = np.diff(self.vertices, axis=0)
+        # Drop the segments connecting the last vertex of a line to the next line
+        within = np.ones(len(deltas), dtype=bool)
+        within[self.offsets[1:-1] - 1] = False
+        return deltas[within], self.line_index()
+
+    def _sum_per_line(self, values, line_index) -> np.ndarray:
+        return np.bincount(line_index, weights=values, minlength=len(self))
+
+    def segment_lengths(self, horizontal: bool = False) -> np.ndarray:
+        """
+        Returns the 3D length of all segments (line after line).
+        :param horizontal: Return the length in x/y only
+        """
+        deltas, _ = self._segments()
+        if horizontal:
+            return np.hypot(deltas[:, 0], deltas[:, 1])
+        return np.linalg.norm(deltas, axis=1)
+
+    def segment_slopes(self) -> np.ndarray:
+        """
+        Returns the slopes of all segments (line after line), inf for segments
+        that are vertical in x/y.
+        """
+        deltas, _ = self._segments()
+        horizontal = np.hypot(deltas[:, 0], deltas[:, 1])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slopes = deltas[:, 2] / horizontal
+        slopes[horizontal == 0] = np.inf
+        return slopes
+
+    def lengths(self) -> np.ndarray:
+        """
+        Returns the length of each line.
+        """
+        deltas, line_index = self._segments()
+        return self._sum_per_line(np.linalg.norm(deltas, axis=1), line_index)
+
+    def cumulative_distance(self) -> np.ndarray:
+        """
+        Returns the distance along its line at each vertex, starting at 0 for
+        the first vertex of every line.
+        """
+        return self.cumulative_sum(self.segment_lengths())
+
+    def cumulative_sum(self, segment_values) -> np.ndarray:
+        """
+        Returns the sum of a per-segment value (e.g. length) along its line at
+        each vertex, starting at 0 for the first vertex of every line.
+        :param segment_values: Array with one value per segment (line after line)
+        """
+        # Sum over all segments of all lines; vertex v of line k is reached
+        # after v - k segments, of which the first offsets[k] - k belong to
+        # the previous lines
+        total = np.concatenate([[0.0], np.cumsum(segment_values)])
+        line_index = np.repeat(np.arange(len(self)), self.counts())
+        reached = total[np.arange(len(self.vertices)) - line_index]
+        start = total[self.offsets[:-1] - np.arange(len(self))]
+        return reached - start[line_index]
+
+    def ascent(self) -> np.ndarray:
+        """
+        Returns the total ascent of each line.
+        """
+        deltas, line_index = self._segments()
+        return self._sum_per_line(np.clip(deltas[:, 2], 0, None), line_index)
+
+    def descent(self) -> np.ndarray:
+        """
+        Returns the total descent of each line as positive values.
+        """
+        deltas, line_index = self._segments()
+        return self._sum_per_line(-np.clip(deltas[:, 2], None, 0), line_index)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tables derived from the partitioned metrics, for notebooks and dashboards"""
+
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from scripts.cache import file_state
+from scripts.route import route_ids
+
+# Per-route metrics compared between the shortest and the recommended route
+PAIR_METRICS = ["length", "s_exp"]
+
+QUANTILES = {"p25": 0.25, "p50": 0.5, "p75": 0.75}
+
+VIEW_FILES = ["pairs.parquet", "distributions.parquet"]
+
+PARTITION_KEYS = ["time_of_day", "type_route"]
+
+
+def read_dataset(dataset_dir) -> pd.DataFrame:
+    """
+    Reads a dataset partitioned by time_of_day and type_route (see
+    route_metrics) in source order, with the partition keys as categorical
+    columns. The partitions are read one by one, so that partitions whose
+    columns got different types are concatenated.
+    """
+    dataset_dir = Path(dataset_dir)
+    frames = []
+    for part_file in sorted(dataset_dir.glob("time_of_day=*/type_route=*/*.parquet")):
+        df = pd.read_parquet(part_file)
+        for part in part_file.parent.relative_to(dataset_dir).parts:
+            key, value = part.split("=", 1)
+            df[key] = value
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=["source"] + PARTITION_KEYS)
+    df = pd.concat(frames).sort_values("source", kind="stable")
+    for key in PARTITION_KEYS:
+        df[key] = df[key].astype("category")
+    return df
+
+
+def read_rows(results_dir) -> pd.DataFrame:
+    """
+    Returns all summary rows of a results directory in source order, as
+    formerly stored in all.parquet: the metrics dataset without the keys.
+    Results of older versions are read from their all.parquet.
+    """
+    results_dir = Path(results_dir)
+    if not (results_dir / "metrics").is_dir():
+        return pd.read_parquet(results_dir / "all.parquet")
+    df_rows = read_dataset(results_dir / "metrics")
+    return df_rows.drop(columns=["route_id"] + PARTITION_KEYS, errors="ignore")
+
+
+def read_routes(results_dir) -> pd.DataFrame:
+    """
+    Returns the per-route table of a results directory in source order:
+    source, route_id, time_of_day, type_route, length, s_exp and n_segments.
+    Results of older versions are read from their routes.parquet, or built
+    from their all.parquet (see routes_from_rows).
+    """
+    results_dir = Path(results_dir)
+    if not (results_dir / "routes").is_dir():
+        if (results_dir / "routes.parquet").exists():
+            return pd.read_parquet(results_dir / "routes.parquet")
+        return routes_from_rows(pd.read_parquet(results_dir / "all.parquet"))
+    df_routes = read_dataset(results_dir / "routes").reset_index(drop=True)
+    keys = ["source", "route_id"] + PARTITION_KEYS
+    return df_routes[keys + [c for c in df_routes.columns if c not in keys]]
+
+
+def routes_from_rows(df_rows: pd.DataFrame) -> pd.DataFrame:
+    """
+    Builds the per-route table from the summary rows of all.parquet, for
+    results written before the per-route table existed: length is the sum of the
+    summary distances of a route, the keys are taken from its source name.
+    n_segments is not stored in all.parquet and left out.
+    :param df_rows: Summary rows with source, distance and s_exp
+    """
+    grouped = df_rows.groupby("source", sort=False)
+    df_routes = pd.DataFrame(
+        {"length": grouped["distance"].sum(), "s_exp": grouped["s_exp"].first()}
+    ).reset_index()
+    # route_<id>_<time of day>_<type>, see Route.extract_metadata
+    keys = df_routes["source"].str.split("_", expand=True)
+    df_routes.insert(1, "route_id", route_ids(keys[1]))
+    df_routes.insert(2, "time_of_day", pd.Categorical(keys[2]))
+    df_routes.insert(3, "type_route", pd.Categorical(keys[3]))
+    return df_routes
+
+
+def route_pairs(df_routes: pd.DataFrame) -> pd.DataFrame:
+    """
+    Joins the shortest and the recommended route of every OD pair and time of
+    day: one row per pair with the length and s_exp of both routes and their
+    difference (recommended - shortest).
+    :param df_routes: Per-route table, see read_routes
+    """
+    keys = ["route_id", "time_of_day"]
+    columns = keys + PAIR_METRICS
+    shortest = df_routes.loc[df_routes["type_route"] == "shortest", columns]
+    recommended = df_routes.loc[df_routes["type_route"] == "recommended", columns]
+    pairs = shortest.merge(recommended, on=keys, suffixes=("_shortest", "_recommended"))
+    for metric in PAIR_METRICS:
+        pairs[f"{metric}_diff"] = (
+            pairs[f"{metric}_recommended"] - pairs[f"{metric}_shortest"]
+        )
+    return pairs.sort_values(keys, ignore_index=True)
+
+
+def distributions(df_routes: pd.DataFrame, pairs: pd.DataFrame) -> pd.DataFrame:
+    """
+    Count, mean, std, min, quartiles and max of length and s_exp per time of
+    day and route type, and of their pair differences (type_route 'pair',
+    metrics length_diff and s_exp_diff).
+    """
+    ids = ["time_of_day", "type_route"]
+    values = pd.concat(
+        [
+            df_routes.melt(id_vars=ids, value_vars=PAIR_METRICS, var_name="metric"),
+            pairs.assign(type_route="pair").melt(
+                id_vars=ids,
+                value_vars=[f"{metric}_diff" for metric in PAIR_METRICS],
+                var_name="metric",
+            ),
+        ],
+        ignore_index=True,
+    )
+    values[ids] = values[ids].astype(str)
+    grouped = values.groupby(ids + ["metric"])["value"]
+    stats = grouped.agg(["count", "mean", "std", "min", "max"])
+    quantiles = grouped.quantile(list(QUANTILES.values())).unstack()
+    quantiles.columns = list(QUANTILES)
+    return stats.join(quantiles).reset_index()
+
+
+def _write_parquet(df: pd.DataFrame, path: Path, index: bool = False) -> None:
+    tmp_path = path.with_name(path.name + ".part")
+    df.to_parquet(tmp_path, index=index)
+    os.replace(tmp_path, path)
+
+
+def _input_files(results_dir: Path) -> list:
+    """Files the per-route table is read from, see read_routes"""
+    if (results_dir / "routes").is_dir():
+        return sorted((results_dir / "routes").glob("time_of_day=*/type_route=*/*"))
+    if (results_dir / "routes.parquet").exists():
+        return [results_dir / "routes.parquet"]
+    return [results_dir / "all.parquet"]
+
+
+def write_views(results_dir: Path) -> bool:
+    """
+    Writes the comparison views of the per-route table (see read_routes) to
+    results_dir/views:
+    - pairs.parquet: see route_pairs
+    - distributions.parquet: see distributions
+    The views are only rebuilt if the content of a partition of the per-route
+    table changed since they were written; their states are kept in
+    views/views.json.
+    :return: True if the views were rebuilt
+    """
+    results_dir = Path(results_dir)
+    views_dir = results_dir / "views"
+    state_file = views_dir / "views.json"
+
+    previous = {}
+    if state_file.exists():
+        with open(state_file) as src:
+            previous = json.load(src)
+    # Files are keyed by their path in results_dir, older versions kept the
+    # state of routes.parquet only
+    previous = {k: v for k, v in previous.items() if isinstance(v, dict)}
+    state = {}
+    for path in _input_files(results_dir):
+        name = path.relative_to(results_dir).as_posix()
+        state[name] = file_state(path, previous.get(name))
+    unchanged = {k: v["sha256"] for k, v in state.items()} == {
+        k: v["sha256"] for k, v in previous.items()
+    }
+    if unchanged and all((views_dir / name).exists() for name in VIEW_FILES):
+        return False
+
+    views_dir.mkdir(exist_ok=True)
+    df_routes = read_routes(results_dir)
+    pairs = route_pairs(df_routes)
+    _write_parquet(pairs, views_dir / "pairs.parquet")
+    _write_parquet(distributions(df_routes, pairs), views_dir / "distributions.parquet")
+
+    tmp_path = state_file.with_name(state_file.name + ".part")
+    with open(tmp_path, "w") as dst:
+        json.dump(state, dst, indent=1, sort_keys=True)
+    os.replace(tmp_path, state_file)
+    return True
+
+
+def export_tables(results_dir: Path) -> None:
+    """
+    Writes all summary rows and the per-route table of a results directory
+    to single files, all.parquet and routes.parquet, e.g. for tools that do
+    not read partitioned datasets. The files are not updated by later runs.
+    """
+    results_dir = Path(results_dir)
+    _write_parquet(read_rows(results_dir), results_dir / "all.parquet", index=True)
+    _write_parquet(read_routes(results_dir), results_dir / "routes.parquet")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(
+        description="Write the comparison views of a metrics results directory."
+    )
+    parser.add_argument(
+        "results_dir", type=str, help="CSV results directory of a metrics run"
+    )
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="Also write all summary rows and the per-route table to "
+        "all.parquet and routes.parquet",
+    )
+    args = parser.parse_args()
+
+    if write_views(Path(args.results_dir)):
+        logging.info(f"Successfully wrote the views in {args.results_dir}/views")
+    else:
+        logging.info("The views are up to date")
+    if args.export:
+        export_tables(Path(args.results_dir))
+        logging.info(f"Successfully exported the tables in {args.results_dir}")
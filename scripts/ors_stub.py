@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Local stub of the ORS directions endpoint for offline tests and throughput runs"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scripts.polyline import encode_deltas, quantize
+
+
+def synthetic_route(
+    start, end, n_vertices: int = 50, n_segments: int = 5, seed=None
+) -> dict:
+    """
+    Creates an ORS-shaped GeoJSON response between two [lon, lat] points.
+    :param start: [lon, lat] of the origin
+    :param end: [lon, lat] of the destination
+    :param n_vertices: Number of vertices of the route
+    :param n_segments: Number of value runs in the csv extras
+    :param seed: Seed for the jitter, elevations and csv values
+    :return: FeatureCollection as dict
+    """
+    rng = random.Random(seed)
+    n_vertices = max(2, n_vertices)
+    n_segments = max(1, min(n_segments, n_vertices - 1))
+
+    coordinates = []
+    for k in range(n_vertices):
+        t = k / (n_vertices - 1)
+        jitter = 0.0 if k in (0, n_vertices - 1) else rng.uniform(-1e-4, 1e-4)
+        coordinates.append(
+            [
+                round(start[0] + t * (end[0] - start[0]) + jitter, 6),
+                round(start[1] + t * (end[1] - start[1]) + jitter, 6),
+                round(110 + 10 * math.sin(6 * t) + rng.uniform(-1, 1), 1),
+            ]
+        )
+
+    # Split the vertices into value runs [start_idx, end_idx, value]
+    cuts = sorted(rng.sample(range(1, n_vertices - 1), n_segments - 1))
+    bounds = [0] + cuts + [n_vertices - 1]
+    values = [
+        [bounds[k], bounds[k + 1], rng.randint(0, 100)] for k in range(n_segments)
+    ]
+
+    def distance(i, j):
+        lon1, lat1 = coordinates[i][:2]
+        lon2, lat2 = coordinates[j][:2]
+        dx = (lon2 - lon1) * 111320 * math.cos(math.radians(lat1))
+        dy = (lat2 - lat1) * 110540
+        return math.hypot(dx, dy)
+
+    per_value = {}
+    for a, b, value in values:
+        d = sum(distance(k, k + 1) for k in range(a, b))
+        per_value[value] = per_value.get(value, 0.0) + d
+    total = sum(per_value.values()) or 1.0
+    summary = [
+        {"value": v, "distance": round(d, 1), "amount": round(100 * d / total, 2)}
+        for v, d in sorted(per_value.items(), key=lambda item: -item[1])
+    ]
+
+    return {
+        "type": "FeatureCollection",
+        "bbox": [
+            min(c[0] for c in coordinates),
+            min(c[1] for c in coordinates),
+            max(c[0] for c in coordinates),
+            max(c[1] for c in coordinates),
+        ],
+        "features": [
+            {
+                "type": "Feature",
+                "bbox": [],
+                "properties": {
+                    "summary": {"distance": round(total, 1), "duration": total / 1.4},
+                    "way_points": [0, n_vertices - 1],
+                    "extras": {"csv": {"values": values, "summary": summary}},
+                },
+                "geometry": {"type": "LineString", "coordinates": coordinates},
+            }
+        ],
+        "metadata": {"service": "routing", "engine": {"version": "stub"}},
+    }
+
+
+def as_json_format(response: dict) -> dict:
+    """
+    Converts a synthetic GeoJSON response to the ORS JSON format, with the
+    geometry as encoded polyline including elevation.
+    """
+    feature = response["features"][0]
+    coordinates = feature["geometry"]["coordinates"]
+    return {
+        "bbox": response["bbox"],
+        "routes": [
+            {
+                **feature["properties"],
+                "bbox": response["bbox"],
+                "geometry": encode_deltas(quantize(coordinates)),
+            }
+        ],
+        "metadata": response["metadata"],
+    }
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        n = stub.record(self.path)
+        if stub.latency:
+            time.sleep(stub.latency)
+        if n <= stub.fail_first:
+            data = json.dumps({"error": {"code": 2099, "message": "stub"}}).encode()
+            self.send_response(stub.fail_status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        payload = json.loads(body or b"{}")
+        start, end = payload.get("coordinates", [[8.68, 49.40], [8.70, 49.41]])
+        if payload.get("preference") in stub.static_preferences:
+            # Same response for every csv_column
+            payload.get("options", {}).pop("profile_params", None)
+        seed = json.dumps(payload, sort_keys=True)
+        response = synthetic_route(
+            start,
+            end,
+            n_vertices=stub.n_vertices,
+            n_segments=stub.n_segments,
+            seed=seed,
+        )
+        if self.path.rstrip("/").endswith("/json"):
+            response = as_json_format(response)
+        data = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/geo+json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubORSServer:
+    """
+    Threaded HTTP server answering directions requests with synthetic routes.
+    Usable as a context manager; records the time of every request.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        n_vertices: int = 50,
+        n_segments: int = 5,
+        fail_first: int = 0,
+        fail_status: int = 500,
+        static_preferences=(),
+    ) -> None:
+        """
+        :param host: Interface to bind
+        :param port: Port to bind, 0 picks a free port
+        :param latency: Artificial delay per request in seconds
+        :param n_vertices: Number of vertices per synthetic route
+        :param n_segments: Number of csv value runs per synthetic route
+        :param fail_first: Number of requests answered with an error first
+        :param fail_status: HTTP status of these errors
+        :param static_preferences: Preferences whose response does not depend
+        on the weightings (csv_column), unlike real ORS responses
+        """
+        self.latency = latency
+        self.n_vertices = n_vertices
+        self.n_segments = n_segments
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.static_preferences = tuple(static_preferences)
+        self.request_times = []
+        self.paths = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _StubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Base URL to be used as `ors_url` in the config"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    @property
+    def request_count(self) -> int:
+        return len(self.request_times)
+
+    def record(self, path: str) -> int:
+        """Records a request and returns the number of requests so far"""
+        with self._lock:
+            self.request_times.append(time.monotonic())
+            self.paths.append(path)
+            return len(self.request_times)
+
+    def throughput(self) -> float:
+        """Requests per second between the first and the last request"""
+        if self.request_count < 2:
+            return 0.0
+        elapsed = self.request_times[-1] - self.request_times[0]
+        return (self.request_count - 1) / elapsed if elapsed > 0 else float("inf")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stub ORS server.")
+    parser.add_argument("--port", type=int, default=8080, help="Port to bind")
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Delay per request in seconds"
+    )
+    args = parser.parse_args()
+
+    stub = StubORSServer(port=args.port, latency=args.latency)
+    print(f"Stub ORS server listening on {stub.url}")
+    try:
+        stub._server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Served {stub.request_count} requests ({stub.throughput():.1f} req/s)")
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Streaming parquet output with bounded memory"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Rows per parquet row group: large enough for efficient scans, small enough
+# that min/max statistics let readers skip groups when filtering
+ROW_GROUP_SIZE = 64 * 1024
+
+
+class ParquetStream:
+    """
+    Writes dataframes to a parquet file in row groups of a fixed size. Rows
+    are copied into preallocated column arrays of one row group, so memory use
+    does not depend on the number of rows written. The schema (including
+    categorical and index columns) is taken from the first non-empty frame.
+    Numeric columns are widened if a later frame needs it, e.g. an integer
+    column that is NaN-filled (float) in a later batch.
+    """
+
+    def __init__(
+        self, path, row_group_size: int = ROW_GROUP_SIZE, preserve_index: bool = True
+    ) -> None:
+        """
+        :param path: Output file
+        :param row_group_size: Rows per row group
+        :param preserve_index: Store the dataframe index, as DataFrame.to_parquet
+        """
+        self.path = Path(path)
+        self.row_group_size = row_group_size
+        self.preserve_index = preserve_index
+        self.rows_written = 0
+        self._schema = None
+        self._writer = None
+        self._buffers = None
+        self._index = None
+        self._n = 0
+        self._template = None
+
+    def _open(self, df: pd.DataFrame) -> None:
+        self._schema = pa.Schema.from_pandas(df, preserve_index=self.preserve_index)
+        self._writer = pq.ParquetWriter(self.path, self._schema)
+        self._buffers = {
+            column: np.empty(self.row_group_size, dtype=_buffer_dtype(df[column]))
+            for column in df.columns
+        }
+        if self.preserve_index:
+            self._index = np.empty(self.row_group_size, dtype=df.index.dtype)
+
+    def write(self, df: pd.DataFrame) -> None:
+        """Appends the rows of a dataframe"""
+        if len(df) == 0:
+            self._template = df
+            return
+        if self._writer is None:
+            self._open(df)
+        columns = {c: df[c].to_numpy() for c in self._buffers}
+        widened = {
+            column: _widened_dtype(column, self._buffers[column].dtype, values.dtype)
+            for column, values in columns.items()
+            if not np.can_cast(values.dtype, self._buffers[column].dtype, "same_kind")
+        }
+        if widened:
+            self._widen(widened)
+        index = df.index.to_numpy()
+
+        position = 0
+        while position < len(df):
+            n = min(self.row_group_size - self._n, len(df) - position)
+            rows = slice(position, position + n)
+            for column, values in columns.items():
+                self._buffers[column][self._n : self._n + n] = values[rows]
+            if self.preserve_index:
+                self._index[self._n : self._n + n] = index[rows]
+            self._n += n
+            position += n
+            if self._n == self.row_group_size:
+                self._flush()
+
+    def _widen(self, dtypes: dict) -> None:
+        """
+        Widens the buffers and the schema of columns to new dtypes. Row groups
+        that were already written are rewritten one at a time with the new
+        schema, as the schema of a parquet file is fixed.
+        """
+        for column, dtype in dtypes.items():
+            i = self._schema.get_field_index(column)
+            field = self._schema.field(i).with_type(pa.from_numpy_dtype(dtype))
+            self._schema = self._schema.set(i, field)
+            buffer = np.empty(self.row_group_size, dtype=dtype)
+            buffer[: self._n] = self._buffers[column][: self._n]
+            self._buffers[column] = buffer
+
+        self._writer.close()
+        old_path = self.path.with_name(self.path.name + ".old")
+        os.replace(self.path, old_path)
+        self._writer = pq.ParquetWriter(self.path, self._schema)
+        written = pq.ParquetFile(old_path)
+        for k in range(written.num_row_groups):
+            table = written.read_row_group(k).cast(self._schema)
+            self._writer.write_table(table, row_group_size=self.row_group_size)
+        old_path.unlink()
+
+    def _flush(self) -> None:
+        if self._n == 0:
+            return
+        df = pd.DataFrame(
+            {c: b[: self._n] for c, b in self._buffers.items()},
+            index=self._index[: self._n] if self.preserve_index else None,
+        )
+        table = pa.Table.from_pandas(
+            df, schema=self._schema, preserve_index=self.preserve_index
+        )
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        self.rows_written += self._n
+        self._n = 0
+
+    def close(self) -> int:
+        """
+        Writes the last row group and closes the file. If only empty frames
+        were written, the file is written from the last of them.
+        :return: Number of rows written
+        """
+        if self._writer is None:
+            if self._template is not None:
+                self._template.to_parquet(self.path, index=self.preserve_index)
+            return 0
+        self._flush()
+        self._writer.close()
+        return self.rows_written
+
+
+def _widened_dtype(column: str, dtype: np.dtype, new_dtype: np.dtype) -> np.dtype:
+    """
+    Returns the dtype holding the values of both dtypes, e.g. float64 for
+    int64 and float64. Only numeric columns are widened.
+    """
+    if dtype.kind in "biuf" and new_dtype.kind in "biuf":
+        return np.result_type(dtype, new_dtype)
+    raise TypeError(
+        f"Column {column} of type {new_dtype} cannot be written "
+        f"to a column of type {dtype}."
+    )
+
+
+def _buffer_dtype(series: pd.Series) -> np.dtype:
+    """Numeric columns are buffered as they are, all others as objects"""
+    if isinstance(series.dtype, np.dtype) and series.dtype.kind in "biufM":
+        return series.dtype
+    return np.dtype(object)
+
+
+class SortedMerge:
+    """
+    Merges new rows into a parquet file that is sorted by a key column,
+    streaming both: the existing file is read one row group at a time and new
+    rows are pushed in ascending key order. Rows whose key is in `replaced` are
+    dropped from the existing file. The result replaces the file on close.
+    """
+
+    def __init__(
+        self, path, replaced=(), key: str = "source", preserve_index: bool = True
+    ) -> None:
+        """
+        :param path: Parquet file, which does not need to exist yet
+        :param replaced: Keys whose existing rows are dropped
+        :param key: Column both inputs are sorted by. New keys must not occur
+        in the existing rows that are kept.
+        """
+        self.path = Path(path)
+        self.replaced = set(replaced)
+        self.key = key
+        self._tmp_path = self.path.with_name(self.path.name + ".part")
+        self._stream = ParquetStream(self._tmp_path, preserve_index=preserve_index)
+        self._existing = self._read_existing()
+        self._pending = None
+
+    def _read_existing(self):
+        if not self.path.exists():
+            return
+        parquet_file = pq.ParquetFile(self.path)
+        for i in range(parquet_file.num_row_groups):
+            df = parquet_file.read_row_group(i).to_pandas()
+            yield df[~df[self.key].isin(self.replaced)]
+
+    def _next_existing(self):
+        """Returns the remaining existing rows of the current row group"""
+        while self._pending is None or len(self._pending) == 0:
+            self._pending = next(self._existing, None)
+            if self._pending is None:
+                return None
+        return self._pending
+
+    def push(self, df: pd.DataFrame) -> None:
+        """Writes new rows together with the existing rows sorting before them"""
+        if len(df) == 0:
+            self._stream.write(df)
+            return
+        last = df[self.key].iloc[-1]
+        frames = []
+        while (existing := self._next_existing()) is not None:
+            before = (existing[self.key] < last).to_numpy()
+            frames.append(existing[before])
+            self._pending = existing[~before]
+            if len(self._pending):
+                break
+        frames.append(df)
+        frames = [f for f in frames if len(f)]
+        merged = pd.concat(frames).sort_values(self.key, kind="stable")
+        # Categoricals with different categories are concatenated as strings
+        for column in df.columns:
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                merged[column] = merged[column].astype("category")
+        self._stream.write(merged)
+
+    def close(self) -> int:
+        """
+        Writes the remaining existing rows and replaces the file. The file is
+        removed if no rows are left.
+        :return: Number of rows
+        """
+        while (existing := self._next_existing()) is not None:
+            self._stream.write(existing)
+            self._pending = None
+        n_rows = self._stream.close()
+        if self._tmp_path.exists():
+            self._tmp_path.replace(self.path)
+        else:
+            self.path.unlink(missing_ok=True)
+        return n_rows
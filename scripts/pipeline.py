@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Stages of a run as a dependency graph, skipping stages whose inputs are unchanged"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+from scripts.filepaths import FilePaths, ResultPaths
+from scripts.telemetry import get_telemetry
+
+
+def path_state(path: Path):
+    """
+    Returns a cheap fingerprint of a file or of all files below a directory:
+    names, sizes and modification times. None if the path does not exist.
+    """
+    path = Path(path)
+    if path.is_file():
+        stat = path.stat()
+        return [stat.st_size, stat.st_mtime_ns]
+    if not path.is_dir():
+        return None
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            relative = os.path.relpath(os.path.join(root, name), path)
+            digest.update(f"{relative}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+class Stage:
+    """
+    A step of the pipeline. Its fingerprint is made of the config entries and
+    input files it depends on and of the outputs of its upstream stages.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run,
+        after=(),
+        config_keys=(),
+        inputs=None,
+        outputs=None,
+    ) -> None:
+        """
+        :param name: Name of the stage
+        :param run: Function called with the Pipeline
+        :param after: Names of the stages whose outputs this stage reads
+        :param config_keys: Config entries the outputs depend on
+        :param inputs: Function of the Pipeline returning input files that are
+        not produced by a stage, e.g. the area of interest
+        :param outputs: Function of the Pipeline returning the output paths
+        """
+        self.name = name
+        self.run = run
+        self.after = list(after)
+        self.config_keys = list(config_keys)
+        self.inputs = inputs or (lambda pipeline: [])
+        self.outputs = outputs or (lambda pipeline: [])
+
+
+# Stage functions import their modules when they run, so that e.g. a metrics
+# run does not import the GIS libraries needed to generate OD pairs
+
+
+def _routes(pipeline) -> None:
+    from scripts.generate_routes import generate_routes
+
+    # With a seed the OD pairs are the same, so finished requests are skipped
+    resume = pipeline.config.get("seed") is not None
+    failed = generate_routes(
+        pipeline.config,
+        pipeline.filepaths,
+        resume=resume,
+        rate_limiter=pipeline.rate_limiter,
+        circuit_breaker=pipeline.circuit_breaker,
+    )
+    if failed:
+        logging.warning(f"{len(failed)} requests failed, see --retry-failed")
+
+
+def _route_store(pipeline) -> None:
+    from scripts.route_store import ingest_routes
+
+    ingest_routes(pipeline.filepaths.ROUTES_DIR, pipeline.filepaths.ROUTE_STORE_FILE)
+
+
+def _metrics(pipeline) -> None:
+    from scripts.route_metrics import calculate_route_metrics
+
+    calculate_route_metrics(
+        pipeline.filepaths, pipeline.filepaths_res, workers=pipeline.workers
+    )
+
+
+def _exposure(pipeline) -> None:
+    from scripts.exposure import write_exposure
+
+    write_exposure(pipeline.filepaths, pipeline.filepaths_res)
+
+
+def _comparison(pipeline) -> None:
+    from scripts.comparison import write_comparison
+
+    write_comparison(
+        pipeline.filepaths,
+        pipeline.filepaths_res,
+        tolerance=pipeline.config.get("comparison_tolerance_m", 10.0),
+        workers=pipeline.workers,
+        frechet=pipeline.config.get("comparison_frechet", False),
+    )
+
+
+def _heatmap(pipeline) -> None:
+    from scripts.heatmap import write_heatmap
+
+    write_heatmap(
+        pipeline.filepaths,
+        pipeline.filepaths_res,
+        pipeline.config.get("heatmap_cell_size_m", 100),
+    )
+
+
+STAGES = [
+    Stage(
+        "routes",
+        _routes,
+        config_keys=[
+            "ors_url",
+            "input_gdf",
+            "random_points",
+            "seed",
+            "number_of_routes_per_time_of_day",
+            "od_batch_size",
+            "distance_bands_km",
+            "max_total_requests",
+            "times_of_day",
+            "compact_geometry",
+            "dedup_preferences",
+            "dedup_probes",
+        ],
+        inputs=lambda p: [Path(p.config["input_gdf"])],
+        outputs=lambda p: [p.filepaths.ROUTES_DIR],
+    ),
+    Stage(
+        "route_store",
+        _route_store,
+        after=["routes"],
+        outputs=lambda p: [p.filepaths.ROUTE_STORE_FILE],
+    ),
+    Stage(
+        "metrics",
+        _metrics,
+        after=["routes"],
+        outputs=lambda p: [
+            p.filepaths_res.CSV_RESULTS_DIR / "metrics",
+            p.filepaths_res.CSV_RESULTS_DIR / "routes",
+            p.filepaths_res.CSV_RESULTS_DIR / "views",
+        ],
+    ),
+    Stage(
+        "exposure",
+        _exposure,
+        after=["route_store"],
+        outputs=lambda p: [p.filepaths_res.CSV_RESULTS_DIR / "exposure.parquet"],
+    ),
+    Stage(
+        "comparison",
+        _comparison,
+        after=["route_store"],
+        config_keys=["comparison_tolerance_m", "comparison_frechet"],
+        outputs=lambda p: [p.filepaths_res.CSV_RESULTS_DIR / "comparison.parquet"],
+    ),
+    Stage(
+        "heatmap",
+        _heatmap,
+        after=["route_store"],
+        config_keys=["heatmap_cell_size_m"],
+        outputs=lambda p: [p.filepaths_res.HEATMAP_DIR],
+    ),
+]
+
+
+class Pipeline:
+    """
+    Runs stages of a run in dependency order. A stage is skipped if its
+    fingerprint and its outputs are the same as after its last run; the
+    state is kept in 02_interim/pipeline_state.json.
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        stages: list = None,
+        workers: int = 1,
+        rate_limiter=None,
+        circuit_breaker=None,
+    ) -> None:
+        """
+        :param config: Loaded config.yml
+        :param stages: List of Stage, STAGES by default
+        :param workers: Number of processes or threads of the stages
+        :param rate_limiter: Optional TokenBucket of the downloads, shared
+        with other pipelines (see shards.py)
+        :param circuit_breaker: Optional CircuitBreaker of the downloads
+        """
+        self.config = config
+        self.stages = {stage.name: stage for stage in (stages or STAGES)}
+        self.workers = workers
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.filepaths = FilePaths(config["output_dir"], config["run_name"])
+        self.filepaths_res = ResultPaths(
+            config["output_dir_metrics"], config["run_name"]
+        )
+
+    def order(self, targets=None, upstream: bool = True) -> list:
+        """
+        Returns the names of the target stages (all if None), upstream stages
+        first.
+        :param upstream: Include all stages the targets depend on
+        """
+        targets = list(targets or self.stages)
+        order = []
+
+        def visit(name, path=()):
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage: {name}")
+            if name in path:
+                raise ValueError(f"Cycle in the stages: {' -> '.join(path + (name,))}")
+            if name in order:
+                return
+            for before in self.stages[name].after:
+                if upstream or before in targets:
+                    visit(before, path + (name,))
+            order.append(name)
+
+        for name in targets:
+            visit(name)
+        return order
+
+    def outputs_state(self, stage: Stage) -> dict:
+        return {str(path): path_state(path) for path in stage.outputs(self)}
+
+    def fingerprint(self, stage: Stage) -> str:
+        """Hash of the config entries, inputs and upstream outputs of a stage"""
+        blob = json.dumps(
+            {
+                "config": {key: self.config.get(key) for key in stage.config_keys},
+                "inputs": {str(p): path_state(p) for p in stage.inputs(self)},
+                "upstream": {
+                    name: self.outputs_state(self.stages[name]) for name in stage.after
+                },
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def _load_state(self) -> dict:
+        if not self.filepaths.PIPELINE_STATE_FILE.exists():
+            return {}
+        with open(self.filepaths.PIPELINE_STATE_FILE) as src:
+            return json.load(src)
+
+    def _save_state(self, state: dict) -> None:
+        path = self.filepaths.PIPELINE_STATE_FILE
+        tmp_path = path.with_name(path.name + ".part")
+        with open(tmp_path, "w") as dst:
+            json.dump(state, dst, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def run(self, targets=None, force: bool = False, upstream: bool = True) -> dict:
+        """
+        Runs the target stages and the stages they depend on.
+        :param targets: Names of the stages to run, all if None
+        :param force: Run the stages even if nothing changed
+        :param upstream: Also run the stages the targets depend on
+        :return: 'ran' or 'skipped' per stage
+        """
+        self.filepaths.OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+        self.filepaths.create_dirs()
+        self.filepaths_res.OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+        self.filepaths_res.create_dirs()
+
+        state = self._load_state()
+        result = {}
+        for name in self.order(targets, upstream):
+            stage = self.stages[name]
+            fingerprint = self.fingerprint(stage)
+            previous = state.get(name, {})
+            if (
+                not force
+                and previous.get("fingerprint") == fingerprint
+                and previous.get("outputs") == self.outputs_state(stage)
+            ):
+                logging.info(f"Stage {name}: unchanged, skipped")
+                result[name] = "skipped"
+                continue
+
+            logging.info(f"Stage {name}: running")
+            with get_telemetry().stage(f"pipeline.{name}"):
+                stage.run(self)
+            state[name] = {
+                "fingerprint": fingerprint,
+                "outputs": self.outputs_state(stage),
+            }
+            self._save_state(state)
+            result[name] = "ran"
+        return result
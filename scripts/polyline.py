@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Encoded polylines of the ORS JSON format and the compact route files built from them"""
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+# Quantization of lat, lon and elevation in ORS encoded polylines
+PRECISION = np.array([1e5, 1e5, 1e2])
+
+
+def decode_deltas(encoded: str, dims: int = 3) -> np.ndarray:
+    """
+    Decodes an encoded polyline into its quantized integer deltas, without a
+    loop over the characters: every character carries 5 bits of a value and
+    a continuation bit, values are zigzag encoded.
+    :param encoded: Polyline, e.g. the geometry of an ORS JSON response
+    :param dims: Values per point, 3 with elevation (lat, lon, elevation)
+    :return: (N, dims) int64 array; the first row is the first point, the
+    others the difference to the previous point
+    """
+    chunks = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64)
+    chunks -= 63
+    last = (chunks & 0x20) == 0
+    # Start of every value and the position of each character within it
+    starts = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+    lengths = np.diff(np.append(starts, len(chunks)))
+    position = np.arange(len(chunks)) - np.repeat(starts, lengths)
+    values = np.add.reduceat((chunks & 0x1F) << (5 * position), starts)
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+    return values.reshape(-1, dims)
+
+
+def encode_deltas(deltas) -> str:
+    """
+    Encodes quantized integer deltas as polyline, the inverse of
+    decode_deltas. Used by the stub server.
+    """
+    out = []
+    for value in np.asarray(deltas, dtype=np.int64).ravel().tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            out.append(chr((0x20 | (value & 0x1F)) + 63))
+            value >>= 5
+        out.append(chr(value + 63))
+    return "".join(out)
+
+
+def quantize(coordinates) -> np.ndarray:
+    """Returns the quantized deltas of (N, 3) [lon, lat, elevation] coordinates"""
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    scaled = np.rint(coordinates[:, [1, 0, 2]] * PRECISION).astype(np.int64)
+    return np.diff(scaled, axis=0, prepend=np.zeros((1, 3), dtype=np.int64))
+
+
+def dequantize(deltas) -> np.ndarray:
+    """Returns the (N, 3) [lon, lat, elevation] coordinates of quantized deltas"""
+    coordinates = np.cumsum(deltas, axis=0, dtype=np.int64) / PRECISION
+    return coordinates[:, [1, 0, 2]]
+
+
+def geometry_file(path) -> Path:
+    """Returns the side file holding the geometry of a compact route file"""
+    return Path(path).with_suffix(".npy")
+
+
+def write_compact(out_path, response: dict) -> int:
+    """
+    Writes an ORS JSON response with an encoded 3D polyline as compact route:
+    the quantized deltas go to an int32 .npy side file, the rest of the
+    response (summary, extras, ...) to out_path. Both files are replaced
+    atomically, the side file first.
+    :return: Number of bytes written
+    """
+    out_path = Path(out_path)
+    route = response["routes"][0]
+    deltas = decode_deltas(route["geometry"], 3).astype(np.int32)
+
+    side_path = geometry_file(out_path)
+    tmp_path = side_path.with_name(side_path.name + ".part")
+    with open(tmp_path, "wb") as f:
+        np.save(f, deltas)
+    os.replace(tmp_path, side_path)
+
+    data = json.dumps(
+        {**response, "routes": [{k: v for k, v in route.items() if k != "geometry"}]}
+    ).encode()
+    tmp_path = out_path.with_name(out_path.name + ".part")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, out_path)
+    return len(data) + side_path.stat().st_size
+
+
+def read_compact(path) -> dict:
+    """
+    Reads a compact route as GeoJSON FeatureCollection like the ones of the
+    GeoJSON endpoint, with the coordinates as (N, 3) array.
+    """
+    with open(path) as src:
+        route = json.load(src)["routes"][0]
+    coordinates = dequantize(np.load(geometry_file(path)))
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "properties": {k: v for k, v in route.items() if k != "geometry"},
+                "geometry": {"type": "LineString", "coordinates": coordinates},
+            }
+        ],
+    }
@@ -1,91 +1,230 @@
 import json
+import threading
 from pathlib import Path
 
-import contextily as ctx
-import geopandas as gpd
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import pyproj
-from shapely.geometry import LineString
 
 from scripts.line import Line
+from scripts.polyline import read_compact
+from scripts.telemetry import get_telemetry
+
+WGS84 = "epsg:4326"
+UTM32N = "epsg:32632"
+
+# Transformers are expensive to create and not thread-safe, so they are
+# cached per thread and per (src, dst) pair
+_transformers = threading.local()
+
+
+def get_transformer(src_crs: str, dst_crs: str) -> pyproj.Transformer:
+    """
+    Returns a cached transformer from src_crs to dst_crs with x/y axis order
+    (lon/lat, easting/northing).
+    """
+    cache = getattr(_transformers, "cache", None)
+    if cache is None:
+        cache = _transformers.cache = {}
+    key = (src_crs, dst_crs)
+    if key not in cache:
+        cache[key] = pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+    return cache[key]
+
+
+def transform_coordinates(coordinates, src_crs: str, dst_crs: str) -> np.ndarray:
+    """
+    Transforms an array of coordinates in one call.
+    :param coordinates: Array-like of shape (N, 3) with x, y, z
+    :return: Array of shape (N, 3) in dst_crs
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    if src_crs == dst_crs or len(coordinates) == 0:
+        return coordinates.copy()
+    with get_telemetry().stage("route.reproject"):
+        x, y = get_transformer(src_crs, dst_crs).transform(
+            coordinates[:, 0], coordinates[:, 1]
+        )
+    return np.column_stack([x, y, coordinates[:, 2]])
+
+
+def convert_routes(routes: list, dst_crs: str = UTM32N) -> list:
+    """
+    Reprojects the coordinates of many routes in a single pass: the vertices of
+    all routes in the same CRS are stacked and transformed in one call.
+    :param routes: List of Route objects
+    :param dst_crs: Target CRS
+    :return: The same routes, converted in place
+    """
+    by_crs = {}
+    for route in routes:
+        if route.crs != dst_crs:
+            by_crs.setdefault(route.crs, []).append(route)
+
+    for src_crs, group in by_crs.items():
+        arrays = [np.asarray(r.coordinates, dtype=np.float64) for r in group]
+        offsets = np.cumsum([len(a) for a in arrays])[:-1]
+        converted = transform_coordinates(np.concatenate(arrays), src_crs, dst_crs)
+        for route, coordinates in zip(group, np.split(converted, offsets)):
+            route.coordinates = coordinates
+            route.crs = dst_crs
+    return routes
+
+
+def route_files(routes_dir) -> list:
+    """
+    Returns the route files of a directory, GeoJSON files and compact route
+    files (see polyline.write_compact), sorted by route name.
+    """
+    routes_dir = Path(routes_dir)
+    paths = [*routes_dir.glob("*.geojson"), *routes_dir.glob("*.json")]
+    return sorted(paths, key=lambda path: (path.stem, path.suffix))
+
+
+def route_keys(file_name: str) -> tuple:
+    """
+    Returns route id, time of day and route type of a route file name
+    (route_<id>_<time of day>_<type>, with or without suffix) as strings.
+    """
+    name_parts = Path(file_name).stem.split("_")
+    return name_parts[1], name_parts[2], name_parts[3]
+
+
+def route_ids(values) -> np.ndarray:
+    """
+    Returns route ids as int64, the type of the route_id column in all
+    outputs (route store, metrics, comparison). Route.route_id is the string
+    of the file name, see route_keys.
+    """
+    return np.asarray(values, dtype=np.int64)
+
+
+def load_routes(file_paths, dst_crs: str = UTM32N) -> list:
+    """
+    Loads many routes and reprojects them together with convert_routes.
+    :param file_paths: Iterable of paths to GeoJSON files
+    :return: List of Route objects
+    """
+    routes = [Route(p, convert=False) for p in file_paths]
+    return convert_routes(routes, dst_crs)
 
 
 class Route(Line):
-    json_response = None
-    crs = "epsg:4326"
+    __slots__ = (
+        "file_path",
+        "_json_response",
+        "crs",
+        "filename",
+        "route_id",
+        "time_of_day",
+        "type_route",
+    )
 
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, convert: bool = True):
         """
         Initializes the Route object with a file path to a GeoJSON file.
-        Loads the route data from the specified file.
         Extracts route id, destination, and time of day from the file name.
+        The file is only read when the extras or the geometry are first
+        accessed, and the coordinates are only extracted and reprojected when
+        a geometry-dependent method (length, plot, as_dataframe, ...) is called.
 
         :param file_path: Path to the GeoJSON file containing route data
+        :param convert: Provide the coordinates in UTM Zone 32N. Use False to
+        convert many routes at once with convert_routes.
         """
         self.file_path = Path(file_path)
-        self.extract_coordinates()
-        self.convert_coordinates()
+        self._json_response = None
+        self._coordinates = None
+        self.crs = UTM32N if convert else WGS84
+        self.name = None
         self.extract_metadata()
 
+    @property
+    def json_response(self) -> dict:
+        """
+        Returns the JSON response, loading the file on first access.
+        """
+        if self._json_response is None:
+            self.load_file()
+        return self._json_response
+
+    @json_response.setter
+    def json_response(self, json_response):
+        self._json_response = json_response
+
+    @property
+    def coordinates(self) -> np.ndarray:
+        """
+        Returns the coordinates in `crs` as a (N, 3) array. They are extracted
+        and reprojected on first access.
+        """
+        if self._coordinates is None:
+            target_crs = self.crs
+            self.extract_coordinates()
+            if target_crs != WGS84:
+                self._coordinates = transform_coordinates(
+                    self._coordinates, WGS84, target_crs
+                )
+                self.crs = target_crs
+        return self._coordinates
+
+    @coordinates.setter
+    def coordinates(self, coordinates):
+        Line.coordinates.fset(self, coordinates)
+
     def load_file(self):
         """
-        Loads the GeoJSON file and returns the JSON response.
+        Loads the GeoJSON file and returns the JSON response. Compact route
+        files (.json) are returned in the same form.
         """
-        with open(self.file_path) as src:
-            self.json_response = json.load(src)
+        with get_telemetry().stage("route.parse"):
+            if self.file_path.suffix == ".json":
+                self._json_response = read_compact(self.file_path)
+            else:
+                with open(self.file_path) as src:
+                    self._json_response = json.load(src)
+        return self._json_response
 
     def extract_coordinates(self):
         """
-        Loads route from file
+        Loads route from file (WGS84)
         """
-        if self.json_response is None:
-            self.load_file()
         self.coordinates = self.json_response["features"][0]["geometry"]["coordinates"]
+        self.crs = WGS84
 
     def extract_metadata(self):
         """
         Extracts metadata from the file name.
         """
         self.filename = self.file_path.stem
-        name_parts = self.filename.split("_")
-        self.route_id = name_parts[1]
-        self.time_of_day = name_parts[2]
-        self.type_route = name_parts[3]
+        self.route_id, self.time_of_day, self.type_route = route_keys(self.filename)
 
     def convert_coordinates(self):
-        """Converts coordinates from WGS84 to UTM Zone 32N."""
-        """
-        Converts a list of coordinates from WGS84 to UTM Zone 32N.
-        :param coordinates: list of tuples [(lon, lat), ...]
-        :return: list of tuples [(x, y, z), ...] in UTM Zone 32N
-        """
-        if self.crs == "epsg:4326":
-            transformer = pyproj.Transformer.from_crs(
-                "epsg:4326", "epsg:32632", always_xy=False
-            )
-            self.coordinates = [
-                transformer.transform(lat, lon, z) for lon, lat, z in self.coordinates
-            ]
-            self.crs = "epsg:32632"
-        else:
-            transformer = pyproj.Transformer.from_crs(
-                "epsg:32632", "epsg:4326", always_xy=False
-            )
-            self.coordinates = [
-                transformer.transform(lat, lon, z) for lon, lat, z in self.coordinates
-            ]
-            self.crs = "epsg:4326"
+        """
+        Converts the coordinates from WGS84 to UTM Zone 32N, or back if they
+        are already projected. All vertices are transformed in one call.
+        """
+        dst_crs = UTM32N if self.crs == WGS84 else WGS84
+        self.coordinates = transform_coordinates(self.coordinates, self.crs, dst_crs)
+        self.crs = dst_crs
 
     def as_dataframe(self):
+        # GIS and plotting libraries are imported on first use, so that the
+        # metrics stages do not pay for them
+        import geopandas as gpd
+        from shapely.geometry import LineString
+
         return gpd.GeoDataFrame(
-            geometry=[LineString(self.coordinates)], crs="EPSG:4326"
+            geometry=[LineString(self.coordinates)], crs=self.crs.upper()
         )
 
     def plot(self):
         """
         Plots the route on a map using GeoPandas and adds a basemap with contextily.
         """
+        import contextily as ctx
+        import matplotlib.pyplot as plt
+
         gdf = self.as_dataframe()
         gdf_webmerc = gdf.to_crs(epsg=3857)
         ax = gdf_webmerc.plot(figsize=(10, 6), color="blue", linewidth=2)
@@ -139,5 +278,8 @@ class Route(Line):
         Returns the overall exposure to solar radiation of the route
         :return: solar exposure/shadow
         """
-        summary = self.summary_criterion("csv")
-        return sum(summary["value"] * summary["distance"]) / summary["distance"].sum()
+        # Plain arrays instead of summary_criterion, which builds a dataframe
+        summary = self.extras["csv"]["summary"]
+        values = np.array([r["value"] for r in summary], dtype=np.float64)
+        distances = np.array([r["distance"] for r in summary], dtype=np.float64)
+        return np.dot(values, distances) / distances.sum()
@@ -6,36 +6,301 @@ from scripts.utils import load_config
 from scripts.filepaths import FilePaths, ResultPaths
 import argparse
 import logging
+import math
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from scripts.route import Route
+from scripts.route import Route, route_files, route_ids, route_keys
+from scripts.route_store import RouteStore
+from scripts.cache import MetricsManifest
+from scripts.metric_views import write_views
+from scripts.parquet_writer import SortedMerge
+from scripts.telemetry import Telemetry, get_telemetry, profiled, use_telemetry
+import numpy as np
 import pandas as pd
 
+# Routes per batch, bounds the size of the results of one batch
+MAX_BATCH_SIZE = 1000
 
-def calculate_route_metrics(filepaths: FilePaths, filepaths_res: ResultPaths) -> None:
+KEY_COLUMNS = ["route_id", "time_of_day", "type_route"]
+
+
+def _route_columns(routes) -> dict:
     """
-    Calculate metrics of routes
-    :param filepaths: File paths for input and output files and directories
-    :return: None
+    Calculates the metrics of routes as compact columns.
+    Summary rows are returned as one array per summary key, route-level values
+    (source, keys, s_exp, number of csv segments) once per route together with
+    the number of summary rows.
+    :param routes: Iterable of Route objects
+    :return: Dictionary of columns
+    """
+    summary_columns = {}
+    sources = []
+    keys = {"route_id": [], "time_of_day": [], "type_route": []}
+    s_exps = []
+    n_segments = []
+    n_rows = []
+
+    for route in routes:
+        summary = route.extras["csv"]["summary"]
+        for record in summary:
+            for key, value in record.items():
+                summary_columns.setdefault(key, []).append(value)
+        sources.append(route.file_name())
+        for key, values in keys.items():
+            values.append(getattr(route, key))
+        s_exps.append(route.solar_exposure())
+        n_segments.append(len(route.extras["csv"]["values"]))
+        n_rows.append(len(summary))
+
+    return {
+        "summary": {k: np.asarray(v) for k, v in summary_columns.items()},
+        "source": sources,
+        "keys": keys,
+        "s_exp": np.asarray(s_exps, dtype=np.float64),
+        "n_segments": np.asarray(n_segments, dtype=np.int64),
+        "n_rows": np.asarray(n_rows, dtype=np.int64),
+    }
+
+
+def route_metrics_batch(file_paths: list) -> dict:
+    """
+    Calculates the metrics of a batch of route files, see _route_columns.
+    Routes are lazy: only the extras are read, the geometry is never projected.
+    The telemetry of the batch is returned under "telemetry".
+    """
+    with use_telemetry(Telemetry()) as telemetry:
+        columns = _route_columns(map(Route, file_paths))
+    columns["telemetry"] = telemetry
+    return columns
+
+
+def store_metrics_batch(store_file, start: int, stop: int) -> dict:
+    """
+    Calculates the metrics of the rows start to stop of a route store,
+    see _route_columns.
+    """
+    with use_telemetry(Telemetry()) as telemetry:
+        columns = _route_columns(RouteStore(store_file).routes(start, stop))
+    columns["telemetry"] = telemetry
+    return columns
+
+
+def _split_batches(items: list, workers: int) -> list:
+    """
+    Splits a list into ordered batches, a few per worker and at most
+    MAX_BATCH_SIZE items each
+    """
+    batch_size = max(1, min(MAX_BATCH_SIZE, math.ceil(len(items) / (workers * 4))))
+    return [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+
+
+def _assemble(batches: list) -> pd.DataFrame:
+    """Concatenates the columns of all batches (in order) into one dataframe"""
+    n_rows = np.concatenate([b["n_rows"] for b in batches])
+    keys = list(dict.fromkeys(k for b in batches for k in b["summary"]))
+    data = {k: np.concatenate([b["summary"][k] for b in batches]) for k in keys}
+    data["s_exp"] = np.repeat(np.concatenate([b["s_exp"] for b in batches]), n_rows)
+    data["source"] = np.repeat(
+        np.asarray([s for b in batches for s in b["source"]], dtype=object), n_rows
+    )
+    # Row index restarts at 0 for every route, as in the per-route summaries
+    index = np.arange(n_rows.sum()) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+    return pd.DataFrame(data, index=index)
+
+
+def _route_table(batches: list, df_rows: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per route with its keys and aggregates: length (sum of the summary
+    distances, m), s_exp and number of csv segments.
+    """
+    n_rows = np.concatenate([b["n_rows"] for b in batches])
+    route_index = np.repeat(np.arange(len(n_rows)), n_rows)
+    if "distance" in df_rows:
+        distance = df_rows["distance"].to_numpy(dtype=np.float64)
+    else:
+        distance = np.zeros(len(df_rows))
+    keys = {k: [v for b in batches for v in b["keys"][k]] for k in KEY_COLUMNS}
+    return pd.DataFrame(
+        {
+            "source": [s for b in batches for s in b["source"]],
+            "route_id": route_ids(keys["route_id"]),
+            "time_of_day": pd.Categorical(keys["time_of_day"]),
+            "type_route": pd.Categorical(keys["type_route"]),
+            "length": np.bincount(route_index, distance, minlength=len(n_rows)),
+            "s_exp": np.concatenate([b["s_exp"] for b in batches]),
+            "n_segments": np.concatenate([b["n_segments"] for b in batches]),
+        }
+    )
+
+
+def _results(batch: dict) -> tuple:
+    """Summary rows and per-route table of one batch"""
+    telemetry = get_telemetry()
+    telemetry.merge(batch["telemetry"])
+    telemetry.count("routes", len(batch["source"]))
+    df_rows = _assemble([batch])
+    return df_rows, _route_table([batch], df_rows)
+
+
+def _compute(batches: list, batch_function, workers: int):
+    """
+    Runs the batches, in worker processes if workers > 1, and yields their
+    results in order. At most two batches per worker are in flight, so the
+    results held in memory do not grow with the number of routes.
+    :return: Generator of (summary rows, per-route table), one per batch
+    """
+    if not batches:
+        yield _results(route_metrics_batch([]))
+    elif workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            in_flight = deque()
+            for args in batches:
+                in_flight.append(pool.submit(batch_function, *args))
+                if len(in_flight) >= 2 * workers:
+                    yield _results(in_flight.popleft().result())
+            while in_flight:
+                yield _results(in_flight.popleft().result())
+    else:
+        for args in batches:
+            yield _results(batch_function(*args))
+
+
+# Partitioned datasets of the results: summary rows and one row per route
+DATASETS = ["metrics", "routes"]
+
+
+def _partition_file(dataset_dir: Path, time_of_day: str, type_route: str) -> Path:
+    return (
+        dataset_dir
+        / f"time_of_day={time_of_day}"
+        / f"type_route={type_route}"
+        / "part-0.parquet"
+    )
+
+
+def _write_results(results_dir: Path, results, replaced: set) -> None:
+    """
+    Streams the results of the batches into the partitions of the metrics and
+    routes datasets. Only partitions that receive new rows or contain replaced
+    routes are rewritten (their existing rows streamed through SortedMerge),
+    the others are not read. Existing rows of replaced routes are dropped and
+    partitions without rows are removed.
+    :param results: Iterable of (summary rows, per-route table), sorted by source
+    :param replaced: Sources whose old rows are dropped (modified and deleted)
     """
+    outputs = {}
 
-    directory = filepaths.ROUTES_DIR
+    def partition(dataset, time_of_day, type_route) -> SortedMerge:
+        if (dataset, time_of_day, type_route) not in outputs:
+            part_file = _partition_file(results_dir / dataset, time_of_day, type_route)
+            part_file.parent.mkdir(parents=True, exist_ok=True)
+            outputs[dataset, time_of_day, type_route] = SortedMerge(
+                part_file, replaced, preserve_index=dataset == "metrics"
+            )
+        return outputs[dataset, time_of_day, type_route]
 
-    desktop = Path(directory)
+    for dataset in DATASETS:
+        (results_dir / dataset).mkdir(exist_ok=True)
+    for df_rows, df_routes in results:
+        route_ids = df_rows["source"].map(
+            dict(zip(df_routes["source"], df_routes["route_id"]))
+        )
+        df_keyed = df_rows.assign(route_id=route_ids)
+        for (time_of_day, type_route), df_part in df_routes.groupby(
+            ["time_of_day", "type_route"], observed=True
+        ):
+            rows = df_keyed[df_keyed["source"].isin(df_part["source"])]
+            partition("metrics", time_of_day, type_route).push(rows)
+            partition("routes", time_of_day, type_route).push(
+                df_part.drop(columns=["time_of_day", "type_route"])
+            )
 
-    dataframes = []
+    for source in sorted(replaced):
+        _, time_of_day, type_route = route_keys(source)
+        for dataset in DATASETS:
+            partition(dataset, time_of_day, type_route)
 
-    for i in desktop.glob("*.geojson"):
-        route = Route(i)
-        r = route.file_name()
-        df = route.summary_criterion("csv")
-        s_exp = route.solar_exposure()
-        df["s_exp"] = s_exp
-        df["source"] = r
-        dataframes.append(df)
+    for output in outputs.values():
+        if output.close() == 0:
+            shutil.rmtree(output.path.parent, ignore_errors=True)
 
-    df_all = pd.concat(dataframes)
 
-    df_all.to_parquet(filepaths_res.CSV_RESULTS_DIR / "all.parquet")
+def calculate_route_metrics(
+    filepaths: FilePaths,
+    filepaths_res: ResultPaths,
+    workers: int = 1,
+    from_store: bool = False,
+    full: bool = False,
+) -> None:
+    """
+    Calculate metrics of routes
+    Writes to CSV_RESULTS_DIR:
+    - metrics/: summary rows partitioned by time_of_day and type_route
+      (Hive layout), e.g. read only noon recommended routes with
+      pd.read_parquet(metrics_dir, filters=[("time_of_day", "==", "noon"),
+      ("type_route", "==", "recommended")])
+    - routes/: one row per route with its keys, length, s_exp and number of
+      csv segments, partitioned the same way
+    - views/: route pairs and distributions, see metric_views.write_views
+    All summary rows (formerly all.parquet) and the per-route table (formerly
+    routes.parquet) are read from the datasets on demand, see
+    metric_views.read_rows and metric_views.read_routes.
+    Partitions are ordered by source and written in row groups of
+    ROW_GROUP_SIZE rows while the routes are processed, so memory use does not
+    grow with the number of routes.
+    Only route files that were added or modified since the last run (see
+    cache.MetricsManifest) are read and only the partitions they belong to
+    are rewritten, so an incremental run does not read or write the results
+    of other partitions.
+    :param filepaths: File paths for input and output files and directories
+    :param workers: Number of processes. The output is identical for any number
+    of workers.
+    :param from_store: Read all routes from filepaths.ROUTE_STORE_FILE instead
+    of the GeoJSON files (always a full run)
+    :param full: Ignore the results of previous runs
+    :return: None
+    """
+    results_dir = filepaths_res.CSV_RESULTS_DIR
+    manifest = MetricsManifest(results_dir / "manifest.json")
+    complete = manifest.path.exists() and all(
+        (results_dir / dataset).is_dir() for dataset in DATASETS
+    )
+
+    if full or from_store or not complete:
+        for dataset in DATASETS:
+            shutil.rmtree(results_dir / dataset, ignore_errors=True)
+        # all.parquet and routes.parquet of older versions would be stale
+        for file_name in ["all.parquet", "routes.parquet", "manifest.json"]:
+            (results_dir / file_name).unlink(missing_ok=True)
+        complete = False
+
+    if from_store:
+        store_file = filepaths.ROUTE_STORE_FILE
+        rows = list(range(len(RouteStore(store_file))))
+        batches = [(store_file, b[0], b[-1] + 1) for b in _split_batches(rows, workers)]
+        batch_function = store_metrics_batch
+        files, replaced = None, set()
+    else:
+        desktop = Path(filepaths.ROUTES_DIR)
+        files, changed, deleted = manifest.changes(route_files(desktop))
+        get_telemetry().count("routes_unchanged", len(files) - len(changed))
+        if not changed and not deleted and complete:
+            write_views(results_dir)
+            return
+        batches = [(b,) for b in _split_batches(changed, workers)]
+        batch_function = route_metrics_batch
+        replaced = {Path(name).stem for name in deleted}
+        replaced |= {p.stem for p in changed}
+
+    with get_telemetry().stage("metrics"):
+        results = _compute(batches, batch_function, workers)
+        _write_results(results_dir, results, replaced)
+    with get_telemetry().stage("views"):
+        write_views(results_dir)
+    if files is not None:
+        manifest.save(files)
 
 
 if __name__ == "__main__":
@@ -48,6 +313,24 @@ if __name__ == "__main__":
     # Get command line arguments
     parser = argparse.ArgumentParser(description="Calculate metrics of routes.")
     parser.add_argument("--config", type=str, required=True, help="Config file as YAML")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--from-store",
+        action="store_true",
+        help="Read routes from the packed route store instead of GeoJSON files",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Recalculate all routes instead of only new or changed ones",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Run under cProfile and save the stats in the run directory",
+    )
     args = parser.parse_args()
 
     # Load configuration
@@ -65,6 +348,17 @@ if __name__ == "__main__":
 
     # Calculates the metrics for the routes. Output file is one parquet file.
 
-    calculate_route_metrics(filepaths, filepaths_res)
+    profile_file = filepaths.OUTPUT_DIR / "profile_route_metrics.prof"
+    with profiled(profile_file if args.profile else None):
+        calculate_route_metrics(
+            filepaths,
+            filepaths_res,
+            workers=args.workers,
+            from_store=args.from_store,
+            full=args.full,
+        )
 
     logging.info("Successfully calculated parquet file with metrics")
+
+    # Stage timings next to the config.yml of the run
+    get_telemetry().dump(filepaths.OUTPUT_DIR / "telemetry_route_metrics.json")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Packs the downloaded GeoJSON routes of a run into one columnar Arrow file"""
+
+import argparse
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+from scripts.filepaths import FilePaths
+from scripts.line import LineCollection
+from scripts.route import Route, route_files, route_ids
+from scripts.utils import load_config
+
+SCHEMA = pa.schema(
+    [
+        ("source", pa.string()),
+        ("route_id", pa.int64()),
+        ("time_of_day", pa.dictionary(pa.int32(), pa.string())),
+        ("type_route", pa.dictionary(pa.int32(), pa.string())),
+        ("coordinates", pa.list_(pa.list_(pa.float64(), 3))),
+        ("extras", pa.string()),
+    ]
+)
+
+
+def ingest_routes(routes_dir, store_file) -> int:
+    """
+    Reads all route files of a directory and writes them to an uncompressed
+    Arrow IPC file, one row per route, ordered by file name.
+    :param routes_dir: Directory with route_{id}_{time}_{mode}.geojson (or
+    compact .json) files
+    :param store_file: Output file
+    :return: Number of routes written
+    """
+    sources, ids, times, types, extras = [], [], [], [], []
+    arrays = []
+
+    for file_path in route_files(routes_dir):
+        route = Route(file_path, convert=False)
+        sources.append(route.file_name())
+        ids.append(route.route_id)
+        times.append(route.time_of_day)
+        types.append(route.type_route)
+        arrays.append(route.coordinates)
+        extras.append(json.dumps(route.extras, separators=(",", ":")))
+
+    counts = [len(a) for a in arrays]
+    vertices = np.concatenate(arrays) if arrays else np.empty((0, 3))
+    points = pa.FixedSizeListArray.from_arrays(pa.array(vertices.ravel()), 3)
+    offsets = pa.array(np.concatenate([[0], np.cumsum(counts)]), type=pa.int32())
+
+    table = pa.table(
+        [
+            pa.array(sources, pa.string()),
+            pa.array(route_ids(ids), pa.int64()),
+            pa.array(times, pa.string()).dictionary_encode(),
+            pa.array(types, pa.string()).dictionary_encode(),
+            pa.ListArray.from_arrays(offsets, points),
+            pa.array(extras, pa.string()),
+        ],
+        schema=SCHEMA,
+    )
+
+    tmp_file = Path(store_file).with_suffix(".part")
+    with pa.OSFile(str(tmp_file), "wb") as sink:
+        with pa.ipc.new_file(sink, SCHEMA) as writer:
+            writer.write_table(table)
+    tmp_file.replace(store_file)
+    return len(sources)
+
+
+class RouteStore:
+    """Memory-mapped read access to a route store written by ingest_routes"""
+
+    def __init__(self, store_file) -> None:
+        self.path = Path(store_file)
+        source = pa.memory_map(str(self.path), "r")
+        self.table = pa.ipc.open_file(source).read_all()
+        coordinates = self.table.column("coordinates").combine_chunks()
+        # Zero-copy views on the memory-mapped buffers
+        self.offsets = coordinates.offsets.to_numpy()
+        self.vertices = coordinates.values.values.to_numpy(
+            zero_copy_only=False
+        ).reshape(-1, 3)
+        self.sources = self.table.column("source").to_pylist()
+        self._extras = self.table.column("extras")
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def index(self, source: str) -> int:
+        """Returns the row of a route, e.g. 'route_3_noon_shortest'"""
+        return self.sources.index(source)
+
+    def coordinates(self, i: int) -> np.ndarray:
+        """Returns the WGS84 coordinates of row i as a (N, 3) array view"""
+        return self.vertices[self.offsets[i] : self.offsets[i + 1]]
+
+    def extras(self, i: int) -> dict:
+        """Returns the decoded extras of row i"""
+        return json.loads(self._extras[i].as_py())
+
+    def route(self, i, convert: bool = True) -> Route:
+        """
+        Returns row i (or the route with this source name) as Route. The route
+        behaves like one loaded from its GeoJSON file.
+        """
+        if isinstance(i, str):
+            i = self.index(i)
+        route = Route(Path(self.sources[i] + ".geojson"), convert=convert)
+        route.json_response = {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "properties": {"extras": self.extras(i)},
+                    "geometry": {
+                        "type": "LineString",
+                        "coordinates": self.coordinates(i),
+                    },
+                }
+            ],
+        }
+        return route
+
+    def routes(self, start: int = 0, stop: int = None, convert: bool = True):
+        """Iterates over the routes of rows start to stop"""
+        stop = len(self) if stop is None else stop
+        for i in range(start, stop):
+            yield self.route(i, convert=convert)
+
+    def line_collection(self) -> LineCollection:
+        """Returns all geometries (WGS84) as one LineCollection"""
+        return LineCollection(self.vertices, self.offsets, self.sources)
+
+
+if __name__ == "__main__":
+    # Set up logging
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    logging.info("Starting route ingest...")
+
+    # Get command line arguments
+    parser = argparse.ArgumentParser(description="Pack routes into one Arrow file.")
+    parser.add_argument("--config", type=str, required=True, help="Config file as YAML")
+    args = parser.parse_args()
+
+    # Load configuration
+    config = load_config(args.config)
+    logging.info(f"Successfully read config file: {args.config}")
+
+    filepaths = FilePaths(config["output_dir"], config["run_name"])
+    filepaths.create_dirs()
+
+    n_routes = ingest_routes(filepaths.ROUTES_DIR, filepaths.ROUTE_STORE_FILE)
+
+    logging.info(
+        f"Successfully stored {n_routes} routes in {filepaths.ROUTE_STORE_FILE}"
+    )
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Runs of several areas of interest as shards of one run, under one ORS rate limit"""
+
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from scripts.downloader import CircuitBreaker, TokenBucket
+from scripts.filepaths import FilePaths, ResultPaths
+from scripts.pipeline import Pipeline
+from scripts.telemetry import in_context
+
+# Config entries that describe the shards, not a shard
+SHARD_KEYS = ["aois", "split_aoi_by", "shard_workers"]
+
+
+def shard_name(value) -> str:
+    """Returns a name usable as directory and partition value"""
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(value)).strip("_.")
+    if not name:
+        raise ValueError(f"Invalid shard name: {value!r}")
+    return name
+
+
+def _write_if_changed(path: Path, data: bytes) -> None:
+    """Writes data unless the file already holds it, so its mtime is kept"""
+    if path.exists() and path.read_bytes() == data:
+        return
+    tmp_path = path.with_name(path.name + ".part")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def _split_aoi(config: dict, column: str) -> dict:
+    """
+    Writes every feature of input_gdf as AOI file of its shard.
+    :return: Shard name -> path of the AOI file
+    """
+    import geopandas as gpd
+
+    gdf = gpd.read_file(config["input_gdf"])
+    if column not in gdf.columns:
+        raise ValueError(f"split_aoi_by: {column} is not a column of input_gdf")
+    names = [shard_name(value) for value in gdf[column]]
+    if len(set(names)) != len(names):
+        raise ValueError(f"split_aoi_by: the values of {column} are not unique")
+
+    aoi_files = {}
+    for k, name in enumerate(names):
+        filepaths = FilePaths(config["output_dir"], f"{config['run_name']}/{name}")
+        filepaths.INTERIM_DIR.mkdir(parents=True, exist_ok=True)
+        aoi_files[name] = filepaths.INTERIM_DIR / "aoi.geojson"
+        _write_if_changed(aoi_files[name], gdf.iloc[[k]].to_json().encode())
+    return aoi_files
+
+
+def shard_configs(config: dict) -> dict:
+    """
+    Returns the configs of the shards of a run, empty if the run is not
+    sharded. A run is sharded by a list of AOIs
+        aois:
+          - name: altstadt
+            input_gdf: ./geodata/altstadt.geojson
+    or by splitting input_gdf into one shard per feature, named by a column:
+        split_aoi_by: name
+    Shard <name> is a run named <run_name>/<name>, so it has its own output
+    tree below the one of the run.
+    :return: Shard name -> config
+    """
+    if config.get("aois") and config.get("split_aoi_by"):
+        raise ValueError("Set either aois or split_aoi_by, not both")
+    if config.get("aois"):
+        aoi_files = {
+            shard_name(aoi["name"]): aoi["input_gdf"] for aoi in config["aois"]
+        }
+        if len(aoi_files) != len(config["aois"]):
+            raise ValueError("aois: the names are not unique")
+    elif config.get("split_aoi_by"):
+        aoi_files = _split_aoi(config, config["split_aoi_by"])
+    else:
+        return {}
+
+    base = {k: v for k, v in config.items() if k not in SHARD_KEYS}
+    return {
+        name: {
+            **base,
+            "input_gdf": str(aoi_file),
+            "run_name": f"{config['run_name']}/{name}",
+        }
+        for name, aoi_file in aoi_files.items()
+    }
+
+
+def _link_file(src, dst) -> None:
+    """Hard link, or copy if the file system does not support hard links"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def merge_shards(config: dict, shards: dict) -> Path:
+    """
+    Merges the metrics of the shards into the results of the run, as
+    datasets partitioned by shard (Hive layout, aoi=<name>):
+    - metrics/aoi=<name>/time_of_day=<time>/type_route=<type>/
+    - routes/aoi=<name>/time_of_day=<time>/type_route=<type>/
+    - pairs/aoi=<name>/, the route pairs of the shard (see metric_views)
+    The files are hard links to the ones of the shards. Partitions of shards
+    that are no longer in the config are removed.
+    :return: CSV results directory of the run
+    """
+    results_dir = ResultPaths(config["output_dir_metrics"], config["run_name"])
+    results_dir = results_dir.CSV_RESULTS_DIR
+    for dataset in ["metrics", "routes", "pairs"]:
+        dataset_dir = results_dir / dataset
+        dataset_dir.mkdir(parents=True, exist_ok=True)
+        for part_dir in dataset_dir.glob("aoi=*"):
+            shutil.rmtree(part_dir)
+
+    for name, shard_config in shards.items():
+        shard_dir = ResultPaths(
+            shard_config["output_dir_metrics"], shard_config["run_name"]
+        ).CSV_RESULTS_DIR
+        for dataset in ["metrics", "routes"]:
+            if (shard_dir / dataset).is_dir():
+                shutil.copytree(
+                    shard_dir / dataset,
+                    results_dir / dataset / f"aoi={name}",
+                    copy_function=_link_file,
+                )
+        pairs_file = shard_dir / "views" / "pairs.parquet"
+        if pairs_file.exists():
+            part_dir = results_dir / "pairs" / f"aoi={name}"
+            part_dir.mkdir()
+            _link_file(pairs_file, part_dir / "part-0.parquet")
+    return results_dir
+
+
+def run_shards(
+    config: dict,
+    targets=None,
+    force: bool = False,
+    upstream: bool = True,
+    workers: int = 1,
+) -> dict:
+    """
+    Runs the pipeline of every shard, `shard_workers` shards at a time (all
+    by default). The shards run in threads of this process and share one
+    token bucket and circuit breaker, so together they stay below
+    `requests_per_second` of the ORS instance. The metrics are merged
+    afterwards, see merge_shards.
+    :param targets: Stages to run, see Pipeline.run
+    :param workers: Number of processes or threads of the stages of a shard
+    :return: Shard name -> result of Pipeline.run
+    """
+    shards = shard_configs(config)
+    if not shards:
+        raise ValueError("The config defines no shards (aois or split_aoi_by)")
+    rate_limiter = TokenBucket(
+        config.get("requests_per_second"), config.get("request_burst", 1)
+    )
+    circuit_breaker = CircuitBreaker(
+        config.get("circuit_breaker_failures", 5),
+        config.get("circuit_breaker_cooldown_s", 30.0),
+    )
+    pipelines = {
+        name: Pipeline(
+            shard_config,
+            workers=workers,
+            rate_limiter=rate_limiter,
+            circuit_breaker=circuit_breaker,
+        )
+        for name, shard_config in shards.items()
+    }
+    # Check the targets before any shard starts
+    next(iter(pipelines.values())).order(targets)
+
+    with ThreadPoolExecutor(config.get("shard_workers") or len(shards)) as pool:
+        futures = {
+            name: pool.submit(in_context(pipeline.run), targets, force, upstream)
+            for name, pipeline in pipelines.items()
+        }
+        results = {name: future.result() for name, future in futures.items()}
+
+    results_dir = merge_shards(config, shards)
+    logging.info(f"Merged the metrics of {len(shards)} shards in {results_dir}")
+    return results
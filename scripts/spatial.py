@@ -3,11 +3,25 @@
 """Script that creates random points within a given polygon"""
 
 import numpy as np
-from shapely.geometry import Point
-import pandas as pd
+import shapely
 import geopandas as gpd
+import pandas as pd
 from numpy import cos, sin, arcsin, sqrt
-from math import radians
+
+EARTH_RADIUS_KM = 6367
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Computes the haversine distance in km between (lon1, lat1) and
+    (lon2, lat2). Accepts scalars or NumPy arrays of any broadcastable shape.
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
+    c = 2 * arcsin(sqrt(np.clip(a, 0, 1)))
+    return EARTH_RADIUS_KM * c
 
 
 class RandomPoints:
@@ -17,61 +31,219 @@ class RandomPoints:
         self.polygon = polygon
         self.polygon = self.polygon.to_crs("EPSG:4326")
 
-    def random_points(self, number: int):
-        minx, miny, maxx, maxy = self.polygon.total_bounds
-        x = np.random.uniform(minx, maxx, number)
-        y = np.random.uniform(miny, maxy, number)
-
-        self.polygon = self.polygon.set_crs("EPSG:4326")
-        self.polygon["poly"] = "poly"
-        self.polygon.set_index("poly", inplace=True)
-
-        df = pd.DataFrame()
-
-        df["points"] = list(zip(x, y))
-        df["points"] = df["points"].apply(Point)
-        gdf_points = gpd.GeoDataFrame(df, geometry="points")
-
-        gdf_points = gdf_points.set_crs("EPSG:4326")
-
-        Sjoin = gpd.tools.sjoin(
-            gdf_points, self.polygon, predicate="within", how="left"
-        )
-
-        self.pnts_in_poly = gdf_points[Sjoin.poly == "poly"]
-
-    def sample_df(self):
-        """Creates a dataframe with max. 100 sample routes"""
-        self.pnts_in_poly.loc[:, "lon"] = self.pnts_in_poly.geometry.x
-        self.pnts_in_poly.loc[:, "lat"] = self.pnts_in_poly.geometry.y
-        del self.pnts_in_poly["points"]
-        df1 = self.pnts_in_poly.iloc[:200].copy()
-
-        df2 = self.pnts_in_poly.iloc[-100:].reset_index(drop=True)
-
-        df1_tail = df1.iloc[-100:].reset_index(drop=True)
-
-        # now attach lon2 and lat2
-        df1_tail["lon2"] = df2["lon"]
-        df1_tail["lat2"] = df2["lat"]
-
-        df1_tail["id"] = np.arange(0, len(df1_tail))
-
-        self.df1_tail = df1_tail
+    def random_points(self, number: int, seed=None, batch_size: int = 1_000_000):
+        """
+        Draws exactly `number` uniform random points within the polygon.
+        Candidates are drawn in batches in the bounding box and tested with a
+        vectorized point-in-polygon test against the prepared polygon until
+        enough points are inside (rejection sampling).
+        :param number: Number of points
+        :param seed: Seed of the random generator for reproducible runs
+        :param batch_size: Maximum number of candidates tested at once
+        """
+        rng = np.random.default_rng(seed)
+        area = self.polygon.union_all()
+        shapely.prepare(area)
+        minx, miny, maxx, maxy = area.bounds
+        # Share of the bounding box covered by the polygon
+        fraction = area.area / ((maxx - minx) * (maxy - miny))
+
+        xs, ys = [], []
+        found = 0
+        while found < number:
+            n_draw = int(min(batch_size, 1.1 * (number - found) / fraction + 100))
+            x = rng.uniform(minx, maxx, n_draw)
+            y = rng.uniform(miny, maxy, n_draw)
+            inside = shapely.contains_xy(area, x, y)
+            xs.append(x[inside])
+            ys.append(y[inside])
+            found += int(inside.sum())
+
+        x = np.concatenate(xs)[:number]
+        y = np.concatenate(ys)[:number]
+
+        self.pnts_in_poly = gpd.GeoDataFrame(
+            geometry=gpd.points_from_xy(x, y), crs="EPSG:4326"
+        ).rename_geometry("points")
+
+    def sample_df(self, number: int = 100, seed=None):
+        """
+        Creates a dataframe with max. `number` sample routes, unique pairs of
+        the points in the polygon (see od_pairs)
+        :param number: Maximum number of routes
+        :param seed: Seed of the random generator
+        :return: Dataframe with lon, lat, lon2, lat2 and id
+        """
+        n = len(self.pnts_in_poly)
+        pairs = self.od_pairs(min(number, n * (n - 1)), batch_size=number, seed=seed)
+        self.df1_tail = pd.concat(list(pairs), ignore_index=True)[
+            ["lon", "lat", "lon2", "lat2", "id"]
+        ]
+        return self.df1_tail
 
     def compute_distance(self):
         """Computes haversine distance between (lon, lat) and (lon2, lat2)"""
+        df = self.df1_tail
+        self.df1_tail["distance_km"] = haversine(
+            df["lon"].to_numpy(),
+            df["lat"].to_numpy(),
+            df["lon2"].to_numpy(),
+            df["lat2"].to_numpy(),
+        )
+        return self.df1_tail
 
-        def haversine(row):
-            lon1, lat1, lon2, lat2 = map(
-                radians, [row["lon"], row["lat"], row["lon2"], row["lat2"]]
+    def _lon_lat(self):
+        """Returns lon and lat arrays of all points in the polygon"""
+        if "lon" in self.pnts_in_poly.columns:
+            return (
+                self.pnts_in_poly["lon"].to_numpy(),
+                self.pnts_in_poly["lat"].to_numpy(),
             )
-            dlon = lon2 - lon1
-            dlat = lat2 - lat1
-            a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-            c = 2 * arcsin(sqrt(a))
-            km = 6367 * c
-            return km
-
-        self.df1_tail["distance_km"] = self.df1_tail.apply(haversine, axis=1)
-        return self.df1_tail
+        return (
+            self.pnts_in_poly.geometry.x.to_numpy(),
+            self.pnts_in_poly.geometry.y.to_numpy(),
+        )
+
+    def distance_blocks(self, max_bytes: int = 64 * 2**20):
+        """
+        Yields the origin x destination haversine distance matrix of all points
+        in the polygon in blocks of rows, so that the temporary arrays of one
+        block stay within max_bytes.
+        :param max_bytes: Memory budget of one block
+        :return: Generator of (start_row, block) with block of shape (rows, n)
+        """
+        lon, lat = self._lon_lat()
+        n = len(lon)
+        # About 6 float64 temporaries of the block size are alive at once
+        rows = max(1, int(max_bytes // (6 * 8 * max(n, 1))))
+        for start in range(0, n, rows):
+            stop = min(start + rows, n)
+            yield (
+                start,
+                haversine(
+                    lon[start:stop, None],
+                    lat[start:stop, None],
+                    lon[None, :],
+                    lat[None, :],
+                ),
+            )
+
+    def distance_matrix(self, max_bytes: int = 64 * 2**20, out=None):
+        """
+        Computes the full origin x destination distance matrix (km) of all
+        points in the polygon, block by block (see distance_blocks).
+        :param max_bytes: Memory budget of one block
+        :param out: Optional (n, n) array to fill, e.g. a np.memmap for large n
+        :return: Distance matrix
+        """
+        lon, _ = self._lon_lat()
+        if out is None:
+            out = np.empty((len(lon), len(lon)))
+        for start, block in self.distance_blocks(max_bytes):
+            out[start : start + len(block)] = block
+        return out
+
+    def od_pairs(
+        self,
+        number: int,
+        batch_size: int = 1000,
+        distance_bands=None,
+        seed=None,
+        max_attempts: int = 100,
+    ):
+        """
+        Streams `number` unique origin-destination pairs drawn from the points
+        in the polygon, in batches of at most batch_size rows.
+        With distance_bands the pairs are stratified: each [min_km, max_km)
+        band receives an equal share of the pairs, based on the haversine
+        distance.
+        :param number: Number of pairs
+        :param batch_size: Number of pairs per yielded dataframe
+        :param distance_bands: Optional list of [min_km, max_km] bands
+        :param seed: Seed of the random generator
+        :param max_attempts: Number of candidate draws without a new pair
+        before giving up
+        :return: Generator of dataframes with lon, lat, lon2, lat2, id,
+        distance_km and band
+        """
+        lon, lat = self._lon_lat()
+        n = len(lon)
+        if number > n * (n - 1):
+            raise ValueError(f"Cannot draw {number} unique pairs from {n} points.")
+
+        rng = np.random.default_rng(seed)
+        if distance_bands is None:
+            distance_bands = [[0, np.inf]]
+        bands = np.asarray(distance_bands, dtype=np.float64)
+        quota = np.full(len(bands), number // len(bands))
+        quota[: number % len(bands)] += 1
+
+        seen = np.empty(0, dtype=np.int64)
+        pending = {"i": [], "j": [], "distance_km": [], "band": []}
+        n_pending = 0
+        next_id = 0
+        attempts = 0
+
+        while quota.sum() > 0:
+            # Fixed draw size, so that without bands a larger `number` extends
+            # the pairs of a smaller one with the same seed
+            m = max(4 * batch_size, 1000)
+            i = rng.integers(0, n, m)
+            j = rng.integers(0, n, m)
+            distance = haversine(lon[i], lat[i], lon[j], lat[j])
+
+            band = np.full(m, -1)
+            for k, (lo, hi) in enumerate(bands):
+                band[(band < 0) & (distance >= lo) & (distance < hi)] = k
+
+            # Drop loops, pairs outside all bands and duplicates
+            keys = i.astype(np.int64) * n + j
+            candidates = np.flatnonzero((i != j) & (band >= 0))
+            _, first = np.unique(keys[candidates], return_index=True)
+            candidates = np.sort(candidates[first])
+            candidates = candidates[~np.isin(keys[candidates], seen)]
+
+            accepted = []
+            for k in range(len(bands)):
+                in_band = candidates[band[candidates] == k][: quota[k]]
+                quota[k] -= len(in_band)
+                accepted.append(in_band)
+            accepted = np.sort(np.concatenate(accepted))
+
+            if len(accepted) == 0:
+                attempts += 1
+                if attempts >= max_attempts:
+                    raise ValueError(
+                        f"No pairs found for the distance bands {bands[quota > 0].tolist()}."
+                    )
+                continue
+            attempts = 0
+            seen = np.concatenate([seen, keys[accepted]])
+
+            for key, values in [
+                ("i", i),
+                ("j", j),
+                ("distance_km", distance),
+                ("band", band),
+            ]:
+                pending[key].append(values[accepted])
+            n_pending += len(accepted)
+
+            while n_pending >= batch_size or (quota.sum() == 0 and n_pending > 0):
+                columns = {k: np.concatenate(v) for k, v in pending.items()}
+                size = min(batch_size, n_pending)
+                oi, di = columns["i"][:size], columns["j"][:size]
+                yield pd.DataFrame(
+                    {
+                        "lon": lon[oi],
+                        "lat": lat[oi],
+                        "lon2": lon[di],
+                        "lat2": lat[di],
+                        "id": np.arange(next_id, next_id + size),
+                        "distance_km": columns["distance_km"][:size],
+                        "band": columns["band"][:size],
+                    }
+                )
+                next_id += size
+                pending = {k: [v[size:]] for k, v in columns.items()}
+                n_pending -= size
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Lightweight instrumentation of the pipeline stages and run telemetry"""
+
+import contextvars
+import cProfile
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+# Upper edges of the request latency histogram in seconds
+LATENCY_BINS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf")]
+
+
+class Telemetry:
+    """Collects per-stage wall/CPU times, counters and request latencies"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.latencies = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures the wall and CPU time of a block. Repeated blocks with the
+        same name are summed. CPU time is process-wide, so it includes other
+        threads running at the same time.
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add_stage(self, name: str, wall: float, cpu: float, calls: int = 1) -> None:
+        with self._lock:
+            entry = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+            entry["wall"] += wall
+            entry["cpu"] += cpu
+            entry["calls"] += calls
+
+    def count(self, name: str, n=1) -> None:
+        """Increments a counter, e.g. bytes downloaded or failures"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_latency(self, latency: float) -> None:
+        """Records the latency of a successful request in seconds"""
+        with self._lock:
+            self.latencies.append(latency)
+        self.count("requests")
+
+    def merge(self, other: "Telemetry") -> None:
+        """Adds the measurements of another Telemetry (e.g. from a worker process)"""
+        for name, entry in other.stages.items():
+            self.add_stage(name, entry["wall"], entry["cpu"], entry["calls"])
+        for name, n in other.counters.items():
+            self.count(name, n)
+        with self._lock:
+            self.latencies.extend(other.latencies)
+
+    def __getstate__(self) -> dict:
+        # Locks cannot be pickled, e.g. when returned from a worker process
+        return {k: v for k, v in self.__dict__.items() if k != "_lock"}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def latency_histogram(self) -> dict:
+        """Number of requests per latency bin, keyed by the upper bin edge"""
+        counts, _ = np.histogram(self.latencies, bins=[0.0] + LATENCY_BINS)
+        return {f"<={edge}s": int(n) for edge, n in zip(LATENCY_BINS, counts)}
+
+    def summary(self) -> dict:
+        latencies = np.asarray(self.latencies)
+        return {
+            "stages": self.stages,
+            "counters": self.counters,
+            "latency": {
+                "histogram": self.latency_histogram(),
+                "mean": float(latencies.mean()) if len(latencies) else None,
+                "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+            },
+        }
+
+    def dump(self, file_path) -> None:
+        """Writes the summary as JSON"""
+        with open(file_path, "w") as dst:
+            json.dump(self.summary(), dst, indent=2)
+
+
+# Telemetry of the current thread (or task), the process telemetry by default.
+# Threads of a pool start without the context of the submitting thread, see
+# in_context
+_current = contextvars.ContextVar("telemetry", default=Telemetry())
+
+
+def get_telemetry() -> Telemetry:
+    """Returns the telemetry of the current context"""
+    return _current.get()
+
+
+@contextmanager
+def use_telemetry(telemetry: Telemetry):
+    """
+    Temporarily replaces the telemetry of the current context, without
+    affecting other threads
+    """
+    token = _current.set(telemetry)
+    try:
+        yield telemetry
+    finally:
+        _current.reset(token)
+
+
+def in_context(function):
+    """
+    Wraps a function to run in a copy of the current context, e.g. when
+    submitted to a thread pool, so that it records to the current telemetry
+    """
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+@contextmanager
+def profiled(output_file=None):
+    """
+    Runs a block under cProfile and saves the stats to output_file
+    (readable with pstats or snakeviz). Does nothing if output_file is None.
+    """
+    if output_file is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(Path(output_file))
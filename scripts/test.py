@@ -1,7 +1,53 @@
+import json
+import shutil
+import threading
+import time
+from pathlib import Path
+
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from openrouteservice.convert import decode_polyline
 from shapely.geometry import box
 from spatial import RandomPoints
 
+from scripts.benchmark import compare, run_benchmarks
+from scripts.cache import (
+    DownloadManifest,
+    FailureJournal,
+    ResponseCache,
+    request_key,
+)
+from scripts.comparison import RouteIndex
+from scripts.downloader import (
+    CircuitBreaker,
+    RouteDownloader,
+    RouteRequest,
+    TokenBucket,
+)
+from scripts.exposure import ExposureEngine
+from scripts.filepaths import FilePaths, ResultPaths
+from scripts.generate_routes import download_routes, retry_failed
+from scripts.heatmap import HeatMap, build_heatmap
+from scripts.line import Line, LineCollection
+from scripts.metric_views import export_tables, read_routes, read_rows, write_views
+from scripts.ors_stub import StubORSServer, synthetic_route
+from scripts.parquet_writer import ParquetStream, SortedMerge
+from scripts.pipeline import Pipeline
+from scripts.polyline import decode_deltas, dequantize, encode_deltas, quantize
+from scripts.route import Route, load_routes
+from scripts.route_metrics import calculate_route_metrics
+from scripts.route_store import RouteStore, ingest_routes
+from scripts.shards import run_shards, shard_configs
+from scripts.telemetry import (
+    Telemetry,
+    get_telemetry,
+    in_context,
+    use_telemetry,
+)
+
 #test if the polygon crs is set to 4326
 
 def test_polygon_crs_is_4326():
@@ -46,6 +92,14 @@ def test_sample_df_columns():
     expected_columns = {"lon", "lat", "lon2", "lat2", "id"}
 
     assert set(rp.df1_tail.columns) == expected_columns
+    assert len(rp.df1_tail) == 100
+
+    #fewer points than pairs requested: all unique pairs, no self-pairs
+    rp.random_points(5)
+    df = rp.sample_df()
+    assert len(df) == 20
+    assert not df[["lon", "lat", "lon2", "lat2"]].duplicated().any()
+    assert ((df["lon"] != df["lon2"]) | (df["lat"] != df["lat2"])).all()
 
 #test if the function does not return negative values
 def test_compute_distance_non_negative():
@@ -58,3 +112,988 @@ def test_compute_distance_non_negative():
     df_distances = rp.compute_distance()
 
     assert (df_distances["distance_km"] >= 0).all()
+
+#stub ORS server serving synthetic routes, so downloads can be tested offline
+
+@pytest.fixture
+def ors_stub():
+    with StubORSServer(latency=0.01) as stub:
+        yield stub
+
+#test if the downloader writes one file per request and stops at max_total_requests
+
+def test_download_routes_with_stub(ors_stub, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.OUTPUT_DIR.mkdir()
+    filepaths.create_dirs()
+    df = pd.DataFrame(
+        {
+            "lon": [8.68, 8.69],
+            "lat": [49.40, 49.41],
+            "lon2": [8.70, 8.71],
+            "lat2": [49.42, 49.43],
+            "id": [0, 1],
+        }
+    )
+    config = {
+        "ors_url": ors_stub.url,
+        "download_workers": 4,
+        "requests_per_second": 100,
+        "request_burst": 4,
+    }
+
+    failed = download_routes(
+        df, config, filepaths, ["noon", "evening"], 2, max_total_requests=6
+    )
+
+    assert failed == []
+    assert ors_stub.request_count == 6
+    assert len(list(filepaths.ROUTES_DIR.glob("*.geojson"))) == 6
+
+#test if a resumed run only sends the requests that are not yet satisfied
+
+def test_download_routes_resume(ors_stub, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.OUTPUT_DIR.mkdir()
+    filepaths.create_dirs()
+    df = pd.DataFrame(
+        {
+            "lon": [8.68, 8.69],
+            "lat": [49.40, 49.41],
+            "lon2": [8.70, 8.71],
+            "lat2": [49.42, 49.43],
+            "id": [0, 1],
+        }
+    )
+    config = {"ors_url": ors_stub.url}
+
+    download_routes(df, config, filepaths, ["noon"], 1)
+    download_routes(df, config, filepaths, ["noon"], 2, resume=True)
+
+    assert ors_stub.request_count == 4
+    assert len(list(filepaths.ROUTES_DIR.glob("*.geojson"))) == 4
+
+#test if the response cache evicts the least recently used entries
+
+def test_response_cache_eviction(tmp_path):
+    cache = ResponseCache(tmp_path / "cache", max_bytes=250)
+    for k in range(5):
+        cache.put(request_key("endpoint", {"k": k}), {"data": "x" * 100})
+
+    assert cache.size <= 250
+    assert request_key("endpoint", {"k": 4}) in cache
+    assert request_key("endpoint", {"k": 0}) not in cache
+
+#test if the token bucket keeps the request rate below the limit
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+
+    assert time.monotonic() - start >= 10 / 50 * 0.9
+
+#synthetic route files in a temporary routes directory
+
+@pytest.fixture
+def route_files(tmp_path):
+    routes_dir = tmp_path / "routes"
+    routes_dir.mkdir()
+    paths = []
+    for route_id in range(3):
+        for time_of_day in ["noon", "evening"]:
+            for mode in ["shortest", "recommended"]:
+                path = routes_dir / f"route_{route_id}_{time_of_day}_{mode}.geojson"
+                response = synthetic_route(
+                    [8.65 + 0.01 * route_id, 49.40],
+                    [8.70, 49.42],
+                    n_vertices=30,
+                    seed=path.name,
+                )
+                with open(path, "w") as f:
+                    json.dump(response, f)
+                paths.append(path)
+    return paths
+
+#test if converting many routes at once gives the same coordinates as one by one
+
+def test_load_routes_matches_single_conversion(route_files):
+    routes = load_routes(route_files)
+
+    for path, route in zip(route_files, routes):
+        single = Route(path)
+        assert route.crs == single.crs == "epsg:32632"
+        assert np.allclose(route.coordinates, single.coordinates)
+
+#test if the vectorized metrics of a line collection match the single lines
+
+def test_line_collection_matches_lines(route_files):
+    routes = load_routes(route_files)
+    collection = LineCollection.from_lines(routes)
+
+    assert np.allclose(collection.lengths(), [r.length() for r in routes])
+    assert np.allclose(collection.ascent(), [r.ascent() for r in routes])
+    assert np.allclose(
+        collection.cumulative_distance(),
+        np.concatenate([r.cumulative_distance() for r in routes]),
+    )
+
+#test if moving a line does not change the array, collection or store it was created from
+
+def test_move_does_not_change_source(route_files, tmp_path):
+    a = np.array([(0.0, 0.0, 0.0), (3.0, 4.0, 1.0)])
+    line = Line(a)
+    line.move(1, 1, 1)
+    assert a[0].tolist() == [0.0, 0.0, 0.0]
+    assert line.coordinates[0].tolist() == [1.0, 1.0, 1.0]
+
+    collection = LineCollection.from_lines(load_routes(route_files))
+    vertices = collection.vertices.copy()
+    collection[0].move(10, 0, 0)
+    assert np.array_equal(collection.vertices, vertices)
+
+    store_file = tmp_path / "routes.arrow"
+    ingest_routes(route_files[0].parent, store_file)
+    route = RouteStore(store_file).route(0, convert=False)
+    first = route.coordinates[0].copy()
+    route.move(0, 0, 5)
+    assert route.coordinates[0, 2] == first[2] + 5
+
+#test if vertical segments get an infinite slope
+
+def test_segment_slopes_vertical():
+    line = Line([(0, 0, 0), (3, 4, 1), (3, 4, 2)])
+
+    assert np.allclose(line.get_segment_slopes(), [0.2, np.inf])
+    assert line.length() == pytest.approx(np.sqrt(26) + 1)
+
+#test if the metrics of a parallel run are identical to a serial run
+
+def test_route_metrics_parallel_matches_serial(route_files, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.ROUTES_DIR = route_files[0].parent
+    results = []
+    for workers in [1, 2]:
+        filepaths_res = ResultPaths(tmp_path, f"results_{workers}")
+        filepaths_res.OUTPUT_DIR.mkdir()
+        filepaths_res.create_dirs()
+        calculate_route_metrics(filepaths, filepaths_res, workers=workers)
+        results.append(read_rows(filepaths_res.CSV_RESULTS_DIR))
+
+    pd.testing.assert_frame_equal(results[0], results[1])
+    assert results[0]["source"].nunique() == len(route_files)
+
+#test if a route only reads and projects its geometry when it is needed
+
+def test_route_is_lazy(route_files):
+    route = Route(route_files[0])
+    assert route.route_id == "0" and route.time_of_day == "noon"
+    assert route._json_response is None
+
+    route.solar_exposure()
+    assert route._json_response is not None
+    assert route._coordinates is None
+
+    assert route.length() > 0
+    assert route.crs == "epsg:32632"
+    assert np.allclose(route.coordinates, load_routes(route_files[:1])[0].coordinates)
+
+#test if routes read from the route store match the GeoJSON files
+
+def test_route_store_matches_files(route_files, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.OUTPUT_DIR.mkdir()
+    filepaths.create_dirs()
+    filepaths.ROUTES_DIR = route_files[0].parent
+    assert ingest_routes(filepaths.ROUTES_DIR, filepaths.ROUTE_STORE_FILE) == 12
+
+    store = RouteStore(filepaths.ROUTE_STORE_FILE)
+    route = store.route("route_1_noon_recommended")
+    single = Route(filepaths.ROUTES_DIR / "route_1_noon_recommended.geojson")
+    assert np.allclose(route.coordinates, single.coordinates)
+    assert route.extras == single.extras
+
+    results = []
+    for from_store in [False, True]:
+        filepaths_res = ResultPaths(tmp_path, f"results_{from_store}")
+        filepaths_res.OUTPUT_DIR.mkdir()
+        filepaths_res.create_dirs()
+        calculate_route_metrics(filepaths, filepaths_res, from_store=from_store)
+        results.append(read_rows(filepaths_res.CSV_RESULTS_DIR))
+    pd.testing.assert_frame_equal(results[0], results[1])
+
+#test if exactly the requested number of points is drawn in a non-rectangular polygon
+
+def test_random_points_exact_count_and_seed():
+    hd_polygon = gpd.read_file(Path(__file__).parents[1] / "geodata" / "hd.geojson")
+    rp = RandomPoints(hd_polygon)
+    rp.random_points(1000, seed=42)
+    rp2 = RandomPoints(hd_polygon)
+    rp2.random_points(1000, seed=42)
+
+    assert len(rp.pnts_in_poly) == 1000
+    assert rp.pnts_in_poly.within(hd_polygon.union_all()).all()
+    assert rp.pnts_in_poly.geometry.equals(rp2.pnts_in_poly.geometry)
+
+#test if the chunked distance matrix matches the pairwise distances
+
+def test_distance_matrix_chunked():
+    heidelberg_bbox = (8.598690, 49.339503, 8.755589, 49.456632)
+    polygon = box(*heidelberg_bbox)
+    heidelberg_polygon_gdf = gpd.GeoDataFrame(geometry=[polygon], crs="EPSG:4326")
+    rp = RandomPoints(heidelberg_polygon_gdf)
+    rp.random_points(300, seed=1)
+    full = rp.distance_matrix()
+    chunked = rp.distance_matrix(max_bytes=20_000)
+    rp.sample_df(seed=1)
+    df_distances = rp.compute_distance()
+    row = {lon: k for k, lon in enumerate(rp.pnts_in_poly.geometry.x)}
+    origins = df_distances["lon"].map(row).to_numpy()
+    destinations = df_distances["lon2"].map(row).to_numpy()
+
+    assert np.allclose(full, chunked)
+    assert np.allclose(np.diag(full), 0)
+    assert np.allclose(df_distances["distance_km"], full[origins, destinations])
+
+#test if the OD pair generator streams unique pairs with equal shares per distance band
+
+def test_od_pairs_stratified():
+    hd_polygon = gpd.read_file(Path(__file__).parents[1] / "geodata" / "hd.geojson")
+    rp = RandomPoints(hd_polygon)
+    rp.random_points(200, seed=1)
+    batches = list(
+        rp.od_pairs(900, batch_size=250, distance_bands=[[0, 3], [3, 8]], seed=2)
+    )
+    df = pd.concat(batches)
+
+    assert [len(b) for b in batches] == [250, 250, 250, 150]
+    assert not df.duplicated(["lon", "lat", "lon2", "lat2"]).any()
+    assert df["band"].value_counts().tolist() == [450, 450]
+    assert df.loc[df["band"] == 1, "distance_km"].between(3, 8).all()
+
+#test if batches of OD pairs are requested until the number of routes is reached
+
+def test_download_routes_batches(ors_stub, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.OUTPUT_DIR.mkdir()
+    filepaths.create_dirs()
+    heidelberg_bbox = (8.598690, 49.339503, 8.755589, 49.456632)
+    polygon = box(*heidelberg_bbox)
+    heidelberg_polygon_gdf = gpd.GeoDataFrame(geometry=[polygon], crs="EPSG:4326")
+    rp = RandomPoints(heidelberg_polygon_gdf)
+    rp.random_points(50, seed=1)
+
+    od_pairs = rp.od_pairs(10, batch_size=3)
+    download_routes(od_pairs, {"ors_url": ors_stub.url}, filepaths, ["noon"], 7)
+
+    assert ors_stub.request_count == 14
+
+#test if the benchmark suite runs on a small synthetic run and detects regressions
+
+def test_benchmarks_small():
+    results = run_benchmarks(sizes=[8], stages=["parse", "route_metrics"])
+    assert [r["stage"] for r in results] == ["parse", "route_metrics"]
+    assert all(r["peak_mb"] > 0 for r in results)
+
+    baseline = [
+        dict(r, routes_per_second=10 * r["routes_per_second"]) for r in results
+    ]
+    assert len(compare(results, baseline)) == 2
+    assert compare(results, results) == []
+
+#test if the telemetry records the requests of a download and the stages of the metrics
+
+def test_telemetry(ors_stub, route_files, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.OUTPUT_DIR.mkdir()
+    filepaths.create_dirs()
+    df = pd.DataFrame(
+        {"lon": [8.68], "lat": [49.40], "lon2": [8.70], "lat2": [49.42], "id": [0]}
+    )
+    filepaths_res = ResultPaths(tmp_path, "results")
+    filepaths_res.OUTPUT_DIR.mkdir()
+    filepaths_res.create_dirs()
+    routes = FilePaths(tmp_path, "run")
+    routes.ROUTES_DIR = route_files[0].parent
+
+    with use_telemetry(Telemetry()) as telemetry:
+        download_routes(df, {"ors_url": ors_stub.url}, filepaths, ["noon"], 1)
+        n_bytes = telemetry.counters["bytes_downloaded"]
+        download_routes(df, {"ors_url": ors_stub.url}, filepaths, ["noon"], 1)
+        # Cache hits are not downloaded
+        assert telemetry.counters["bytes_downloaded"] == n_bytes
+        calculate_route_metrics(routes, filepaths_res, workers=2)
+        telemetry.dump(filepaths.OUTPUT_DIR / "telemetry.json")
+
+    summary = json.loads((filepaths.OUTPUT_DIR / "telemetry.json").read_text())
+    assert summary["counters"]["requests"] == 2
+    assert summary["counters"]["cache_hits"] == 2
+    assert summary["counters"]["bytes_downloaded"] > 0
+    assert summary["counters"]["routes"] == len(route_files)
+    assert sum(summary["latency"]["histogram"].values()) == 2
+    assert summary["stages"]["route.parse"]["calls"] == len(route_files)
+    assert summary["stages"]["download_routes"]["calls"] == 2
+
+#test if threads using their own telemetry at the same time do not record to each other's
+
+def test_telemetry_threads():
+    process_telemetry = get_telemetry()
+    barrier = threading.Barrier(2)
+    telemetries = {}
+
+    def run(name, n):
+        with use_telemetry(Telemetry()) as telemetry:
+            telemetries[name] = telemetry
+            barrier.wait()
+            get_telemetry().count("calls", n)
+            # A thread started in_context records to the telemetry of this one
+            worker = threading.Thread(
+                target=in_context(get_telemetry().count), args=("calls", n)
+            )
+            worker.start()
+            worker.join()
+            barrier.wait()
+
+    threads = [
+        threading.Thread(target=run, args=(name, n)) for name, n in [("a", 1), ("b", 10)]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert telemetries["a"].counters == {"calls": 2}
+    assert telemetries["b"].counters == {"calls": 20}
+    assert get_telemetry() is process_telemetry
+
+#test if an incremental metrics run gives the same result as a full run after routes are added, changed and deleted
+
+def test_route_metrics_incremental(route_files, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.ROUTES_DIR = route_files[0].parent
+    filepaths_res = ResultPaths(tmp_path, "results")
+    filepaths_res.OUTPUT_DIR.mkdir()
+    filepaths_res.create_dirs()
+    results_dir = filepaths_res.CSV_RESULTS_DIR
+
+    route_files[0].unlink()
+    calculate_route_metrics(filepaths, filepaths_res)
+
+    # Add one route, change one and delete one
+    response = synthetic_route([8.66, 49.41], [8.70, 49.42], seed=1)
+    with open(route_files[0], "w") as f:
+        json.dump(response, f)
+    with open(route_files[5], "w") as f:
+        json.dump(response, f)
+    route_files[7].unlink()
+
+    # Only the partitions of the added, changed and deleted routes are written
+    part_files = sorted((results_dir / "metrics").glob("*/*/*.parquet"))
+    part_files += sorted((results_dir / "routes").glob("*/*/*.parquet"))
+    mtimes = {p: p.stat().st_mtime_ns for p in part_files}
+    with use_telemetry(Telemetry()) as telemetry:
+        calculate_route_metrics(filepaths, filepaths_res)
+    incremental = read_rows(results_dir)
+    assert telemetry.counters["routes"] == 2
+    rewritten = {
+        (p.parent.parent.name, p.parent.name)
+        for p in part_files
+        if p.stat().st_mtime_ns != mtimes[p]
+    }
+    assert rewritten == {
+        ("time_of_day=noon", "type_route=shortest"),
+        ("time_of_day=noon", "type_route=recommended"),
+        ("time_of_day=evening", "type_route=recommended"),
+    }
+
+    incremental_routes = read_routes(results_dir)
+
+    calculate_route_metrics(filepaths, filepaths_res, full=True)
+    pd.testing.assert_frame_equal(incremental, read_rows(results_dir))
+    pd.testing.assert_frame_equal(incremental_routes, read_routes(results_dir))
+    assert incremental["source"].nunique() == len(route_files) - 1
+
+#test if the partitioned dataset can be filtered by key and matches the per-route table
+
+def test_route_metrics_partitioned(route_files, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.ROUTES_DIR = route_files[0].parent
+    filepaths_res = ResultPaths(tmp_path, "results")
+    filepaths_res.OUTPUT_DIR.mkdir()
+    filepaths_res.create_dirs()
+    calculate_route_metrics(filepaths, filepaths_res)
+
+    df = pd.read_parquet(
+        filepaths_res.CSV_RESULTS_DIR / "metrics",
+        filters=[("time_of_day", "==", "noon"), ("type_route", "==", "recommended")],
+    )
+    assert set(df["source"]) == {f"route_{i}_noon_recommended" for i in range(3)}
+    assert set(df["route_id"]) == {0, 1, 2}
+
+    routes = read_routes(filepaths_res.CSV_RESULTS_DIR)
+    assert len(routes) == len(route_files)
+    assert routes["time_of_day"].dtype == "category"
+    noon = routes[routes["source"] == "route_1_noon_recommended"].iloc[0]
+    assert noon["length"] == pytest.approx(df[df["route_id"] == 1]["distance"].sum())
+    assert noon["n_segments"] == 5
+
+#test if streamed row groups have a fixed size and merged rows stay sorted
+
+def test_parquet_stream_and_merge(tmp_path):
+    path = tmp_path / "rows.parquet"
+    stream = ParquetStream(path, row_group_size=4)
+    for start in range(0, 10, 3):
+        keys = [f"k{i:02d}" for i in range(start, min(start + 3, 10), 1)]
+        stream.write(pd.DataFrame({"source": keys, "v": np.arange(len(keys))}))
+    assert stream.close() == 10
+    assert pq.ParquetFile(path).metadata.num_rows == 10
+    assert pq.ParquetFile(path).metadata.num_row_groups == 3
+
+    merge = SortedMerge(path, replaced={"k03", "k04"})
+    merge.push(pd.DataFrame({"source": ["k04", "k05a"], "v": [40, 50]}))
+    merge.push(pd.DataFrame({"source": ["k11"], "v": [110]}))
+    assert merge.close() == 11
+    df = pd.read_parquet(path)
+    assert df["source"].is_monotonic_increasing
+    assert "k03" not in set(df["source"])
+    assert df.loc[df["source"] == "k04", "v"].item() == 40
+
+#test if an integer column is widened when a later batch holds floats (NaN)
+
+def test_parquet_stream_widens_columns(tmp_path):
+    path = tmp_path / "rows.parquet"
+    stream = ParquetStream(path, row_group_size=4, preserve_index=False)
+    stream.write(pd.DataFrame({"source": list("abcde"), "v": np.arange(5)}))
+    stream.write(pd.DataFrame({"source": ["f", "g"], "v": [np.nan, 6.5]}))
+    assert stream.close() == 7
+    df = pd.read_parquet(path)
+    assert df["v"].dtype == np.float64
+    assert df["v"].tolist()[:5] == [0, 1, 2, 3, 4]
+    assert np.isnan(df["v"][5]) and df["v"][6] == 6.5
+
+    stream = ParquetStream(tmp_path / "bad.parquet")
+    stream.write(pd.DataFrame({"v": [1, 2]}))
+    with pytest.raises(TypeError):
+        stream.write(pd.DataFrame({"v": ["x"]}))
+
+#test if the batched exposure matches a loop over the value runs of every route
+
+def test_exposure_engine(route_files, tmp_path):
+    routes = load_routes(route_files)
+    engine = ExposureEngine.from_routes(routes)
+
+    expected = []
+    cumulative = []
+    for route in routes:
+        deltas = np.diff(route.coordinates, axis=0)
+        lengths = np.hypot(deltas[:, 0], deltas[:, 1])
+        values = np.zeros(len(lengths))
+        for start, end, value in route.extras["csv"]["values"]:
+            values[start:end] = value
+        expected.append((values * lengths).sum() / lengths.sum())
+        cumulative.append(np.concatenate([[0], np.cumsum(values * lengths)]))
+
+    np.testing.assert_allclose(engine.route_exposure(), expected)
+    np.testing.assert_allclose(engine.cumulative_exposure(), np.concatenate(cumulative))
+    per_time = engine.exposure_per_time_of_day()
+    assert set(per_time.index) == {"noon", "evening"}
+
+    store_file = tmp_path / "routes.arrow"
+    ingest_routes(route_files[0].parent, store_file)
+    from_store = ExposureEngine.from_store(RouteStore(store_file))
+    order = np.argsort([r.file_name() for r in routes])
+    np.testing.assert_allclose(from_store.route_exposure(), np.asarray(expected)[order])
+
+#test if pairs of shortest and recommended routes are compared and areas can be queried
+
+def test_route_index_compare_and_query():
+    x = np.linspace(0, 1000, 11)
+    lines = [
+        np.column_stack([x, np.zeros(11), np.zeros(11)]),
+        np.column_stack([x, np.zeros(11), np.zeros(11)]),
+        np.column_stack([x, np.zeros(11), np.zeros(11)]),
+        np.column_stack([x, np.full(11, 100.0), np.zeros(11)]),
+    ]
+    names = [
+        "route_0_noon_shortest",
+        "route_0_noon_recommended",
+        "route_1_noon_shortest",
+        "route_1_noon_recommended",
+    ]
+    offsets = np.arange(5) * 11
+    index = RouteIndex(LineCollection(np.concatenate(lines), offsets, names))
+
+    result = index.compare_pairs(tolerance=10, workers=2).set_index("route_id")
+    assert result["frechet"].isna().all()
+    result = index.compare_pairs(tolerance=10, frechet=True, workers=2)
+    result = result.set_index("route_id")
+    assert result.loc[0, "shared_fraction"] == pytest.approx(1)
+    assert result.loc[0, "hausdorff"] == pytest.approx(0)
+    assert result.loc[0, "buffer_overlap"] == pytest.approx(1)
+    assert result.loc[1, "shared_length"] == pytest.approx(0)
+    assert result.loc[1, "frechet"] == pytest.approx(100)
+    assert result.loc[1, "buffer_overlap"] == pytest.approx(0)
+
+    assert index.query(box(400, 50, 600, 150)) == ["route_1_noon_recommended"]
+
+#test if route_id has the same type in the route store, the comparison and the metrics
+
+def test_route_id_dtype(route_files, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.ROUTES_DIR = route_files[0].parent
+    filepaths_res = ResultPaths(tmp_path, "results")
+    filepaths_res.OUTPUT_DIR.mkdir()
+    filepaths_res.create_dirs()
+    calculate_route_metrics(filepaths, filepaths_res)
+    routes = read_routes(filepaths_res.CSV_RESULTS_DIR)
+
+    store_file = tmp_path / "routes.arrow"
+    ingest_routes(route_files[0].parent, store_file)
+    store = RouteStore(store_file)
+    comparison = RouteIndex.from_store(store).compare_pairs()
+
+    assert store.table.column("route_id").type == "int64"
+    assert routes["route_id"].dtype == comparison["route_id"].dtype == "int64"
+    joined = comparison.merge(
+        routes[routes["type_route"] == "shortest"].astype({"time_of_day": str}),
+        on=["route_id", "time_of_day"],
+    )
+    assert len(joined) == len(comparison) == 6
+
+#test if the heat map keeps the length and exposure of all routes and counts each route once per cell
+
+def test_heatmap(route_files, tmp_path):
+    store_file = tmp_path / "routes.arrow"
+    ingest_routes(route_files[0].parent, store_file)
+    store = RouteStore(store_file)
+    heatmap = build_heatmap(store, 200, tmp_path / "heatmap", batch_size=5)
+
+    engine = ExposureEngine.from_store(store)
+    lengths = engine.lines.segment_lengths(horizontal=True)
+    assert heatmap.layers["length"].sum() == pytest.approx(lengths.sum())
+    assert len(heatmap.groups) == 4
+    weighted = np.nansum(engine.segment_values() * lengths)
+    assert heatmap.layers["exposure_sum"].sum() == pytest.approx(weighted)
+    assert heatmap.layers["count"].max() <= 3
+    assert (heatmap.layers["count"] > 0).sum() >= len(store)
+
+    in_memory = build_heatmap(store, 200, batch_size=100)
+    opened = HeatMap.open(tmp_path / "heatmap")
+    assert opened.groups == heatmap.groups
+    for name, layer in in_memory.layers.items():
+        np.testing.assert_allclose(opened.layers[name], layer)
+
+    cells = opened.to_frame()
+    assert cells["count"].sum() == heatmap.layers["count"].sum()
+    assert cells["length"].sum() == pytest.approx(lengths.sum())
+
+#test if deduplicated preferences are only derived once probes confirmed identical responses and identical responses are stored once
+
+def test_download_routes_dedup(ors_stub, tmp_path):
+    df = pd.DataFrame(
+        {
+            "lon": [8.68, 8.69],
+            "lat": [49.40, 49.41],
+            "lon2": [8.70, 8.71],
+            "lat2": [49.42, 49.43],
+            "id": [0, 1],
+        }
+    )
+    times = ["morning", "noon", "afternoon", "evening"]
+
+    # The csv extras of shortest depend on the time of day: all are sent
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.OUTPUT_DIR.mkdir()
+    filepaths.create_dirs()
+    with StubORSServer() as stub, use_telemetry(Telemetry()) as telemetry:
+        config = {
+            "ors_url": stub.url,
+            "dedup_preferences": ["shortest"],
+            "dedup_probes": 1,
+        }
+        assert download_routes(df, config, filepaths, times, 2) == []
+        assert stub.request_count == 4 * len(times)
+    assert telemetry.counters["dedup_rejected"] == 1
+    assert "derived_requests" not in telemetry.counters
+    inodes = {
+        (filepaths.ROUTES_DIR / f"route_1_{t}_shortest.geojson").stat().st_ino
+        for t in times
+    }
+    assert len(inodes) == len(times)
+    noon, morning = [
+        Route(filepaths.ROUTES_DIR / f"route_1_{t}_shortest.geojson", convert=False)
+        for t in ["noon", "morning"]
+    ]
+    assert noon.extras != morning.extras
+
+    # Time-independent responses: derived after the probes of route 0
+    filepaths = FilePaths(tmp_path, "run_static")
+    filepaths.OUTPUT_DIR.mkdir()
+    filepaths.create_dirs()
+    with (
+        StubORSServer(static_preferences=["shortest"]) as stub,
+        use_telemetry(Telemetry()) as telemetry,
+    ):
+        config = {
+            "ors_url": stub.url,
+            "dedup_preferences": ["shortest"],
+            "dedup_probes": 1,
+        }
+        assert download_routes(df, config, filepaths, times, 2) == []
+        assert stub.request_count == 2 + 2 * len(times) + (len(times) - 1)
+    assert telemetry.counters["dedup_confirmed"] == 1
+    assert telemetry.counters["derived_requests"] == len(times) - 1
+    assert len(list(filepaths.ROUTES_DIR.glob("*.geojson"))) == 4 * len(times)
+    entries = DownloadManifest(filepaths.DOWNLOAD_MANIFEST_FILE).entries()
+    assert entries["route_1_evening_shortest.geojson"]["ref"] == (
+        "route_1_morning_shortest.geojson"
+    )
+    assert "ref" not in entries["route_1_evening_recommended.geojson"]
+
+    payload = {"coordinates": [[8.68, 49.40], [8.70, 49.42]]}
+    requests = [
+        RouteRequest(0, "noon", "shortest", payload, tmp_path / "a.geojson"),
+        RouteRequest(0, "noon", "shortest", payload, tmp_path / "b.geojson"),
+    ]
+    with use_telemetry(Telemetry()) as telemetry:
+        RouteDownloader(ors_stub.url, workers=1).run(requests)
+    assert telemetry.counters["duplicate_responses"] == 1
+    assert (tmp_path / "a.geojson").samefile(tmp_path / "b.geojson")
+
+#test if probes and derived requests that may be sent count towards the maximum number of requests
+
+def test_download_routes_dedup_max_requests(tmp_path):
+    df = pd.DataFrame(
+        {
+            "lon": 8.68 + 0.001 * np.arange(10),
+            "lat": np.full(10, 49.40),
+            "lon2": np.full(10, 8.70),
+            "lat2": 49.42 + 0.001 * np.arange(10),
+            "id": np.arange(10),
+        }
+    )
+    times = ["morning", "noon", "afternoon", "evening"]
+
+    # Rejected: the 40 requests of morning and noon are sent. Confirmed: the
+    # 10 shortest requests of noon are 3 probes and 7 derived requests
+    for static_preferences, n_requests in [((), 40), (["shortest"], 33)]:
+        filepaths = FilePaths(tmp_path, f"run_{len(static_preferences)}")
+        filepaths.OUTPUT_DIR.mkdir()
+        filepaths.create_dirs()
+        with StubORSServer(static_preferences=static_preferences) as stub:
+            config = {"ors_url": stub.url, "dedup_preferences": ["shortest"]}
+            failed = download_routes(
+                df, config, filepaths, times, 10, max_total_requests=40
+            )
+            assert stub.request_count == n_requests
+        assert failed == []
+        assert len(list(filepaths.ROUTES_DIR.glob("*.geojson"))) == 40
+
+#test if transient errors are retried and failed requests are journaled and retried later
+
+def test_download_retries_and_failure_journal(tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.OUTPUT_DIR.mkdir()
+    filepaths.create_dirs()
+    df = pd.DataFrame(
+        {"lon": [8.68], "lat": [49.40], "lon2": [8.70], "lat2": [49.42], "id": [0]}
+    )
+
+    with StubORSServer(fail_first=2) as stub, use_telemetry(Telemetry()) as telemetry:
+        config = {"ors_url": stub.url, "download_workers": 1, "retry_backoff_s": 0}
+        failed = download_routes(df, config, filepaths, ["noon"], 1)
+    assert failed == []
+    assert telemetry.counters["retries"] == 2
+    assert len(list(filepaths.ROUTES_DIR.glob("*.geojson"))) == 2
+
+    with StubORSServer(fail_first=100) as stub:
+        config = {"ors_url": stub.url, "max_retries": 1, "retry_backoff_s": 0}
+        failed = download_routes(df, config, filepaths, ["evening"], 1)
+        assert len(failed) == 2
+        assert stub.request_count == 4
+
+        journal = FailureJournal(filepaths.FAILURE_JOURNAL_FILE)
+        entries = journal.load()
+        assert set(entries) == {
+            "route_0_evening_shortest.geojson",
+            "route_0_evening_recommended.geojson",
+        }
+        assert entries["route_0_evening_shortest.geojson"]["error"] == "ApiError"
+        assert entries["route_0_evening_shortest.geojson"]["payload"]["preference"] == (
+            "shortest"
+        )
+
+        stub.fail_first = 0
+        assert retry_failed(config, filepaths) == []
+        assert stub.request_count == 6
+    assert journal.load() == {}
+    assert len(list(filepaths.ROUTES_DIR.glob("*.geojson"))) == 4
+
+#test if 503 errors are retried by the downloader, not by the ORS client
+
+def test_download_retries_service_unavailable(recwarn, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.OUTPUT_DIR.mkdir()
+    filepaths.create_dirs()
+    df = pd.DataFrame(
+        {"lon": [8.68], "lat": [49.40], "lon2": [8.70], "lat2": [49.42], "id": [0]}
+    )
+
+    with (
+        StubORSServer(fail_first=4, fail_status=503) as stub,
+        use_telemetry(Telemetry()) as telemetry,
+    ):
+        config = {
+            "ors_url": stub.url,
+            "download_workers": 1,
+            "max_retries": 5,
+            "retry_backoff_s": 0,
+            "circuit_breaker_failures": 3,
+            "circuit_breaker_cooldown_s": 0.05,
+        }
+        failed = download_routes(df, config, filepaths, ["noon"], 1)
+        # 4 errors, then the requests of both csv_column weightings
+        assert stub.request_count == 6
+    assert failed == []
+    assert telemetry.counters["retries"] == 4
+    assert telemetry.counters["circuit_breaker_opened"] >= 1
+
+    # The error keeps the response, the ORS client does not warn of a retry
+    with StubORSServer(fail_first=100, fail_status=503) as stub:
+        config = {"ors_url": stub.url, "max_retries": 0}
+        failed = download_routes(df, config, filepaths, ["evening"], 1)
+    error = failed[0][1]
+    assert error.status == 503
+    assert error.message == {"error": {"code": 2099, "message": "stub"}}
+    assert not [w for w in recwarn if "Retrying" in str(w.message)]
+
+#test if the circuit breaker pauses all requests after repeated failures
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.2)
+    assert not breaker.record_failure()
+    assert breaker.record_failure()
+
+    start = time.monotonic()
+    breaker.wait()
+    assert time.monotonic() - start >= 0.15
+
+    assert breaker.record_failure()
+    breaker.record_success()
+    assert not breaker.record_failure()
+
+#test if the vectorized polyline decoder matches the ORS client and compact routes match GeoJSON routes
+
+def test_compact_geometry(ors_stub, tmp_path):
+    response = synthetic_route([8.68, 49.40], [8.70, 49.42], 200, seed=1)
+    coordinates = np.array(response["features"][0]["geometry"]["coordinates"])
+    encoded = encode_deltas(quantize(coordinates))
+    expected = np.array(decode_polyline(encoded, is3d=True)["coordinates"])
+    np.testing.assert_allclose(dequantize(decode_deltas(encoded)), expected, atol=1e-9)
+
+    df = pd.DataFrame(
+        {"lon": [8.68], "lat": [49.40], "lon2": [8.70], "lat2": [49.42], "id": [0]}
+    )
+    routes = {}
+    for compact in [False, True]:
+        filepaths = FilePaths(tmp_path, f"run_{compact}")
+        filepaths.OUTPUT_DIR.mkdir()
+        filepaths.create_dirs()
+        config = {"ors_url": ors_stub.url, "compact_geometry": compact}
+        assert download_routes(df, config, filepaths, ["noon"], 1) == []
+        ingest_routes(filepaths.ROUTES_DIR, filepaths.ROUTE_STORE_FILE)
+        routes[compact] = RouteStore(filepaths.ROUTE_STORE_FILE).route(0)
+
+    assert ors_stub.paths[-1].endswith("/json")
+    assert routes[True].file_name() == routes[False].file_name()
+    assert routes[True].extras == routes[False].extras
+    np.testing.assert_allclose(
+        routes[True].coordinates, routes[False].coordinates, atol=1.5
+    )
+    compact_dir = FilePaths(tmp_path, "run_True").ROUTES_DIR
+    assert (compact_dir / "route_0_noon_shortest.npy").exists()
+    compact_route = Route(compact_dir / "route_0_noon_shortest.json")
+    assert compact_route.length() == pytest.approx(routes[False].length(), rel=1e-3)
+
+#test if the pipeline only runs the stages whose config entries, inputs or outputs changed
+
+def test_pipeline_skips_unchanged_stages(ors_stub, tmp_path):
+    heidelberg_bbox = (8.598690, 49.339503, 8.755589, 49.456632)
+    aoi_file = tmp_path / "aoi.geojson"
+    gpd.GeoDataFrame(geometry=[box(*heidelberg_bbox)], crs="EPSG:4326").to_file(
+        aoi_file
+    )
+    config = {
+        "output_dir": str(tmp_path / "data"),
+        "output_dir_metrics": str(tmp_path / "results"),
+        "run_name": "run",
+        "input_gdf": str(aoi_file),
+        "ors_url": ors_stub.url,
+        "random_points": 30,
+        "seed": 1,
+        "number_of_routes_per_time_of_day": 2,
+        "times_of_day": ["noon", "evening"],
+        "heatmap_cell_size_m": 200,
+    }
+
+    first = Pipeline(config).run()
+    assert set(first.values()) == {"ran"}
+    assert list(first)[:2] == ["routes", "route_store"]
+    assert ors_stub.request_count == 8
+    assert set(Pipeline(config).run().values()) == {"skipped"}
+
+    config["heatmap_cell_size_m"] = 500
+    result = Pipeline(config).run()
+    assert [name for name, status in result.items() if status == "ran"] == ["heatmap"]
+
+    pipeline = Pipeline(config)
+    (pipeline.filepaths_res.CSV_RESULTS_DIR / "exposure.parquet").unlink()
+    assert pipeline.run(["exposure"], upstream=False) == {"exposure": "ran"}
+    assert ors_stub.request_count == 8
+
+#test if the features of an AOI run as shards under one rate limit and are merged by aoi
+
+def test_sharded_run(ors_stub, tmp_path):
+    aoi_file = tmp_path / "districts.geojson"
+    gpd.GeoDataFrame(
+        {"name": ["Alt Stadt", "Weststadt"]},
+        geometry=[box(8.66, 49.40, 8.72, 49.42), box(8.66, 49.38, 8.72, 49.40)],
+        crs="EPSG:4326",
+    ).to_file(aoi_file)
+    config = {
+        "output_dir": str(tmp_path / "data"),
+        "output_dir_metrics": str(tmp_path / "results"),
+        "run_name": "run",
+        "input_gdf": str(aoi_file),
+        "split_aoi_by": "name",
+        "ors_url": ors_stub.url,
+        "requests_per_second": 10,
+        "request_burst": 1,
+        "random_points": 20,
+        "seed": 1,
+        "number_of_routes_per_time_of_day": 2,
+        "times_of_day": ["noon", "evening"],
+    }
+
+    shards = shard_configs(config)
+    assert list(shards) == ["Alt_Stadt", "Weststadt"]
+    assert shards["Weststadt"]["run_name"] == "run/Weststadt"
+    assert "split_aoi_by" not in shards["Weststadt"]
+
+    start = time.perf_counter()
+    results = run_shards(config, ["metrics"])
+    # 16 requests at 10 per second: the shards share one token bucket
+    assert time.perf_counter() - start >= 1.4
+    assert ors_stub.request_count == 16
+    assert results["Weststadt"] == {"routes": "ran", "metrics": "ran"}
+    shard_routes = FilePaths(tmp_path / "data", "run/Weststadt").ROUTES_DIR
+    assert len(list(shard_routes.glob("*.geojson"))) == 8
+
+    results_dir = ResultPaths(tmp_path / "results", "run").CSV_RESULTS_DIR
+    df_routes = pd.read_parquet(results_dir / "routes")
+    assert df_routes.groupby("aoi", observed=True).size().to_dict() == {
+        "Alt_Stadt": 8,
+        "Weststadt": 8,
+    }
+    df_noon = pd.read_parquet(
+        results_dir / "metrics",
+        filters=[("aoi", "==", "Weststadt"), ("time_of_day", "==", "noon")],
+    )
+    assert set(df_noon["route_id"]) == set(
+        df_routes.loc[df_routes["aoi"] == "Weststadt", "route_id"]
+    )
+
+    assert len(pd.read_parquet(results_dir / "pairs")) == 8
+
+    assert set(run_shards(config, ["metrics"])["Alt_Stadt"].values()) == {"skipped"}
+    assert ors_stub.request_count == 16
+
+#test if the comparison views match the reshaping of all.parquet and are only rebuilt when the metrics change
+
+def test_route_metrics_views(route_files, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.ROUTES_DIR = route_files[0].parent
+    filepaths_res = ResultPaths(tmp_path, "results")
+    filepaths_res.OUTPUT_DIR.mkdir()
+    filepaths_res.create_dirs()
+    calculate_route_metrics(filepaths, filepaths_res)
+    views_dir = filepaths_res.CSV_RESULTS_DIR / "views"
+    pairs = pd.read_parquet(views_dir / "pairs.parquet")
+
+    # Reshaping of the notebook
+    df = read_rows(filepaths_res.CSV_RESULTS_DIR)
+    dfw = df.groupby("source")["distance"].sum().to_frame().reset_index()
+    dfw = dfw.merge(df[["source", "s_exp"]].drop_duplicates(), on="source")
+    dfw["pair"] = dfw["source"].str.rsplit("_", n=1).str[0]
+    dfw["route_type"] = dfw["source"].str.split("_").str[3]
+    wide = dfw.pivot(
+        index="pair", columns="route_type", values=["distance", "s_exp"]
+    )
+
+    assert len(pairs) == len(wide) == 6
+    pair_names = "route_" + pairs["route_id"].astype(str) + "_"
+    pair_names += pairs["time_of_day"].astype(str)
+    wide = wide.loc[pair_names]
+    np.testing.assert_allclose(
+        pairs["length_diff"],
+        wide["distance", "recommended"] - wide["distance", "shortest"],
+        atol=1e-6,
+    )
+    np.testing.assert_allclose(
+        pairs["s_exp_diff"],
+        wide["s_exp", "recommended"] - wide["s_exp", "shortest"],
+        atol=1e-6,
+    )
+
+    stats = pd.read_parquet(views_dir / "distributions.parquet")
+    noon = stats.set_index(["time_of_day", "type_route", "metric"])
+    noon = noon.loc["noon", "shortest", "length"]
+    lengths = wide["distance", "shortest"][pair_names.str.endswith("noon").to_numpy()]
+    assert noon["count"] == 3
+    assert noon["p50"] == pytest.approx(lengths.median())
+    assert set(stats["type_route"]) == {"shortest", "recommended", "pair"}
+
+    # Unchanged metrics keep the views, a changed route rebuilds them
+    mtime = (views_dir / "pairs.parquet").stat().st_mtime_ns
+    calculate_route_metrics(filepaths, filepaths_res)
+    assert (views_dir / "pairs.parquet").stat().st_mtime_ns == mtime
+    response = synthetic_route([8.66, 49.41], [8.70, 49.42], seed=1)
+    with open(route_files[0], "w") as f:
+        json.dump(response, f)
+    calculate_route_metrics(filepaths, filepaths_res)
+    pairs = pd.read_parquet(views_dir / "pairs.parquet")
+    changed = pairs[(pairs["route_id"] == 0) & (pairs["time_of_day"] == "noon")]
+    assert changed["length_shortest"].iloc[0] == pytest.approx(
+        Route(route_files[0]).length(), rel=1e-2
+    )
+
+#test if the views of older results with only all.parquet are built from it
+
+def test_views_from_all_parquet(route_files, tmp_path):
+    filepaths = FilePaths(tmp_path, "run")
+    filepaths.ROUTES_DIR = route_files[0].parent
+    filepaths_res = ResultPaths(tmp_path, "results")
+    filepaths_res.OUTPUT_DIR.mkdir()
+    filepaths_res.create_dirs()
+    calculate_route_metrics(filepaths, filepaths_res)
+    results_dir = filepaths_res.CSV_RESULTS_DIR
+    routes = read_routes(results_dir)
+    pairs = pd.read_parquet(results_dir / "views" / "pairs.parquet")
+
+    old_results_dir = tmp_path / "old_results"
+    old_results_dir.mkdir()
+    export_tables(results_dir)
+    shutil.copyfile(results_dir / "all.parquet", old_results_dir / "all.parquet")
+    pd.testing.assert_frame_equal(
+        pd.read_parquet(results_dir / "routes.parquet"), routes
+    )
+    assert write_views(old_results_dir)
+
+    pd.testing.assert_frame_equal(
+        read_routes(old_results_dir),
+        routes.drop(columns="n_segments"),
+        check_categorical=False,
+    )
+    pd.testing.assert_frame_equal(
+        pd.read_parquet(old_results_dir / "views" / "pairs.parquet"), pairs
+    )